@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from spectrum_util import Spectrum
+from search_util import ReferenceLibrary, METRICS
+
+# In-process library search: scoring the whole library against the peak index candidates.
+# Library spectra end at a molecular mass between 80 and 600, as in EI libraries, so their most
+# significant (high m/z) peaks spread over the m/z range. The queries are noisy copies of library
+# spectra (intensity noise, dropped small peaks, a few noise peaks), so the top hit of a query should be
+# the spectrum it was made from.
+
+
+def make_spectra(count, rng):
+    spectra = []
+    for _ in range(count):
+        mass = int(rng.integers(80, 600))
+        peaks = min(int(rng.integers(20, 80)), mass - 30)
+        mz = np.sort(rng.choice(np.arange(30, mass + 1), size=peaks, replace=False))
+        intensity = rng.pareto(1.5, peaks) * 50 + 1
+        spectra.append((mz, intensity / intensity.max() * 999))
+    return spectra
+
+
+def make_queries(spectra, truth, rng):
+    queries = []
+    for row in truth:
+        mz, intensity = spectra[row]
+        intensity = intensity * rng.lognormal(0, 0.25, len(intensity))
+        keep = (intensity > 15) | (rng.random(len(intensity)) > 0.3)
+        mz = np.concatenate([mz[keep], rng.choice(np.arange(30, mz.max() + 1), 3)])
+        intensity = np.concatenate([intensity[keep], rng.uniform(1, 30, 3)])
+        order = np.argsort(mz, kind='stable')
+        queries.append(Spectrum(mz[order].astype(np.uint16), intensity[order].astype(np.float32)))
+    return pd.Series(queries, dtype=object)
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def accuracy(hits, truth):
+    best = hits[hits['Rank'] == 1]
+    return float(np.mean(best['Library_Row'].to_numpy() == truth[best['Query'].to_numpy()]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark library search with and without the peak index.')
+    parser.add_argument('--library', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--top-k', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    spectra = make_spectra(args.library, rng)
+    df = pd.DataFrame({'Chemical_Name': [f"Compound {i}" for i in range(args.library)], 'CAS_Number': '', 'Formula': '',
+                       'MS_Peaks': [Spectrum(mz.astype(np.uint16), intensity.astype(np.float32)) for mz, intensity in spectra]})
+    truth = rng.choice(args.library, args.queries, replace=False)
+    queries = make_queries(spectra, truth, rng)
+
+    index_path = tempfile.mkdtemp(prefix='peakindex')
+    try:
+        build_time, library = timed(ReferenceLibrary, df, index_path=index_path)
+        open_time, library = timed(ReferenceLibrary, df, index_path=index_path)
+        lookup_time, (_, candidates) = timed(library.index.candidates, queries)
+        single_time, _ = timed(library.index.candidates, queries[:1])
+
+        print(f"{args.library} library spectra, {args.queries} queries, top {args.top_k}")
+        print(f"  index build: {build_time:8.3f} s, reopen: {open_time:.3f} s")
+        print(f"  candidates:  {lookup_time:8.3f} s ({len(candidates) / args.queries:.0f} per query), "
+              f"single query {single_time * 1000:.2f} ms")
+        for metric in METRICS:
+            brute_time, brute = timed(library.search, queries, top_k=args.top_k, metric=metric, use_index=False)
+            index_time, indexed = timed(library.search, queries, top_k=args.top_k, metric=metric)
+            print(f"  {metric:9}  whole library {brute_time:7.3f} s (top-1 {accuracy(brute, truth):.3f})  "
+                  f"index {index_time:7.3f} s (top-1 {accuracy(indexed, truth):.3f})  {brute_time / index_time:.1f}x")
+    finally:
+        library = None
+        shutil.rmtree(index_path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
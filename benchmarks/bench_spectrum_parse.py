@@ -0,0 +1,65 @@
+import os
+import sys
+import ast
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from spectrum_util import Spectrum, parse_ms_peaks_column
+
+# CSV spectrum loading: the old per-access ast.literal_eval path against parsing the column once.
+# The old path parsed a row again on every plot click, export row and NIST search; `--accesses`
+# sets how many times each row is read.
+
+
+def make_texts(rows, peaks, seed=0):
+    # MS_Peaks text as written by DataFrame.to_csv
+    rng = np.random.default_rng(seed)
+    texts = []
+    for _ in range(rows):
+        mz = np.sort(rng.choice(np.arange(35, 500), size=peaks, replace=False))
+        intensity = np.round(rng.uniform(1, 999, size=peaks), 4)
+        texts.append(repr(list(zip(mz.tolist(), intensity.tolist()))))
+    return texts
+
+
+def literal_eval_path(texts, accesses):
+    for _ in range(accesses):
+        spectra = [Spectrum.from_peaks(ast.literal_eval(text)) for text in texts]
+    return spectra
+
+
+def parse_once_path(texts, accesses):
+    store, _ = parse_ms_peaks_column(texts)
+    for _ in range(accesses):
+        spectra = list(store)
+    return spectra
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark MS_Peaks parsing on CSV import.')
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--peaks', type=int, default=60)
+    parser.add_argument('--accesses', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    texts = make_texts(args.rows, args.peaks)
+    old_time, old = timed(literal_eval_path, texts, args.accesses)
+    new_time, new = timed(parse_once_path, texts, args.accesses)
+
+    same = all(np.array_equal(a.mz, b.mz) and np.array_equal(a.intensity, b.intensity) for a, b in zip(old, new))
+    print(f"{args.rows} rows x {args.peaks} peaks, {args.accesses} access(es) per row")
+    print(f"  literal_eval per access: {old_time:8.3f} s")
+    print(f"  parse once (tokenizer):  {new_time:8.3f} s  ({old_time / new_time:.1f}x)")
+    print(f"  identical spectra: {same}")
+
+
+if __name__ == '__main__':
+    main()
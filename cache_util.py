@@ -0,0 +1,155 @@
+import os
+import hashlib
+import numpy as np
+from spectrum_util import Spectrum, SpectrumStore
+
+# On-disk cache of parsed CEF files.
+# Each CEF file gets one compact .npz sidecar in the cache directory holding its compounds as
+# packed arrays. A sidecar is valid while the size and mtime of the CEF file are unchanged; if only
+# the mtime changed (e.g. the file was copied) the content hash decides.
+
+CACHE_VERSION = 2
+DEFAULT_CACHE_LIMIT = 512 * 1024 * 1024  # bytes
+
+_STRING_FIELDS = ['Chemical_Name', 'Formula', 'CAS_Number', 'File']
+_FLOAT_FIELDS = ['RT', 'RI', 'MaxArea']
+
+
+def default_cache_dir():
+    return os.environ.get('LIBRACEF_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.libracef', 'cef_cache'))
+
+
+def _sidecar_path(cache_dir, file_path):
+    key = hashlib.sha1(os.path.abspath(file_path).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{os.path.basename(file_path)}-{key}.npz")
+
+
+def _file_hash(file_path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _pack_compounds(compounds):
+    arrays = {}
+    for field in _STRING_FIELDS:
+        values = [compound.get(field) for compound in compounds]
+        arrays[field] = np.array(['' if value is None else value for value in values], dtype=str)
+        arrays[field + '.present'] = np.array([field in compound and compound[field] is not None for compound in compounds], dtype=bool)
+    for field in _FLOAT_FIELDS:
+        arrays[field] = np.array([compound.get(field, np.nan) for compound in compounds], dtype=np.float64)
+        arrays[field + '.present'] = np.array([field in compound for compound in compounds], dtype=bool)
+
+    peaks = [compound.get('MS_Peaks') for compound in compounds]
+    arrays['MS_Peaks.present'] = np.array([p is not None for p in peaks], dtype=bool)
+    store = SpectrumStore.from_peaks(p if p is not None else [] for p in peaks)
+    arrays['offsets'] = store.offsets
+    arrays['mz'] = store.mz
+    arrays['intensity'] = store.intensity
+    return arrays
+
+
+def _unpack_compounds(arrays):
+    count = len(arrays['offsets']) - 1
+    columns = {}
+    for field in _STRING_FIELDS + _FLOAT_FIELDS:
+        columns[field] = (arrays[field].tolist(), arrays[field + '.present'].tolist())
+
+    offsets = arrays['offsets'].tolist()
+    mz = arrays['mz']
+    intensity = arrays['intensity']
+    peaks_present = arrays['MS_Peaks.present'].tolist()
+
+    compounds = []
+    for i in range(count):
+        compound = {}
+        for field, (values, present) in columns.items():
+            if present[i]:
+                compound[field] = values[i]
+        if peaks_present[i]:
+            start, end = offsets[i], offsets[i + 1]
+            compound['MS_Peaks'] = Spectrum(mz[start:end], intensity[start:end])
+        compounds.append(compound)
+    return compounds
+
+
+def load_cached_compounds(file_path, cache_dir):
+    # Return the cached compounds of file_path, or None if there is no valid sidecar
+    sidecar = _sidecar_path(cache_dir, file_path)
+    try:
+        stat = os.stat(file_path)
+        with np.load(sidecar) as cached:
+            arrays = {name: cached[name] for name in cached.files}
+    except (OSError, ValueError, KeyError):
+        return None
+
+    meta = arrays['meta']
+    if int(meta[0]) != CACHE_VERSION or int(meta[1]) != stat.st_size:
+        return None
+    if int(meta[2]) != stat.st_mtime_ns:
+        # Same size but touched or copied: fall back to the content hash
+        if str(arrays['hash']) != _file_hash(file_path):
+            return None
+        _write_sidecar(sidecar, file_path, arrays, str(arrays['hash']))
+
+    # Mark the sidecar as recently used for LRU eviction
+    try:
+        os.utime(sidecar)
+    except OSError:
+        pass
+    return _unpack_compounds(arrays)
+
+
+def store_cached_compounds(file_path, compounds, cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+    _write_sidecar(_sidecar_path(cache_dir, file_path), file_path, _pack_compounds(compounds), _file_hash(file_path))
+
+
+def _write_sidecar(sidecar, file_path, arrays, file_hash):
+    stat = os.stat(file_path)
+    arrays = dict(arrays)
+    arrays['meta'] = np.array([CACHE_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    arrays['hash'] = np.array(file_hash)
+    # Write to a temporary file first so an interrupted write never leaves a corrupt sidecar behind
+    tmp_path = f"{sidecar}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, sidecar)
+
+
+def enforce_cache_limit(cache_dir, max_bytes=DEFAULT_CACHE_LIMIT):
+    # Evict least recently used sidecars until the cache fits in max_bytes
+    try:
+        entries = [entry for entry in os.scandir(cache_dir) if entry.is_file() and entry.name.endswith('.npz')]
+    except OSError:
+        return
+    entries = sorted(((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries), reverse=True)
+
+    total = 0
+    for _, size, path in entries:
+        total += size
+        if total > max_bytes:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def clear_cef_cache(cache_dir=None):
+    # Remove every sidecar from the cache directory, return the number of files removed
+    cache_dir = cache_dir or default_cache_dir()
+    removed = 0
+    try:
+        entries = list(os.scandir(cache_dir))
+    except OSError:
+        return 0
+    for entry in entries:
+        if entry.is_file() and (entry.name.endswith('.npz') or entry.name.endswith('.tmp')):
+            try:
+                os.remove(entry.path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
@@ -1,68 +1,147 @@
 import pandas as pd
 import xml.etree.ElementTree as ET
 import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
 from scipy.spatial.distance import cosine
-
-def parse_cef_file(file_path):
-    tree = ET.parse(file_path)
-    root = tree.getroot()
-
-    compounds = []
-    for compound in root.findall('.//Compound'):
-        compound_data = {}
-        
-        # Find the chemical name and formula in the attributes under Molecule node under Results node
-        results_node = compound.find('.//Results')
-        if results_node is not None:
-            molecule_node = results_node.find('.//Molecule')
-            if molecule_node is not None:
-                compound_data['Chemical_Name'] = molecule_node.get('name')
-                compound_data['Formula'] = molecule_node.get('formula')
-                
-                # Get CAS number from Accession node under Database node under Molecule node
-                database_node = molecule_node.find('.//Database')
-                if database_node is not None:
-                    accession_node = database_node.find('.//Accession')
-                    if accession_node is not None:
-                        compound_data['CAS_Number'] = accession_node.get('id')
-        
-        # Find RT and RI in attributes in location node under Compound node
-        location_node = compound.find('.//Location')
-        if location_node is not None:
-            compound_data['RT'] = float(location_node.get('rt'))
-            compound_data['RI'] = float(location_node.get('ri', 0))  # Default to 0 if 'ri' is not present
-            compound_data['MaxArea'] = float(location_node.get('a', 0))  # Default to 0 if 'area' is not present
-
-        # Capture mass spectrum from MSPeaks node under Spectrum node
-        spectrum_node = compound.find('.//Spectrum')
-        if spectrum_node is not None:
-            ms_peaks = spectrum_node.find('.//MSPeaks')
-            if ms_peaks is not None:
-                peaks = []
-                for peak in ms_peaks.findall('.//p'):
-                    peaks.append((round(float(peak.get('x'))), float(peak.get('y'))))
-                compound_data['MS_Peaks'] = peaks
-
-        
-        compound_data['File'] = os.path.basename(file_path)  # Add filename to track source
-        compounds.append(compound_data)
-
+from spectrum_util import Spectrum, MZ_DTYPE, INTENSITY_DTYPE, SpectrumStore, as_spectrum, previous_next_similarity, pair_similarity, normalized_csr, candidate_pairs, indexed_pair_similarity
+from formula_util import FormulaIndex
+from cache_util import DEFAULT_CACHE_LIMIT, load_cached_compounds, store_cached_compounds, enforce_cache_limit
+
+def iter_cef_compounds(file_path):
+    # Stream the CEF file and yield one compound record per </Compound>, so the
+    # whole tree never has to be held in memory
+    file_name = os.path.basename(file_path)  # Add filename to track source
+    parents = []
+    for event, element in ET.iterparse(file_path, events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            continue
+
+        parents.pop()
+        if element.tag != 'Compound':
+            continue
+
+        yield _read_compound(element, file_name)
+
+        # Free the processed compound and detach it from its parent (CompoundList)
+        element.clear()
+        if parents:
+            parents[-1].remove(element)
+
+def _read_compound(compound, file_name):
+    compound_data = {}
+
+    # Chemical name and formula are attributes of Compound/Results/Molecule
+    molecule_node = compound.find('Results/Molecule')
+    if molecule_node is not None:
+        compound_data['Chemical_Name'] = molecule_node.get('name')
+        compound_data['Formula'] = molecule_node.get('formula')
+
+        # CAS number is the id of Molecule/Database/Accession
+        accession_node = molecule_node.find('Database/Accession')
+        if accession_node is not None:
+            compound_data['CAS_Number'] = accession_node.get('id')
+
+    # Find RT and RI in attributes in location node under Compound node
+    location_node = compound.find('Location')
+    if location_node is not None:
+        compound_data['RT'] = float(location_node.get('rt'))
+        compound_data['RI'] = float(location_node.get('ri', 0))  # Default to 0 if 'ri' is not present
+        compound_data['MaxArea'] = float(location_node.get('a', 0))  # Default to 0 if 'area' is not present
+
+    # Capture mass spectrum from Spectrum/MSPeaks
+    ms_peaks = compound.find('Spectrum/MSPeaks')
+    if ms_peaks is not None:
+        peaks = [(peak.get('x'), peak.get('y')) for peak in ms_peaks.iterfind('p')]
+        values = np.array(peaks, dtype=np.float64).reshape(-1, 2)
+        compound_data['MS_Peaks'] = Spectrum(np.rint(values[:, 0]).astype(MZ_DTYPE), values[:, 1].astype(INTENSITY_DTYPE))
+
+    compound_data['File'] = file_name
+    return compound_data
+
+def parse_cef_file(file_path, cache_dir=None):
+    # With a cache_dir, reuse the parsed compounds from the on-disk cache when the file is unchanged
+    if cache_dir is None:
+        return list(iter_cef_compounds(file_path))
+
+    compounds = load_cached_compounds(file_path, cache_dir)
+    if compounds is None:
+        compounds = list(iter_cef_compounds(file_path))
+        try:
+            store_cached_compounds(file_path, compounds, cache_dir)
+        except OSError as e:
+            print(f"Unable to cache {file_path}: {e}")
     return compounds
 
-def combine_cef_results(directory, rt_tolerance=0.1, group_similarity_threshold=0.9, exclude_elements=['Si']):
-    all_compounds = []
-    for filename in os.listdir(directory):
-        if filename.endswith('.cef'):
-            file_path = os.path.join(directory, filename)
-            all_compounds.extend(parse_cef_file(file_path))
-    
+def list_cef_files(directory):
+    # Sorted so that the merge order (and therefore tie-breaking in the dedup) does not depend on the file system
+    return [os.path.join(directory, filename) for filename in sorted(os.listdir(directory)) if filename.endswith('.cef')]
+
+class ImportCancelled(Exception):
+    pass
+
+# Errors that make a single CEF file unreadable
+CEF_FILE_ERRORS = (ET.ParseError, OSError, ValueError, TypeError)
+
+def load_cef_compounds(file_paths, workers=1, cache_dir=None, cache_limit=DEFAULT_CACHE_LIMIT, on_file=None, cancelled=None, errors=None):
+    # Yield the compounds of all files in the order of file_paths.
+    # With workers > 1 the files are parsed in a process pool; results are still merged in file order.
+    # on_file(file_path, compounds, done, total) is called after each file. cancelled() is checked between
+    # files and raises ImportCancelled when it returns True. With an errors list, unreadable files are
+    # skipped and recorded there as (file_path, reason) instead of raising.
+    if workers is None or workers <= 1 or len(file_paths) <= 1:
+        readers = (partial(parse_cef_file, file_path, cache_dir) for file_path in file_paths)
+        yield from _file_compounds(file_paths, readers, on_file, cancelled, errors)
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(file_paths))) as executor:
+            futures = [executor.submit(parse_cef_file, file_path, cache_dir) for file_path in file_paths]
+            try:
+                yield from _file_compounds(file_paths, (future.result for future in futures), on_file, cancelled, errors)
+            finally:
+                # Files not started yet are dropped on cancellation or error
+                for future in futures:
+                    future.cancel()
+
+    if cache_dir is not None:
+        enforce_cache_limit(cache_dir, cache_limit)
+
+def _file_compounds(file_paths, readers, on_file, cancelled, errors):
+    for done, (file_path, read) in enumerate(zip(file_paths, readers), start=1):
+        if cancelled is not None and cancelled():
+            raise ImportCancelled()
+        try:
+            compounds = read()
+        except CEF_FILE_ERRORS as e:
+            if errors is None:
+                raise
+            errors.append((file_path, f"{type(e).__name__}: {e}"))
+            compounds = []
+        yield from compounds
+        if on_file is not None:
+            on_file(file_path, compounds, done, len(file_paths))
+
+def _check_stage(stage, progress, cancelled):
+    if cancelled is not None and cancelled():
+        raise ImportCancelled()
+    if progress is not None:
+        progress(stage)
+
+COLUMN_ORDER = ['Chemical_Name', 'Formula', 'RT', 'RI', 'RI Ref', 'CAS_Number', 'group', 'Similarity_to_Previous', 'Similarity_to_Next', 'MS_Peaks', 'File','MaxArea']
+
+# Suffix added to repeated compound names, e.g. "Toluene peak 2"
+PEAK_SUFFIX = re.compile(r' peak \d+$')
+
+def merge_duplicate_peaks(compounds, rt_tolerance):
     # Sort compounds by Chemical_Name and RT
-    sorted_list = sorted(all_compounds, key=lambda x: (x['Chemical_Name'], x['RT']))
+    sorted_list = sorted(compounds, key=lambda x: (x['Chemical_Name'], x['RT']))
 
-    # Step 2: Prepare the structures to hold the unique peaks and count the duplicates
+    # Prepare the structures to hold the unique peaks
     unique_compounds = []
-    peak_counts = {}  # To keep track of peak counts for renaming
 
     for i, current in enumerate(sorted_list):
         if i == 0:
@@ -89,6 +168,30 @@ def combine_cef_results(directory, rt_tolerance=0.1, group_similarity_threshold=
                 # If the current peak is a duplicate, we skip adding it to unique_compounds
                 continue
 
+    return unique_compounds
+
+def exclude_compounds(df, exclude_elements):
+    # Remove compounds with formula containing any of the excluded elements (element-wise, so "C" does not match "Cl")
+    if len(df) == 0 or 'Formula' not in df.columns:
+        return df.reset_index(drop=True)
+    excluded = FormulaIndex(df['Formula']).contains_any(exclude_elements)
+    return df[~excluded].reset_index(drop=True)
+
+def combine_cef_results(directory, rt_tolerance=0.1, group_similarity_threshold=0.9, exclude_elements=['Si'], workers=1, cache_dir=None, max_rt_gap=None,
+                        grouping='adjacent', rt_window=0.5, ri_window=None, on_file=None, progress=None, cancelled=None, errors=None):
+    # grouping='adjacent' groups runs of similar RT-neighbours; grouping='cluster' links similar spectra
+    # anywhere within rt_window (and ri_window) of each other, see cluster_groups.
+    # on_file, cancelled and errors are passed to load_cef_compounds; after parsing, progress(stage) is
+    # called before each step and cancelled() is checked between the steps.
+    all_compounds = list(load_cef_compounds(list_cef_files(directory), workers=workers, cache_dir=cache_dir,
+                                            on_file=on_file, cancelled=cancelled, errors=errors))
+    if not all_compounds:
+        raise ValueError(f"No compounds found in the CEF files of {directory}")
+
+    # Step 2: merge the same identification found in several files
+    _check_stage("Merging duplicate peaks", progress, cancelled)
+    unique_compounds = merge_duplicate_peaks(all_compounds, rt_tolerance)
+
     # Step 3: Rename duplicates with "peak" suffix
     # Create a new list to hold renamed compounds
     renamed_dicts = []
@@ -111,64 +214,242 @@ def combine_cef_results(directory, rt_tolerance=0.1, group_similarity_threshold=
     # Sort unique_compounds by RT
     renamed_dicts.sort(key=lambda x: x['RT'])
 
-    # Rename duplcates as Peak 1, Peak 2, etc.
-    
-    df = pd.DataFrame(renamed_dicts)
-    
-    # Remove compounds with formula containing "Si"
-    for element in exclude_elements:
-        df = df[~df['Formula'].str.contains(element, na=False)]
-    
+    df = exclude_compounds(pd.DataFrame(renamed_dicts), exclude_elements)
     
-    # Calculate similarity to previous and next spectrum
-    df['Similarity_to_Previous'] = df.apply(lambda row: calculate_similarity(row, df.iloc[df.index.get_loc(row.name) - 1] if df.index.get_loc(row.name) > 0 else None), axis=1)
-    df['Similarity_to_Next'] = df.apply(lambda row: calculate_similarity(row, df.iloc[df.index.get_loc(row.name) + 1] if df.index.get_loc(row.name) < len(df) - 1 else None), axis=1)
-    # Replace None values with 0 in Similarity_to_Previous and Similarity_to_Next columns
-    df['Similarity_to_Previous'] = df['Similarity_to_Previous'].fillna(0)
-    df['Similarity_to_Next'] = df['Similarity_to_Next'].fillna(0)
-    # Add a 'group' column and assign group numbers
-    df['group'] = 0
-    group_id = 1
-
-    # Assign the first row to the first group
-    df.at[0, 'group'] = group_id
+    # Pack all spectra into one shared store; the column keeps zero-copy views
+    store = SpectrumStore.from_peaks(df['MS_Peaks'])
+    df['MS_Peaks'] = store.to_series(df.index)
 
-    for i in range(1, len(df)):
-    # Since next_similarity of previous row == prev_similarity of current row,
-    # we check if this shared similarity exceeds the threshold
-        shared_similarity = df.iloc[i]['Similarity_to_Previous']  # or df.at[i - 1, 'next_similarity']
-
-        if shared_similarity > group_similarity_threshold:
-            # Assign the current row to the same group as the previous row
-            df.iloc[i, df.columns.get_loc('group')] = group_id
-        else:
-            # Start a new group
-            group_id += 1
-            df.iloc[i, df.columns.get_loc('group')] = group_id
+    # Calculate similarity to previous and next spectrum in one sparse pass (0 for the first/last row)
+    _check_stage("Calculating spectrum similarity", progress, cancelled)
+    df['Similarity_to_Previous'], df['Similarity_to_Next'] = previous_next_similarity(store)
+    # Add a 'group' column and assign group numbers
+    _check_stage("Grouping peaks", progress, cancelled)
+    if grouping == 'cluster':
+        df['group'] = cluster_groups(store, df['RT'].to_numpy(), group_similarity_threshold,
+                                     rt_window=rt_window, ri=df['RI'].to_numpy(), ri_window=ri_window)
+    else:
+        df['group'] = assign_groups(df['Similarity_to_Previous'].to_numpy(), group_similarity_threshold,
+                                    rt=df['RT'].to_numpy(), max_rt_gap=max_rt_gap)
 
     df['RI Ref'] = ''
     # Reorder columns
-    column_order = ['Chemical_Name', 'Formula', 'RT', 'RI', 'RI Ref', 'CAS_Number', 'group', 'Similarity_to_Previous', 'Similarity_to_Next', 'MS_Peaks', 'File','MaxArea']
-    df = df[column_order]
+    df = df[COLUMN_ORDER]
     
     return df
 
+def append_cef_results(df, file_paths, rt_tolerance=0.1, group_similarity_threshold=0.9, exclude_elements=['Si'], workers=1, cache_dir=None, max_rt_gap=None,
+                       grouping='adjacent', rt_window=0.5, ri_window=None, edited_rows=None):
+    # Fold the compounds of new CEF files into an existing result frame.
+    # A new compound that matches an existing row by name and RT is a duplicate peak, as in
+    # merge_duplicate_peaks: when its MaxArea is larger, its spectrum, RT, RI, File and MaxArea replace
+    # those of the row ('updated'), otherwise it is dropped. Rows at the positions in edited_rows (rows
+    # edited by hand) are never replaced. Apart from that, existing rows only change in the similarity
+    # of the neighbours of inserted and updated rows and where an inserted row splits a group, so manual
+    # edits (names, CAS, RI Ref, groups, extra columns) are preserved.
+    # Returns the new frame and a summary dict with the number of added, updated and duplicate compounds
+    # and the positions of the added rows in the new frame.
+    new_compounds = merge_duplicate_peaks(load_cef_compounds(sorted(file_paths), workers=workers, cache_dir=cache_dir), rt_tolerance)
+    if not new_compounds:
+        return df, {'added': 0, 'updated': 0, 'duplicates': 0}
+    new_df = exclude_compounds(pd.DataFrame(new_compounds), exclude_elements).sort_values('RT', kind='stable').reset_index(drop=True)
+    new_df['MS_Peaks'] = SpectrumStore.from_peaks(new_df['MS_Peaks']).to_series(new_df.index)
+
+    # Existing peaks by base name (without the " peak N" suffix), for the name/RT dedup
+    base_names = df['Chemical_Name'].astype(str).str.replace(PEAK_SUFFIX, '', regex=True)
+    existing_rt = {}
+    existing_rows = {}
+    for row, (name, rt) in enumerate(zip(base_names, pd.to_numeric(df['RT'], errors='coerce'))):
+        existing_rt.setdefault(name, []).append(rt)
+        existing_rows.setdefault(name, []).append(row)
+    area = pd.to_numeric(df['MaxArea'], errors='coerce').to_numpy(dtype=np.float64, copy=True) if 'MaxArea' in df.columns else np.full(len(df), np.nan)
+    edited = np.zeros(len(df), dtype=bool)
+    if edited_rows is not None:
+        edited[np.asarray(edited_rows, dtype=np.int64)] = True
+
+    # A duplicate goes to the existing row closest in RT; replaced maps that row to the new compound
+    keep = []
+    replaced = {}
+    new_area = pd.to_numeric(new_df['MaxArea'], errors='coerce').to_numpy(dtype=np.float64)
+    for position, (name, rt) in enumerate(zip(new_df['Chemical_Name'], new_df['RT'])):
+        rts = existing_rt.get(name)
+        distance = np.abs(np.asarray(rts, dtype=np.float64) - rt) if rts is not None else np.zeros(0)
+        if not np.any(distance < rt_tolerance):
+            keep.append(True)
+            continue
+        keep.append(False)
+        row = existing_rows[name][int(np.nanargmin(distance))]
+        if not edited[row] and new_area[position] > area[row]:
+            replaced[row] = position
+            area[row] = new_area[position]
+    duplicates = len(new_df) - int(np.sum(keep)) - len(replaced)
+    updates = new_df.iloc[list(replaced.values())]
+    new_df = new_df[keep].reset_index(drop=True)
+    if new_df.empty and not replaced:
+        return df, {'added': 0, 'updated': 0, 'duplicates': duplicates}
+
+    # Continue the peak numbering of names that already exist
+    names = []
+    for name in new_df['Chemical_Name']:
+        count = len(existing_rt.get(name, [])) + 1
+        existing_rt.setdefault(name, []).append(None)
+        names.append(name if count == 1 else f"{name} peak {count}")
+    new_df['Chemical_Name'] = names
+    new_df['RI Ref'] = ''
+    new_df['group'] = 0
+    new_df['Similarity_to_Previous'] = 0.0
+    new_df['Similarity_to_Next'] = 0.0
+
+    # Insert by RT when the table is RT-sorted, otherwise append at the end
+    rt = pd.to_numeric(df['RT'], errors='coerce').to_numpy()
+    if len(rt) and np.all(np.diff(rt) >= 0):
+        insert_at = np.searchsorted(rt, new_df['RT'].to_numpy(), side='right')
+    else:
+        insert_at = np.full(len(new_df), len(df))
+    sort_key = np.concatenate((np.arange(len(df), dtype=np.float64), insert_at - 0.5))
+    order = np.argsort(sort_key, kind='stable')
+
+    combined = pd.concat([df, new_df[[column for column in COLUMN_ORDER if column in df.columns]]], ignore_index=True)
+    # Extra user columns are left blank on the new rows
+    for column in combined.columns:
+        if column not in COLUMN_ORDER and combined[column].dtype == object:
+            combined.loc[len(df):, column] = combined.loc[len(df):, column].fillna('')
+    updated_rows = np.fromiter(replaced, dtype=np.int64, count=len(replaced))
+    for column in ('MS_Peaks', 'RT', 'RI', 'File', 'MaxArea'):
+        if column in combined.columns and len(updated_rows):
+            combined.iloc[updated_rows, combined.columns.get_loc(column)] = updates[column].to_numpy()
+    combined = combined.iloc[order].reset_index(drop=True)
+
+    # Update the similarity of the inserted and updated rows and their neighbours only
+    positions = np.flatnonzero(order >= len(df))
+    new_positions = np.empty(len(order), dtype=np.int64)
+    new_positions[order] = np.arange(len(order))
+    changed = np.concatenate((positions, new_positions[updated_rows]))
+    left = np.unique(np.concatenate((changed - 1, changed)))
+    left = left[(left >= 0) & (left < len(combined) - 1)]
+    similarity = pair_similarity(combined['MS_Peaks'].iloc[left], combined['MS_Peaks'].iloc[left + 1])
+    previous_column = combined.columns.get_loc('Similarity_to_Previous')
+    next_column = combined.columns.get_loc('Similarity_to_Next')
+    combined.iloc[left + 1, previous_column] = similarity
+    combined.iloc[left, next_column] = similarity
+
+    # Inserted rows join the group of a similar neighbour, otherwise they start a new group
+    group_column = combined.columns.get_loc('group')
+    groups = combined['group'].to_numpy(copy=True)
+    combined_rt = pd.to_numeric(combined['RT'], errors='coerce').to_numpy()
+    next_group = int(pd.to_numeric(df['group'], errors='coerce').max()) + 1 if len(df) else 1
+    inserted = set(positions.tolist())
+    summary = {'added': len(new_df), 'updated': len(replaced), 'duplicates': duplicates, 'positions': positions}
+    if grouping == 'cluster':
+        # Join the group of the most similar grouped row (before or after it) within the RT (and RI) window
+        combined_ri = pd.to_numeric(combined['RI'], errors='coerce').to_numpy()
+        for position in positions:
+            window = np.abs(combined_rt - combined_rt[position]) <= rt_window
+            if ri_window is not None:
+                window &= np.abs(combined_ri - combined_ri[position]) <= ri_window
+            window &= groups != 0
+            window[position] = False
+            candidates = np.flatnonzero(window)
+            similarity = pair_similarity([combined['MS_Peaks'].iat[position]] * len(candidates), combined['MS_Peaks'].iloc[candidates])
+            if len(candidates) and similarity.max() > group_similarity_threshold:
+                groups[position] = groups[candidates[np.argmax(similarity)]]
+            else:
+                groups[position] = next_group
+                next_group += 1
+        combined.iloc[:, group_column] = groups
+        return combined, summary
+
+    for position in positions:
+        joined = False
+        for neighbour, column in ((position - 1, previous_column), (position + 1, next_column)):
+            if neighbour < 0 or neighbour >= len(combined) or neighbour in inserted and groups[neighbour] == 0:
+                continue
+            within_gap = max_rt_gap is None or abs(combined_rt[position] - combined_rt[neighbour]) <= max_rt_gap
+            if combined.iat[position, column] > group_similarity_threshold and within_gap:
+                groups[position] = groups[neighbour]
+                joined = True
+                break
+        if not joined:
+            groups[position] = next_group
+            next_group += 1
+
+    # A run of inserted rows that does not all join the group around it splits that group: the rows after
+    # the last inserted row that left it start a new group, so groups stay contiguous runs of rows
+    block_starts = positions[~np.isin(positions - 1, positions)]
+    block_ends = positions[~np.isin(positions + 1, positions)]
+    for start, end in zip(block_starts, block_ends):
+        before, after = start - 1, end + 1
+        if before < 0 or after >= len(combined) or groups[before] != groups[after]:
+            continue
+        outside = np.flatnonzero(groups[start:end + 1] != groups[before])
+        if not len(outside):
+            continue
+        split = start + outside[-1] + 1
+        run = np.flatnonzero(groups[split:] != groups[before])
+        groups[split:split + (run[0] if len(run) else len(groups) - split)] = next_group
+        next_group += 1
+    combined.iloc[:, group_column] = groups
+
+    return combined, summary
+
+def assign_groups(similarity_to_previous, group_similarity_threshold, rt=None, max_rt_gap=None):
+    # A row joins the group of the previous row when their shared similarity exceeds the threshold
+    # (and, with max_rt_gap, when they are at most max_rt_gap apart in RT); otherwise it starts a new group.
+    # Group numbers start at 1.
+    similarity_to_previous = np.asarray(similarity_to_previous, dtype=np.float64)
+    if len(similarity_to_previous) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    new_group = ~(similarity_to_previous > group_similarity_threshold)
+    if max_rt_gap is not None and rt is not None:
+        new_group[1:] |= np.abs(np.diff(np.asarray(rt, dtype=np.float64))) > max_rt_gap
+    new_group[0] = True
+    return np.cumsum(new_group)
+
+def cluster_groups(spectra, rt, group_similarity_threshold, rt_window=0.5, ri=None, ri_window=None):
+    # Group spectra across the whole data set: every pair within the RT (and RI) window whose
+    # similarity exceeds the threshold is linked, and each connected component becomes one group.
+    # Candidate pairs come from an inverted index over the top peaks, so not all pairs are scored.
+    # Group numbers start at 1 and follow the row order.
+    store = SpectrumStore.from_peaks(spectra) if not isinstance(spectra, SpectrumStore) else spectra
+    count = len(store)
+    if count == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    first, second = candidate_pairs(store, rt, rt_window)
+    if ri is not None and ri_window is not None:
+        ri = np.asarray(ri, dtype=np.float64)
+        within = np.abs(ri[first] - ri[second]) <= ri_window
+        first, second = first[within], second[within]
+
+    similarity = indexed_pair_similarity(normalized_csr(store), first, second)
+    linked = similarity > group_similarity_threshold
+    graph = sparse.coo_matrix((np.ones(linked.sum()), (first[linked], second[linked])), shape=(count, count))
+    _, labels = connected_components(graph, directed=False)
+
+    # Renumber the components in order of their first row
+    _, first_rows = np.unique(labels, return_index=True)
+    rank = np.empty(len(first_rows), dtype=np.int64)
+    rank[labels[np.sort(first_rows)]] = np.arange(1, len(first_rows) + 1)
+    return rank[labels]
+
 def calculate_similarity(row1, row2):
     if row2 is None:
         return None
     
-    peaks1 = row1['MS_Peaks']
-    peaks2 = row2['MS_Peaks']
+    spectrum1 = as_spectrum(row1['MS_Peaks'])
+    spectrum2 = as_spectrum(row2['MS_Peaks'])
     
     # Create vectors for comparison
-    max_mz = max(max(p[0] for p in peaks1), max(p[0] for p in peaks2))
-    vector1 = np.zeros(int(max_mz) + 1)
-    vector2 = np.zeros(int(max_mz) + 1)
+    # Nominal m/z as in SpectrumStore.to_csr; a repeated m/z keeps its last intensity
+    mz1 = np.rint(spectrum1.mz).astype(np.int64)
+    mz2 = np.rint(spectrum2.mz).astype(np.int64)
+    max_mz = max(int(mz1.max()), int(mz2.max()))
+    vector1 = np.zeros(max_mz + 1)
+    vector2 = np.zeros(max_mz + 1)
     
-    for mz, intensity in peaks1:
-        vector1[int(mz)] = intensity
-    for mz, intensity in peaks2:
-        vector2[int(mz)] = intensity
+    vector1[mz1] = spectrum1.intensity
+    vector2[mz2] = spectrum2.intensity
     
     # Calculate cosine similarity
     similarity = 1 - cosine(vector1, vector2)
@@ -1,54 +1,81 @@
-import ast
-import xml.etree.ElementTree as ET
+import io
+import os
+import gzip
 import base64
+from xml.sax.saxutils import escape
 from datetime import datetime, timedelta
+import numpy as np
 import pytz
-import struct
 from unidecode import unidecode
+from spectrum_util import as_spectrum_store
 
-def create_jcamp_library(df):
-    jcamp_library = []
-    
-    for index, row in df.iterrows():
-        if type(row['MS_Peaks']) == str:
-            row['MS_Peaks'] = ast.literal_eval(row['MS_Peaks'].strip())
-        jcamp_entry = f"""##TITLE={row['Chemical_Name']}
+JCAMP_HEADER = """##TITLE={name}
 ##JCAMPDX=Revision 5.00
 ##DATA TYPE=MASS SPECTRUM
 ##ORIGIN=Combined CEF Results
 ##OWNER=
-##CAS REGISTRY NO={row['CAS_Number']}
-##$RETENTION INDEX={row['RI']}
-##RETENTION TIME={row['RT']}
-##MOLECULAR FORMULA={row['Formula']}
+##CAS REGISTRY NO={cas}
+##$RETENTION INDEX={ri}
+##RETENTION TIME={rt}
+##MOLECULAR FORMULA={formula}
 ##XUNITS=M/Z
 ##YUNITS=RELATIVE INTENSITY
 ##XFACTOR=1
 ##YFACTOR=1
 ##FIRSTX=0
-##LASTX={max(peak[0] for peak in row['MS_Peaks'])}
+##LASTX={max_mz}
 ##FIRSTY=0
-##MAXX={max(peak[0] for peak in row['MS_Peaks'])}
+##MAXX={max_mz}
 ##MINX=0
 ##MAXY=999
 ##MINY=0
-##MW={row['RT']}
-##NPOINTS={len(row['MS_Peaks'])}
+##MW={rt}
+##NPOINTS={npoints}
 ##PEAK TABLE=(XY..XY)
-"""     
+"""
 
-        for mz, intensity in row['MS_Peaks']:
-            jcamp_entry += f"{int(mz)} {int(intensity)}\n"
-        
-        jcamp_entry += "##END="
-        jcamp_library.append(jcamp_entry)
-    
-    return jcamp_library
+def iter_jcamp_entries(df, chunk_size=5000):
+    # Yield one JCAMP entry per row. Spectra are packed per chunk, and the per-spectrum stats
+    # (max m/z, number of points) are computed for the whole chunk at once.
+    for chunk_start in range(0, len(df), chunk_size):
+        chunk = df.iloc[chunk_start:chunk_start + chunk_size]
+        store = as_spectrum_store(chunk['MS_Peaks'])
+        lengths = store.lengths
+        mz = store.mz.astype(np.int64)
+        intensity = store.intensity.astype(np.int64)
+
+        # reduceat needs valid start positions, empty spectra are set to 0 afterwards
+        max_mz = np.zeros(len(store), dtype=np.int64)
+        if len(mz):
+            starts = np.minimum(store.offsets[:-1], len(mz) - 1)
+            max_mz = np.where(lengths > 0, np.maximum.reduceat(mz, starts), 0)
+
+        # Interleaved m/z, intensity values for the "%d %d" peak lines
+        peaks = np.empty(2 * len(mz), dtype=np.int64)
+        peaks[0::2] = mz
+        peaks[1::2] = intensity
+        peaks = peaks.tolist()
+        offsets = (store.offsets * 2).tolist()
 
-def write_jcamp_library(df, filename):
-    jcamp_library = create_jcamp_library(df)
-    with open(filename, 'w') as f:
-        for entry in jcamp_library:
+        columns = zip(chunk['Chemical_Name'], chunk['CAS_Number'], chunk['RI'], chunk['RT'], chunk['Formula'],
+                      max_mz.tolist(), lengths.tolist(), offsets[:-1], offsets[1:])
+        for name, cas, ri, rt, formula, spectrum_max_mz, npoints, start, end in columns:
+            header = JCAMP_HEADER.format(name=name, cas=cas, ri=ri, rt=rt, formula=formula, max_mz=spectrum_max_mz, npoints=npoints)
+            yield header + ("%d %d\n" * npoints) % tuple(peaks[start:end]) + "##END="
+
+def create_jcamp_library(df):
+    return list(iter_jcamp_entries(df))
+
+def write_jcamp_library(df, filename, compress=None):
+    # Stream the JCAMP library to filename. compress=None gzips when the name ends with .gz.
+    if compress is None:
+        compress = str(filename).endswith('.gz')
+    if compress:
+        f = gzip.open(filename, 'wt', encoding='utf-8')
+    else:
+        f = open(filename, 'w', buffering=1024 * 1024)
+    with f:
+        for entry in iter_jcamp_entries(df):
             f.write(entry + '\n\n')
 
 def get_custom_datetime_string():
@@ -74,56 +101,93 @@ def get_custom_datetime_string():
     
     return custom_datetime_string
 
-def create_mslibrary_xml(df, filename):
-    root = ET.Element("LibraryDataSet", SchemaVersion="2", xmlns="Quantitation.LibraryDatabase")
+def _xml_text(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ''
+    return escape(str(value))
+
+def _write_element(f, name, text, prefix, newline):
+    text = _xml_text(text)
+    if text:
+        f.write(f"{prefix}<{name}>{text}</{name}>{newline}")
+    else:
+        f.write(f"{prefix}<{name}/>{newline}")
+
+def encode_spectra_base64(spectra):
+    # Base64 MzValues and AbundanceValues payloads (little-endian float64) for a batch of spectra.
+    # Both arrays are converted once for the whole batch; each row is then a slice of the same buffer.
+    store = as_spectrum_store(spectra)
+    byte_offsets = (store.offsets * 8).tolist()
+    mz_buffer = memoryview(store.mz.astype('<f8').tobytes())
+    abundance_buffer = memoryview(store.intensity.astype('<f8').tobytes())
+    b64encode = base64.b64encode
+    mz_values = [b64encode(mz_buffer[start:end]).decode('ascii') for start, end in zip(byte_offsets[:-1], byte_offsets[1:])]
+    abundance_values = [b64encode(abundance_buffer[start:end]).decode('ascii') for start, end in zip(byte_offsets[:-1], byte_offsets[1:])]
+    return mz_values, abundance_values
+
+def write_mslibrary_xml(df, file, indent="  ", chunk_size=5000):
+    # Stream an Agilent MSLibrary XML (LibraryDataSet) to a path or text file handle, one compound at a time.
+    # With indent=None the output is written without line breaks.
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'w', encoding='utf-8') as f:
+            write_mslibrary_xml(df, f, indent=indent, chunk_size=chunk_size)
+        return
+
+    f = file
+    newline = "\n" if indent is not None else ""
+    level1 = indent or ""
+    level2 = level1 * 2
     edit_datetime = get_custom_datetime_string()
-    library = ET.SubElement(root, "Library")
-    ET.SubElement(library, "LibraryID").text = "1"
-    ET.SubElement(library, "CreationDateTime").text = edit_datetime
 
-    
-    for index, row in df.iterrows():
-        compound = ET.SubElement(root, "Compound")
-        ET.SubElement(compound, "LibraryID").text = "1"
-        ET.SubElement(compound, "CompoundID").text = str(index + 1)
-        ET.SubElement(compound, "AlternateNames").text = ""  # You may want to add this to your DataFrame
-        ET.SubElement(compound, "CASNumber").text = row['CAS_Number']
-        ET.SubElement(compound, "CompoundName").text = unidecode(row['Chemical_Name'])
-        ET.SubElement(compound, "Description").text = row['File']  # You may want to add this to your DataFrame
-        ET.SubElement(compound, "Formula").text = row['Formula']
-        ET.SubElement(compound, "LastEditDateTime").text = edit_datetime
-        ET.SubElement(compound, "RetentionTimeRTL").text = str(row['RT'])  # Using RT as MW, adjust if needed
-        ET.SubElement(compound, "RetentionIndex").text = str(row['RI'])
-        ET.SubElement(compound, "UserDefined").text = str(row['RI Ref'])  # You may want to add this to your DataFrame
-
-        spectrum = ET.SubElement(root, "Spectrum")
-        ET.SubElement(spectrum, "LibraryID").text = "1"
-        ET.SubElement(spectrum, "CompoundID").text = str(index + 1)
-        ET.SubElement(spectrum, "SpectrumID").text = "0"
-        if type(row['MS_Peaks']) is str:
-            ms_peaks = ast.literal_eval(row['MS_Peaks'].strip())
-        else:
-            ms_peaks = row['MS_Peaks']
-        mz_values = [peak[0] for peak in ms_peaks]
-        abundance_values = [peak[1] for peak in ms_peaks]
-
-        ET.SubElement(spectrum, "AbundanceValues").text = base64.b64encode(struct.pack('<%sd' % len(abundance_values), *abundance_values)).decode()
-        ET.SubElement(spectrum, "IonPolarity").text = "Positive"
-        ET.SubElement(spectrum, "LastEditDateTime").text = edit_datetime
-        ET.SubElement(spectrum, "MzValues").text = base64.b64encode(struct.pack('<%sd' % len(mz_values), *mz_values)).decode()
-        ET.SubElement(spectrum, "Origin").text = "Combined CEF Results"
-        ET.SubElement(spectrum, "Owner").text = ""
-        ET.SubElement(spectrum, "ScanType").text = "Scan"
-
-    tree = ET.ElementTree(root)
-    # Convert the ElementTree to a string
-    xml_string = ET.tostring(root, encoding="utf-8", xml_declaration=True).decode("utf-8")
-    
-    # Prettify the XML string
-    from xml.dom import minidom
-    pretty_xml_string = minidom.parseString(xml_string).toprettyxml(indent="  ")
-    
-    # Return the prettified XML string
-    return pretty_xml_string
-    # print(filename)
-    # tree.write(filename, encoding="utf-8", xml_declaration=True)
+    f.write(f'<?xml version="1.0" ?>{newline}')
+    f.write(f'<LibraryDataSet xmlns="Quantitation.LibraryDatabase" SchemaVersion="2">{newline}')
+    f.write(f"{level1}<Library>{newline}")
+    _write_element(f, "LibraryID", "1", level2, newline)
+    _write_element(f, "CreationDateTime", edit_datetime, level2, newline)
+    f.write(f"{level1}</Library>{newline}")
+
+    # Spectra are encoded in bulk, one chunk of rows at a time to keep memory flat
+    for chunk_start in range(0, len(df), chunk_size):
+        chunk = df.iloc[chunk_start:chunk_start + chunk_size]
+        mz_values, abundance_values = encode_spectra_base64(chunk['MS_Peaks'])
+        columns = zip(chunk.index, chunk['CAS_Number'], chunk['Chemical_Name'], chunk['File'], chunk['Formula'],
+                      chunk['RT'], chunk['RI'], chunk['RI Ref'], mz_values, abundance_values)
+        _write_compounds(f, columns, edit_datetime, level1, level2, newline)
+
+    f.write(f"</LibraryDataSet>{newline}")
+
+def _write_compounds(f, columns, edit_datetime, level1, level2, newline):
+    for index, cas_number, chemical_name, file_name, formula, rt, ri, ri_ref, mz_value, abundance_value in columns:
+        compound_id = str(index + 1)
+        f.write(f"{level1}<Compound>{newline}")
+        _write_element(f, "LibraryID", "1", level2, newline)
+        _write_element(f, "CompoundID", compound_id, level2, newline)
+        _write_element(f, "AlternateNames", "", level2, newline)  # You may want to add this to your DataFrame
+        _write_element(f, "CASNumber", cas_number, level2, newline)
+        _write_element(f, "CompoundName", unidecode(str(chemical_name)), level2, newline)
+        _write_element(f, "Description", file_name, level2, newline)  # You may want to add this to your DataFrame
+        _write_element(f, "Formula", formula, level2, newline)
+        _write_element(f, "LastEditDateTime", edit_datetime, level2, newline)
+        _write_element(f, "RetentionTimeRTL", str(rt), level2, newline)
+        _write_element(f, "RetentionIndex", str(ri), level2, newline)
+        _write_element(f, "UserDefined", str(ri_ref), level2, newline)  # You may want to add this to your DataFrame
+        f.write(f"{level1}</Compound>{newline}")
+
+        f.write(f"{level1}<Spectrum>{newline}")
+        _write_element(f, "LibraryID", "1", level2, newline)
+        _write_element(f, "CompoundID", compound_id, level2, newline)
+        _write_element(f, "SpectrumID", "0", level2, newline)
+        _write_element(f, "AbundanceValues", abundance_value, level2, newline)
+        _write_element(f, "IonPolarity", "Positive", level2, newline)
+        _write_element(f, "LastEditDateTime", edit_datetime, level2, newline)
+        _write_element(f, "MzValues", mz_value, level2, newline)
+        _write_element(f, "Origin", "Combined CEF Results", level2, newline)
+        _write_element(f, "Owner", "", level2, newline)
+        _write_element(f, "ScanType", "Scan", level2, newline)
+        f.write(f"{level1}</Spectrum>{newline}")
+
+def create_mslibrary_xml(df, filename=None):
+    # Return the MSLibrary XML as one string; prefer write_mslibrary_xml for large libraries
+    buffer = io.StringIO()
+    write_mslibrary_xml(df, buffer)
+    return buffer.getvalue()
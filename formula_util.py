@@ -0,0 +1,142 @@
+import re
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+# Element-aware formula index.
+# Each distinct formula string is parsed once into element counts; a FormulaIndex holds the counts
+# of a whole column as a compact integer matrix so element and mass filters are vectorized masks.
+
+# Monoisotopic masses of the elements commonly found in GC-MS library compounds
+MONOISOTOPIC_MASS = {
+    'H': 1.007825, 'D': 2.014102, 'B': 11.009305, 'C': 12.0, 'N': 14.003074, 'O': 15.994915,
+    'F': 18.998403, 'Na': 22.989770, 'Si': 27.976927, 'P': 30.973762, 'S': 31.972071,
+    'Cl': 34.968853, 'K': 38.963707, 'Ge': 73.921178, 'As': 74.921596, 'Se': 79.916522,
+    'Br': 78.918338, 'Sn': 119.902197, 'I': 126.904468, 'Hg': 201.970643,
+}
+
+_TOKEN = re.compile(r'([A-Z][a-z]?)|(\()|(\))|(\d+)|(\s+)')
+_ELEMENT = re.compile(r'[A-Z][a-z]?')
+
+
+@lru_cache(maxsize=None)
+def parse_formula(formula):
+    # Parse a molecular formula such as "C6H5Cl" or "C2H4(OH)2" into a tuple of (element, count).
+    # Raises ValueError for text that is not a formula.
+    stack = [{}]
+    position = 0
+    last = None  # counts added by the previous token, multiplied by a following number
+    while position < len(formula):
+        match = _TOKEN.match(formula, position)
+        if match is None:
+            raise ValueError(f"Invalid formula: {formula!r}")
+        element, open_group, close_group, number, _ = match.groups()
+        position = match.end()
+
+        if element:
+            stack[-1][element] = stack[-1].get(element, 0) + 1
+            last = {element: 1}
+        elif open_group:
+            stack.append({})
+            last = None
+        elif close_group:
+            if len(stack) == 1:
+                raise ValueError(f"Invalid formula: {formula!r}")
+            group = stack.pop()
+            for name, count in group.items():
+                stack[-1][name] = stack[-1].get(name, 0) + count
+            last = group
+        elif number:
+            if last is None:
+                raise ValueError(f"Invalid formula: {formula!r}")
+            for name, count in last.items():
+                stack[-1][name] += count * (int(number) - 1)
+            last = None
+
+    if len(stack) != 1:
+        raise ValueError(f"Invalid formula: {formula!r}")
+    return tuple(sorted(stack[0].items()))
+
+
+def _normalize_element(element):
+    element = element.strip()
+    return element[:1].upper() + element[1:].lower()
+
+
+class FormulaIndex:
+    def __init__(self, formulas):
+        # Parse every distinct formula once; rows share the counts of their formula
+        codes, uniques = pd.factorize(pd.Series(formulas, dtype=object).fillna('').astype(str))
+        parsed = []
+        self.invalid = np.zeros(len(uniques), dtype=bool)
+        # Element symbols found in the text of formulas the parser rejects (charges, other tokens)
+        self.unparsed_elements = {}
+        for i, formula in enumerate(uniques):
+            if not formula.strip():
+                parsed.append(())
+                self.invalid[i] = True
+                continue
+            try:
+                parsed.append(parse_formula(formula.replace(' ', '')))
+            except ValueError:
+                parsed.append(())
+                self.invalid[i] = True
+                self.unparsed_elements[i] = set(_ELEMENT.findall(formula))
+
+        self.elements = sorted({element for counts in parsed for element, _ in counts})
+        columns = {element: i for i, element in enumerate(self.elements)}
+        self.formula_counts = np.zeros((len(uniques), len(self.elements)), dtype=np.int32)
+        for i, counts in enumerate(parsed):
+            for element, count in counts:
+                self.formula_counts[i, columns[element]] = count
+        self.codes = codes
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def counts(self):
+        # Row x element count matrix
+        return self.formula_counts[self.codes]
+
+    def count(self, element):
+        # Number of atoms of element in every row (0 for rows without a formula)
+        element = _normalize_element(element)
+        if element not in self.elements:
+            return np.zeros(len(self), dtype=np.int32)
+        return self.formula_counts[:, self.elements.index(element)][self.codes]
+
+    def contains_any(self, elements):
+        # Formulas that could not be parsed match when the element symbol appears in their text
+        elements = [_normalize_element(element) for element in elements if element and element.strip()]
+        mask = np.zeros(len(self), dtype=bool)
+        for element in elements:
+            mask |= self.count(element) > 0
+        unparsed = [i for i, symbols in self.unparsed_elements.items() if symbols.intersection(elements)]
+        if unparsed:
+            mask |= np.isin(self.codes, unparsed)
+        return mask
+
+    def element_range(self, element, minimum=0, maximum=None):
+        counts = self.count(element)
+        mask = counts >= minimum
+        if maximum is not None:
+            mask &= counts <= maximum
+        return mask
+
+    def monoisotopic_mass(self):
+        # NaN for rows with unknown elements or without a valid formula
+        masses = np.array([MONOISOTOPIC_MASS.get(element, np.nan) for element in self.elements], dtype=np.float64)
+        used = self.formula_counts > 0
+        formula_mass = np.where(used, self.formula_counts * masses, 0).sum(axis=1)
+        formula_mass[self.invalid | (used & np.isnan(masses)).any(axis=1)] = np.nan
+        return formula_mass[self.codes]
+
+    def mass_range(self, minimum=None, maximum=None):
+        mass = self.monoisotopic_mass()
+        mask = ~np.isnan(mass)
+        if minimum is not None:
+            mask &= mass >= minimum
+        if maximum is not None:
+            mask &= mass <= maximum
+        return mask
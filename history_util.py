@@ -0,0 +1,320 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+from spectrum_util import Spectrum
+
+# Undo/redo history for the result table.
+# Every edit is recorded as a command that keeps only what it changed (cells, rows, a column or a row
+# order) instead of a copy of the whole frame. Commands work on row positions; redo(df) and undo(df)
+# return the updated frame, which may be df itself when the change was made in place.
+# Index labels identify rows across edits: they move with the rows, deleted rows take theirs along and
+# get them back on undo, and inserted rows keep the labels they come with (which must be new labels).
+# changes(undo) describes the effect on the rows so a table view can be updated without a reset:
+# a list of ('insert', positions after the insert), ('remove', positions before the removal),
+# ('order', old position of every new row) and ('values', positions, columns) steps, or None when
+# the columns changed.
+
+DEFAULT_MEMORY_BUDGET_MB = 256
+
+
+def default_memory_budget():
+    # Bytes of undo history to keep; LIBRACEF_UNDO_MEMORY_MB overrides the default
+    return int(float(os.environ.get('LIBRACEF_UNDO_MEMORY_MB', DEFAULT_MEMORY_BUDGET_MB)) * 1024 * 1024)
+
+
+def _array_nbytes(values):
+    # Approximate memory held by a column slice, including the peak arrays of spectra
+    total = values.nbytes
+    if values.dtype == object:
+        for value in values:
+            if isinstance(value, Spectrum):
+                total += value.mz.nbytes + value.intensity.nbytes
+            elif value is not None:
+                total += sys.getsizeof(value)
+    return total
+
+
+def frame_nbytes(frame):
+    return sum(_array_nbytes(frame[column].to_numpy()) for column in frame.columns)
+
+
+def insert_rows(df, positions, rows):
+    # Insert the rows of `rows` so that they end up at `positions` (ascending) of the returned frame
+    positions = np.asarray(positions, dtype=np.int64)
+    total = len(df) + len(positions)
+    inserted = np.zeros(total, dtype=bool)
+    inserted[positions] = True
+    order = np.empty(total, dtype=np.int64)
+    order[~inserted] = np.arange(len(df))
+    order[inserted] = len(df) + np.arange(len(positions))
+    return pd.concat([df, rows]).take(order)
+
+
+def delete_rows(df, positions):
+    keep = np.ones(len(df), dtype=bool)
+    keep[np.asarray(positions, dtype=np.int64)] = False
+    return df[keep]
+
+
+def move_order(row_count, positions, target):
+    # Row order that moves the rows at positions (keeping their order) in front of row target;
+    # target == row_count moves them to the end
+    positions = np.asarray(positions, dtype=np.int64)
+    moved = np.zeros(row_count, dtype=bool)
+    moved[positions] = True
+    rest = np.flatnonzero(~moved)
+    split = np.searchsorted(rest, target)
+    return np.concatenate((rest[:split], positions, rest[split:]))
+
+
+def capture_values(df, positions, columns):
+    # Copies of the values at positions in each of columns, for SetValues
+    positions = np.asarray(positions, dtype=np.int64)
+    return {column: df[column].to_numpy()[positions].copy() for column in columns}
+
+
+class SetValues:
+    # Cell, spectrum and search hit edits: old and new values of some columns at some row positions.
+    # Columns named in added_columns (name -> fill value) do not exist before the edit.
+    def __init__(self, positions, old_values, new_values, added_columns=None, text="Edit"):
+        self.positions = np.asarray(positions, dtype=np.int64)
+        self.old_values = old_values
+        self.new_values = new_values
+        self.added_columns = added_columns or {}
+        self.text = text
+        self.nbytes = self.positions.nbytes + sum(_array_nbytes(values) for values in list(old_values.values()) + list(new_values.values()))
+
+    def _assign(self, df, values):
+        for column, column_values in values.items():
+            df.iloc[self.positions, df.columns.get_loc(column)] = column_values
+        return df
+
+    def redo(self, df):
+        for column, fill in self.added_columns.items():
+            if column not in df.columns:
+                df[column] = fill
+        return self._assign(df, self.new_values)
+
+    def undo(self, df):
+        df = self._assign(df, {column: values for column, values in self.old_values.items() if column not in self.added_columns})
+        return df.drop(columns=[column for column in self.added_columns if column in df.columns])
+
+    def changes(self, undo=False):
+        if self.added_columns:
+            return None
+        return [('values', self.positions, list(self.new_values))]
+
+
+class InsertRows:
+    # rows (with their index labels) end up at positions (ascending) of the edited frame
+    def __init__(self, positions, rows, text="Insert rows"):
+        self.positions = np.asarray(positions, dtype=np.int64)
+        self.rows = rows
+        self.text = text
+        self.nbytes = self.positions.nbytes + frame_nbytes(self.rows)
+
+    def redo(self, df):
+        return insert_rows(df, self.positions, self.rows)
+
+    def undo(self, df):
+        return delete_rows(df, self.positions)
+
+    def changes(self, undo=False):
+        return [('remove' if undo else 'insert', self.positions)]
+
+
+class DeleteRows(InsertRows):
+    # rows are the deleted rows, taken from positions (ascending) of the frame before the edit
+    def __init__(self, positions, rows, text="Delete rows"):
+        super().__init__(positions, rows, text)
+
+    def redo(self, df):
+        return delete_rows(df, self.positions)
+
+    def undo(self, df):
+        return insert_rows(df, self.positions, self.rows)
+
+    def changes(self, undo=False):
+        return [('insert' if undo else 'remove', self.positions)]
+
+
+class ReorderRows:
+    # Sorting and moving rows. order: row positions of the frame before the edit, in their new order;
+    # index labels move with the rows
+    def __init__(self, order, text="Sort"):
+        self.order = np.asarray(order, dtype=np.int64)
+        self.text = text
+        self.nbytes = self.order.nbytes
+
+    def redo(self, df):
+        return df.take(self.order)
+
+    def undo(self, df):
+        return df.take(np.argsort(self.order, kind='stable'))
+
+    def changes(self, undo=False):
+        return [('order', np.argsort(self.order, kind='stable') if undo else self.order)]
+
+
+class AddColumn:
+    def __init__(self, name, fill=None, text=None):
+        self.name = name
+        self.fill = fill
+        self.text = text or f"Add column {name}"
+        self.nbytes = 0
+
+    def redo(self, df):
+        df[self.name] = self.fill
+        return df
+
+    def undo(self, df):
+        return df.drop(columns=[self.name])
+
+    def changes(self, undo=False):
+        return None
+
+
+class RemoveColumn:
+    def __init__(self, df, name, text=None):
+        self.name = name
+        self.position = df.columns.get_loc(name)
+        self.values = df[name].copy()
+        self.text = text or f"Remove column {name}"
+        self.nbytes = _array_nbytes(self.values.to_numpy())
+
+    def redo(self, df):
+        return df.drop(columns=[self.name])
+
+    def undo(self, df):
+        df.insert(self.position, self.name, self.values.to_numpy())
+        return df
+
+    def changes(self, undo=False):
+        return None
+
+
+class ReorderColumns:
+    def __init__(self, old_order, new_order, text="Rearrange columns"):
+        self.old_order = list(old_order)
+        self.new_order = list(new_order)
+        self.text = text
+        self.nbytes = 0
+
+    def redo(self, df):
+        return df[self.new_order]
+
+    def undo(self, df):
+        return df[self.old_order]
+
+    def changes(self, undo=False):
+        return None
+
+
+class CompositeCommand:
+    # Several commands applied as one step
+    def __init__(self, commands, text="Edit"):
+        self.commands = list(commands)
+        self.text = text
+        self.nbytes = sum(command.nbytes for command in self.commands)
+
+    def redo(self, df):
+        for command in self.commands:
+            df = command.redo(df)
+        return df
+
+    def undo(self, df):
+        for command in reversed(self.commands):
+            df = command.undo(df)
+        return df
+
+    def changes(self, undo=False):
+        changes = []
+        for command in (reversed(self.commands) if undo else self.commands):
+            command_changes = command.changes(undo)
+            if command_changes is None:
+                return None
+            changes.extend(command_changes)
+        return changes
+
+
+def insert_command(old_df, new_df, positions, text="Insert rows"):
+    # Command for an edit that inserted the rows at positions of new_df and may have changed some cells of
+    # the existing rows (e.g. the neighbour similarities of appended CEF compounds)
+    positions = np.asarray(positions, dtype=np.int64)
+    kept = np.ones(len(new_df), dtype=bool)
+    kept[positions] = False
+    kept = np.flatnonzero(kept)
+    changed_rows = np.zeros(len(kept), dtype=bool)
+    changed_columns = []
+    for column in old_df.columns:
+        old_values = old_df[column].to_numpy()
+        new_values = new_df[column].to_numpy()[kept]
+        changed = ~((old_values == new_values) | (pd.isna(old_values) & pd.isna(new_values)))
+        if changed.any():
+            changed_rows |= changed
+            changed_columns.append(column)
+
+    commands = [InsertRows(positions, new_df.iloc[positions], text)]
+    if changed_columns:
+        rows = np.flatnonzero(changed_rows)
+        old_values = {column: old_df[column].to_numpy()[rows].copy() for column in changed_columns}
+        commands.append(SetValues(kept[rows], old_values, capture_values(new_df, kept[rows], changed_columns), text=text))
+    return CompositeCommand(commands, text)
+
+
+class History:
+    # Undo and redo stacks of commands. When the commands hold more than memory_budget bytes the oldest
+    # are dropped first; the most recent command is always kept.
+    def __init__(self, memory_budget=None):
+        self.memory_budget = default_memory_budget() if memory_budget is None else memory_budget
+        self.undo_commands = []
+        self.redo_commands = []
+
+    @property
+    def nbytes(self):
+        return sum(command.nbytes for command in self.undo_commands + self.redo_commands)
+
+    def can_undo(self):
+        return bool(self.undo_commands)
+
+    def can_redo(self):
+        return bool(self.redo_commands)
+
+    def push(self, command):
+        # Record a command that has already been applied
+        self.redo_commands.clear()
+        self.undo_commands.append(command)
+        self.evict()
+
+    def undo(self, df):
+        # Returns the frame before the last command and the command, or (df, None) when there is nothing to undo
+        if not self.undo_commands:
+            return df, None
+        command = self.undo_commands.pop()
+        df = command.undo(df)
+        self.redo_commands.append(command)
+        return df, command
+
+    def redo(self, df):
+        if not self.redo_commands:
+            return df, None
+        command = self.redo_commands.pop()
+        df = command.redo(df)
+        self.undo_commands.append(command)
+        return df, command
+
+    def set_memory_budget(self, memory_budget):
+        self.memory_budget = memory_budget
+        self.evict()
+
+    def evict(self):
+        # Oldest first: the bottom of the undo stack, then the redo command furthest from the current state
+        total = self.nbytes
+        while total > self.memory_budget and len(self.undo_commands) + len(self.redo_commands) > 1:
+            command = self.undo_commands.pop(0) if self.undo_commands else self.redo_commands.pop(0)
+            total -= command.nbytes
+
+    def clear(self):
+        self.undo_commands.clear()
+        self.redo_commands.clear()
@@ -1,50 +1,121 @@
 import sys
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from PyQt5.QtGui import QIcon, QKeySequence
-from PyQt5.QtWidgets import QApplication, QMainWindow, QTableView, QVBoxLayout, QWidget, QFileDialog, QMenu, QMessageBox, QHBoxLayout, QAction, QSplitter, QInputDialog, QHeaderView, QDialog, QLabel, QDoubleSpinBox, QDialogButtonBox, QLineEdit, QPushButton, QListWidget, QComboBox, QTableWidget, QTableWidgetItem
-from PyQt5.QtCore import Qt, QAbstractTableModel
+from PyQt5.QtWidgets import QApplication, QMainWindow, QTableView, QVBoxLayout, QWidget, QFileDialog, QMenu, QMessageBox, QHBoxLayout, QAction, QSplitter, QInputDialog, QHeaderView, QDialog, QLabel, QDoubleSpinBox, QSpinBox, QDialogButtonBox, QLineEdit, QPushButton, QListWidget, QComboBox, QTableWidget, QTableWidgetItem, QCheckBox
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, QThread, QTimer, pyqtSignal
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
-from nist_util import search_nist_for_spectrum
-from export_util import create_jcamp_library, create_mslibrary_xml
-from cef_util import combine_cef_results
-import ast
+from nist_util import run_nist_search_job, nist_hits_frame
+from search_util import load_reference_library, library_hits_frame
+from export_util import write_jcamp_library, write_mslibrary_xml
+from cef_util import combine_cef_results, append_cef_results, ImportCancelled, COLUMN_ORDER
+from cache_util import default_cache_dir, clear_cef_cache
+from spectrum_util import Spectrum, as_spectrum, parse_ms_peaks_column
+from library_util import read_mslibrary_xml, merge_library_files, merge_summary
+from project_util import save_project, load_project, PROJECT_EXTENSION
+from history_util import History, SetValues, InsertRows, DeleteRows, ReorderRows, AddColumn, RemoveColumn, ReorderColumns, capture_values, insert_command, move_order
 import os
+import multiprocessing
+from collections import OrderedDict
 from pathlib import Path
 
 version = "0.2"
 
+# Columns shown while a CEF import streams in parsed compounds (before merging and grouping)
+CEF_PREVIEW_COLUMNS = [column for column in COLUMN_ORDER if column not in ('RI Ref', 'group', 'Similarity_to_Previous', 'Similarity_to_Next')]
+
 class PandasModel(QAbstractTableModel):
-    def __init__(self, data):
+    # Rows are handed to the view in FETCH_ROWS batches (canFetchMore/fetchMore) and cell texts are read from
+    # NumPy arrays of the columns; formatted strings are kept in a bounded LRU cache.
+    FETCH_ROWS = 2000
+    DISPLAY_CACHE_SIZE = 50000
+    # Row position of a cell edited in the view
+    cell_edited = pyqtSignal(int)
+
+    def __init__(self, data, history=None):
         QAbstractTableModel.__init__(self)
         self._data = data
+        # Cell edits are recorded in history (a history_util.History) when one is given
+        self._history = history
         self._decimal_places = {}
+        self._display_cache = OrderedDict()
+        self._loaded_rows = min(len(data), self.FETCH_ROWS)
+        self._refresh_columns()
+
+    def _refresh_columns(self):
+        self._row_count = len(self._data)
+        self._columns = [self._data.iloc[:, col].to_numpy() for col in range(self._data.shape[1])]
+        self._spectrum_column = self._data.columns.get_loc('MS_Peaks') if 'MS_Peaks' in self._data.columns else None
+        self._display_cache.clear()
 
     def rowCount(self, parent=None):
-        return self._data.shape[0]
+        return self._loaded_rows
 
     def columnCount(self, parent=None):
         return self._data.shape[1]
 
+    def canFetchMore(self, parent=None):
+        return self._loaded_rows < self._row_count
+
+    def fetchMore(self, parent=None):
+        count = min(self._row_count - self._loaded_rows, self.FETCH_ROWS)
+        if count <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self._loaded_rows, self._loaded_rows + count - 1)
+        self._loaded_rows += count
+        self.endInsertRows()
+
+    def _display_text(self, row, col):
+        key = (row, col)
+        text = self._display_cache.get(key)
+        if text is not None:
+            self._display_cache.move_to_end(key)
+            return text
+        value = self._columns[col][row]
+        if col == self._spectrum_column:
+            try:
+                text = as_spectrum(value).summary()
+            except ValueError:
+                text = str(value)
+        elif isinstance(value, (float, np.floating)):
+            text = f"{value:.{self._decimal_places.get(col, 2)}f}"
+        else:
+            text = str(value)
+        self._display_cache[key] = text
+        if len(self._display_cache) > self.DISPLAY_CACHE_SIZE:
+            self._display_cache.popitem(last=False)
+        return text
+
     def data(self, index, role=Qt.DisplayRole):
-        if index.isValid():
+        # Rows past the end of the frame can be asked for while apply_changes is signalling a removal
+        if index.isValid() and index.row() < self._row_count:
             if role == Qt.DisplayRole or role == Qt.EditRole:
-                value = self._data.iloc[index.row(), index.column()]
-                if isinstance(value, float):
-                    decimal_places = self._decimal_places.get(index.column(), 2)
-                    return f"{value:.{decimal_places}f}"
-                return str(value)
+                return self._display_text(index.row(), index.column())
         return None
 
     def setData(self, index, value, role):
         if role == Qt.EditRole:
             try:
+                # Edited text is converted to the column type so numeric columns stay numeric
+                dtype = self._columns[index.column()].dtype
+                if dtype.kind in 'iuf':
+                    value = dtype.type(float(value)) if dtype.kind == 'f' else dtype.type(int(value))
+                column = self._data.columns[index.column()]
+                old_values = capture_values(self._data, [index.row()], [column])
                 self._data.iloc[index.row(), index.column()] = value
-                self.dataChanged.emit(index, index)
-                return True
-            except ValueError:
+            except (ValueError, TypeError):
                 return False
+            if self._history is not None:
+                new_values = capture_values(self._data, [index.row()], [column])
+                self._history.push(SetValues([index.row()], old_values, new_values, text=f"Edit {column}"))
+            # The assignment may have changed the column dtype, so take a fresh copy of it
+            self._columns[index.column()] = self._data.iloc[:, index.column()].to_numpy()
+            self._display_cache.pop((index.row(), index.column()), None)
+            self.dataChanged.emit(index, index)
+            self.cell_edited.emit(index.row())
+            return True
         return False
 
     def headerData(self, col, orientation, role):
@@ -53,12 +124,100 @@ class PandasModel(QAbstractTableModel):
         return None
 
     def flags(self, index):
+        # Spectra are edited with the Modify MS spectrum dialog, not as cell text
+        if index.column() == self._spectrum_column:
+            return Qt.ItemIsSelectable | Qt.ItemIsEnabled
         return Qt.ItemIsSelectable | Qt.ItemIsEnabled | Qt.ItemIsEditable
 
     def set_decimal_places(self, column, places):
         self._decimal_places[column] = places
+        for key in [key for key in self._display_cache if key[1] == column]:
+            del self._display_cache[key]
         self.layoutChanged.emit()
 
+    def apply_changes(self, data, changes):
+        # Swap in the edited frame and tell the view which rows were inserted, removed, reordered or
+        # changed (history_util command changes), so selection and scroll position survive the edit
+        row_count = len(self._data)
+        self._data = data
+        self._refresh_columns()
+        for change in changes:
+            if change[0] == 'remove':
+                # Back to front so the positions of the remaining runs stay valid
+                for start, end in reversed(_row_runs(change[1])):
+                    if start < self._loaded_rows:
+                        end = min(end, self._loaded_rows - 1)
+                        self.beginRemoveRows(QModelIndex(), start, end)
+                        self._loaded_rows -= end - start + 1
+                        self.endRemoveRows()
+                row_count -= len(change[1])
+            elif change[0] == 'insert':
+                # Rows inserted past the loaded rows are picked up by fetchMore
+                fully_loaded = self._loaded_rows >= row_count
+                for start, end in _row_runs(change[1]):
+                    if start < self._loaded_rows or fully_loaded:
+                        self.beginInsertRows(QModelIndex(), start, end)
+                        self._loaded_rows += end - start + 1
+                        self.endInsertRows()
+                row_count += len(change[1])
+            elif change[0] == 'order':
+                self.layoutAboutToBeChanged.emit()
+                new_positions = np.argsort(change[1], kind='stable')
+                old_indexes = self.persistentIndexList()
+                self.changePersistentIndexList(old_indexes, [self.index(int(new_positions[index.row()]), index.column()) for index in old_indexes])
+                self.layoutChanged.emit()
+            elif change[0] == 'values' and len(change[1]):
+                first, last = int(np.min(change[1])), min(int(np.max(change[1])), self._loaded_rows - 1)
+                columns = [self._data.columns.get_loc(column) for column in change[2]]
+                if first <= last:
+                    self.dataChanged.emit(self.index(first, min(columns)), self.index(last, max(columns)))
+
+class CEFPreviewModel(PandasModel):
+    # Read-only table of the compounds a CEF import has parsed so far. Rows are appended to object column
+    # buffers that grow by doubling, so adding a batch does not copy the rows before it.
+    def __init__(self, columns):
+        super().__init__(pd.DataFrame(columns=columns))
+        self._columns = [np.empty(0, dtype=object) for _ in columns]
+
+    def append_rows(self, rows):
+        # rows: a frame with the preview columns. Returns the number of rows in the preview.
+        first, count = self._row_count, len(rows)
+        if not count:
+            return first
+        if first + count > len(self._columns[0]):
+            capacity = max(2 * len(self._columns[0]), first + count, self.FETCH_ROWS)
+            for col, values in enumerate(self._columns):
+                grown = np.empty(capacity, dtype=object)
+                grown[:first] = values[:first]
+                self._columns[col] = grown
+        for col, column in enumerate(rows.columns):
+            self._columns[col][first:first + count] = rows[column].to_numpy()
+        # Like an insert in apply_changes: shown now when all rows were loaded, otherwise by fetchMore
+        if self._loaded_rows >= first:
+            self.beginInsertRows(QModelIndex(), first, first + count - 1)
+            self._row_count += count
+            self._loaded_rows += count
+            self.endInsertRows()
+        else:
+            self._row_count += count
+        return self._row_count
+
+    def setData(self, index, value, role):
+        return False
+
+    def flags(self, index):
+        return Qt.ItemIsSelectable | Qt.ItemIsEnabled
+
+def _row_runs(positions):
+    # (first, last) of each run of consecutive positions (ascending)
+    positions = np.asarray(positions, dtype=np.int64)
+    if not len(positions):
+        return []
+    breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+    starts = positions[np.concatenate(([0], breaks))]
+    ends = positions[np.concatenate((breaks - 1, [len(positions) - 1]))]
+    return list(zip(starts.tolist(), ends.tolist()))
+
 class MplCanvas(FigureCanvas):
     def __init__(self, parent=None, width=5, height=4, dpi=100):
         fig = Figure(figsize=(width, height), dpi=dpi)
@@ -95,12 +254,53 @@ class CEFImportDialog(QDialog):
         layout.addWidget(QLabel("Group Similarity Threshold:"))
         layout.addWidget(self.group_similarity_threshold_input)
 
+        # Split groups when adjacent peaks are further apart than this in RT (0 disables the check)
+        self.max_rt_gap_input = QDoubleSpinBox()
+        self.max_rt_gap_input.setRange(0, 10)
+        self.max_rt_gap_input.setSingleStep(0.01)
+        self.max_rt_gap_input.setValue(0)
+        layout.addWidget(QLabel("Max RT Gap within Group (0 = off):"))
+        layout.addWidget(self.max_rt_gap_input)
+
+        # Grouping mode: adjacent RT neighbours, or spectral clustering over the whole data set
+        self.grouping_input = QComboBox()
+        self.grouping_input.addItems(['Adjacent peaks', 'Spectral clustering'])
+        layout.addWidget(QLabel("Grouping:"))
+        layout.addWidget(self.grouping_input)
+
+        self.rt_window_input = QDoubleSpinBox()
+        self.rt_window_input.setRange(0, 10)
+        self.rt_window_input.setSingleStep(0.05)
+        self.rt_window_input.setValue(0.5)
+        layout.addWidget(QLabel("Clustering RT Window:"))
+        layout.addWidget(self.rt_window_input)
+
+        # Clustering also requires the RI values to be this close (0 disables the check)
+        self.ri_window_input = QDoubleSpinBox()
+        self.ri_window_input.setRange(0, 1000)
+        self.ri_window_input.setSingleStep(5)
+        self.ri_window_input.setValue(0)
+        layout.addWidget(QLabel("Clustering RI Window (0 = off):"))
+        layout.addWidget(self.ri_window_input)
+
         # Add Exclude Element input
         self.exclude_element_input = QLineEdit()
         self.exclude_element_input.setText("Si")
         layout.addWidget(QLabel("Exclude Element (separate by ','):"))
         layout.addWidget(self.exclude_element_input)
 
+        # Number of processes used to parse the CEF files
+        self.workers_input = QSpinBox()
+        self.workers_input.setRange(1, os.cpu_count() or 1)
+        self.workers_input.setValue(min(4, os.cpu_count() or 1))
+        layout.addWidget(QLabel("Worker Processes:"))
+        layout.addWidget(self.workers_input)
+
+        # Reuse previously parsed CEF files from the on-disk cache
+        self.use_cache_input = QCheckBox("Use CEF parse cache")
+        self.use_cache_input.setChecked(True)
+        layout.addWidget(self.use_cache_input)
+
         buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
         buttons.accepted.connect(self.accept)
         buttons.rejected.connect(self.reject)
@@ -112,9 +312,20 @@ class CEFImportDialog(QDialog):
             self.dir_input.setText(directory)
 
     def get_values(self):
+        # Return the directory and the keyword arguments for combine_cef_results
         exclude_elements = [elem.strip() for elem in self.exclude_element_input.text().split(',')]
-        return (self.dir_input.text(), self.rt_tolerance_input.value(),
-                self.group_similarity_threshold_input.value(), exclude_elements)
+        options = {
+            'rt_tolerance': self.rt_tolerance_input.value(),
+            'group_similarity_threshold': self.group_similarity_threshold_input.value(),
+            'exclude_elements': exclude_elements,
+            'workers': self.workers_input.value(),
+            'cache_dir': default_cache_dir() if self.use_cache_input.isChecked() else None,
+            'max_rt_gap': self.max_rt_gap_input.value() or None,
+            'grouping': 'cluster' if self.grouping_input.currentIndex() == 1 else 'adjacent',
+            'rt_window': self.rt_window_input.value(),
+            'ri_window': self.ri_window_input.value() or None,
+        }
+        return self.dir_input.text(), options
 # Create a dialog box for selecting column and order
 class SortDialog(QDialog):
     def __init__(self, parent):
@@ -140,6 +351,94 @@ class SortDialog(QDialog):
     def get_values(self):
         return self.column_combo.currentText(), self.order_combo.currentText()
 
+class NistSearchThread(QThread):
+    # Runs one NIST MS Search job off the UI thread; rows are the DataFrame index labels searched
+    search_done = pyqtSignal(object, object)
+    search_failed = pyqtSignal(object, str)
+
+    def __init__(self, rows, df, spec_data_path, nist_path, parent=None):
+        super().__init__(parent)
+        self.rows = rows
+        self.df = df
+        self.spec_data_path = spec_data_path
+        self.nist_path = nist_path
+
+    def run(self):
+        try:
+            results = run_nist_search_job(self.df, self.spec_data_path, self.nist_path)
+        except Exception as e:
+            self.search_failed.emit(self.rows, str(e))
+            return
+        self.search_done.emit(self.rows, results)
+
+class LibrarySearchThread(QThread):
+    # Searches the reference library off the UI thread, CHUNK_ROWS queries at a time so progress can be shown
+    # and requestInterruption() cancels between chunks; rows are the DataFrame index labels searched
+    CHUNK_ROWS = 1000
+    progress = pyqtSignal(int, int)
+    search_done = pyqtSignal(object, object, int)
+    search_failed = pyqtSignal(object, str)
+    search_cancelled = pyqtSignal()
+
+    def __init__(self, rows, spectra, ri, library, options, parent=None):
+        super().__init__(parent)
+        self.rows = rows
+        self.spectra = spectra
+        self.ri = ri
+        self.library = library
+        self.options = options
+
+    def run(self):
+        tables = []
+        count = len(self.spectra)
+        try:
+            for start in range(0, count, self.CHUNK_ROWS):
+                if self.isInterruptionRequested():
+                    self.search_cancelled.emit()
+                    return
+                end = min(start + self.CHUNK_ROWS, count)
+                ri = None if self.ri is None else self.ri.iloc[start:end]
+                hits = self.library.search(self.spectra.iloc[start:end], ri=ri, **self.options)
+                hits['Query'] += start
+                tables.append(hits)
+                self.progress.emit(end, count)
+            hits = pd.concat(tables, ignore_index=True)
+            found = hits['Query'].nunique()
+            hits = library_hits_frame(hits, count, self.options['top_k'])
+        except Exception as e:
+            self.search_failed.emit(self.rows, str(e))
+            return
+        self.search_done.emit(self.rows, hits, found)
+
+class CEFImportThread(QThread):
+    # Runs combine_cef_results off the UI thread. file_loaded carries the compounds of every parsed file so
+    # the table can fill in while the import runs; requestInterruption() cancels between files and steps.
+    file_loaded = pyqtSignal(object, int, int, str)
+    stage_started = pyqtSignal(str)
+    import_done = pyqtSignal(object, object)
+    import_failed = pyqtSignal(str, object)
+    import_cancelled = pyqtSignal()
+
+    def __init__(self, directory, options, parent=None):
+        super().__init__(parent)
+        self.directory = directory
+        self.options = options
+
+    def run(self):
+        # errors collects (file, reason) for CEF files that could not be read; they are skipped
+        errors = []
+        try:
+            df = combine_cef_results(self.directory, **self.options,
+                                     on_file=lambda file_path, compounds, done, total: self.file_loaded.emit(compounds, done, total, file_path),
+                                     progress=self.stage_started.emit, cancelled=self.isInterruptionRequested, errors=errors)
+        except ImportCancelled:
+            self.import_cancelled.emit()
+            return
+        except Exception as e:
+            self.import_failed.emit(str(e), errors)
+            return
+        self.import_done.emit(df, errors)
+
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -148,8 +447,32 @@ class MainWindow(QMainWindow):
         self.setWindowIcon(QIcon('libracef_icon.jpg'))
         self.initUI()
         self.curent_csv_file = None
+        self.current_project_file = None
         self.nist_path = self.find_nist_ms_search_default_paths()
-        self.undo_stack = []
+        self.history = History()
+        # Index labels identify rows while searches run and edits are made; every loaded table and every
+        # new row takes labels no earlier row had, so late search results never land on the wrong row
+        self.next_row_label = 0
+        # Labels of rows edited by hand; appending CEF files never replaces their values
+        self.edited_row_labels = set()
+        self.cef_import_options = None
+        # NIST MS Search shares its import and result files, so jobs run one at a time
+        self.nist_jobs = []
+        self.nist_thread = None
+        self.nist_hit_count = 3
+        self.reference_library = None
+        self.library_search_thread = None
+        # Background CEF import: the thread, the table to restore on cancel or failure, and the parsed
+        # compounds waiting for the next preview update (the timer adds them to the table in one batch)
+        self.cef_import_thread = None
+        self.cef_import_previous = None
+        self.cef_import_pending = []
+        self.cef_preview_timer = QTimer(self)
+        self.cef_preview_timer.setInterval(250)
+        self.cef_preview_timer.timeout.connect(self._update_cef_preview)
+        # Search hits that arrive during an import; written to the previous table if it comes back
+        self.cef_import_pending_hits = []
+        self.library_search_options = {'top_k': 3, 'metric': 'composite', 'ri_window': None}
 
     def initUI(self):
         self.setWindowTitle('LibraCEF - Build MS library from CEFs')
@@ -185,16 +508,35 @@ class MainWindow(QMainWindow):
         self.setCentralWidget(container)
 
         # Add File menu
+        # Actions that edit, search or replace the table; disabled while a CEF import runs
+        self.table_actions = []
+
         menubar = self.menuBar()
         file_menu = menubar.addMenu('File')
+        open_project_action = QAction('Open Project', self)
+        open_project_action.triggered.connect(self.open_project)
+        file_menu.addAction(open_project_action)
+        self.table_actions.append(open_project_action)
+
         import_csv_action = QAction('Import CSV', self)
         import_csv_action.triggered.connect(self.import_csv)
         file_menu.addAction(import_csv_action)
+        self.table_actions.append(import_csv_action)
         
         import_cef_action = QAction('Import CEF results', self)
         import_cef_action.triggered.connect(self.import_cef)
         file_menu.addAction(import_cef_action)
 
+        import_mslibrary_action = QAction('Import MSLibrary XML', self)
+        import_mslibrary_action.triggered.connect(self.import_mslibrary)
+        file_menu.addAction(import_mslibrary_action)
+        self.table_actions.append(import_mslibrary_action)
+
+        append_cef_action = QAction('Append CEF files', self)
+        append_cef_action.triggered.connect(self.append_cef)
+        file_menu.addAction(append_cef_action)
+        self.table_actions.append(append_cef_action)
+
         # Add a separator
         file_menu.addSeparator()
 
@@ -203,11 +545,16 @@ class MainWindow(QMainWindow):
         file_menu.addAction(self.import_save_action)
         self.import_save_action.setEnabled(False)
                 
-        self.export_csv_action = QAction('Save as', self)
+        self.export_csv_action = QAction('Save as CSV', self)
         self.export_csv_action.triggered.connect(self.export_to_csv)
         file_menu.addAction(self.export_csv_action)
         self.export_csv_action.setEnabled(False)
 
+        self.save_project_action = QAction('Save Project As', self)
+        self.save_project_action.triggered.connect(self.save_project_as)
+        file_menu.addAction(self.save_project_action)
+        self.save_project_action.setEnabled(False)
+
         # Add Export menu
         export_menu = menubar.addMenu('Export')
         
@@ -219,6 +566,21 @@ class MainWindow(QMainWindow):
         export_mslibrary_action.triggered.connect(self.export_to_mslibrary)
         export_menu.addAction(export_mslibrary_action)
 
+        merge_library_action = QAction('Merge into Existing Library', self)
+        merge_library_action.triggered.connect(self.merge_into_library)
+        export_menu.addAction(merge_library_action)
+
+        # Add Search menu
+        search_menu = menubar.addMenu('Search')
+        load_library_action = QAction('Load Reference Library', self)
+        load_library_action.triggered.connect(self.load_reference_library)
+        search_menu.addAction(load_library_action)
+
+        search_table_action = QAction('Search Whole Table in Library', self)
+        search_table_action.triggered.connect(self.search_library_table)
+        search_menu.addAction(search_table_action)
+        self.table_actions.append(search_table_action)
+
         # Add Settings menu
         settings_menu = menubar.addMenu('Settings')
         set_bar_width_action = QAction('Set Bar Width', self)
@@ -230,6 +592,16 @@ class MainWindow(QMainWindow):
         set_nist_path_action.triggered.connect(self.set_nist_path)
         settings_menu.addAction(set_nist_path_action)
 
+        # Add action to clear the CEF parse cache
+        clear_cache_action = QAction('Clear CEF Parse Cache', self)
+        clear_cache_action.triggered.connect(self.clear_cache)
+        settings_menu.addAction(clear_cache_action)
+
+        # Add action to set the memory limit of the undo history
+        undo_memory_action = QAction('Set Undo Memory Limit', self)
+        undo_memory_action.triggered.connect(self.set_undo_memory_limit)
+        settings_menu.addAction(undo_memory_action)
+
         # Add Edit menu
         edit_menu = menubar.addMenu('Edit')
         ## Add an undo action
@@ -240,6 +612,12 @@ class MainWindow(QMainWindow):
         ## Add a shortcut to the undo action
         undo_action.setShortcut(QKeySequence.Undo)
 
+        redo_action = QAction("Redo", self)
+        redo_action.triggered.connect(self.redo_changes)
+        redo_action.setShortcut(QKeySequence.Redo)
+        edit_menu.addAction(redo_action)
+        self.table_actions.extend([undo_action, redo_action])
+
         table_menu = edit_menu.addMenu('Table')
         add_column_action = QAction('Add Column', self)
         add_column_action.triggered.connect(self.add_column)
@@ -257,6 +635,7 @@ class MainWindow(QMainWindow):
         sort_by_action = QAction('Sort By', self)
         sort_by_action.triggered.connect(self.sort_by_column)
         table_menu.addAction(sort_by_action)
+        self.table_actions.extend([add_column_action, remove_column_action, rearrange_column_action, sort_by_action])
 
         # Add Help menu
         help_menu = menubar.addMenu('Help')
@@ -272,8 +651,26 @@ class MainWindow(QMainWindow):
         self.status_label = QLabel("DataFrame is empty")
         self.statusBar.addWidget(self.status_label)
 
+        # Shown while a CEF import runs in the background
+        self.cancel_import_button = QPushButton("Cancel Import")
+        self.cancel_import_button.clicked.connect(self.cancel_cef_import)
+        self.statusBar.addPermanentWidget(self.cancel_import_button)
+        self.cancel_import_button.hide()
+
+        # Shown while a library search runs in the background
+        self.cancel_search_button = QPushButton("Cancel Search")
+        self.cancel_search_button.clicked.connect(self.cancel_library_search)
+        self.statusBar.addPermanentWidget(self.cancel_search_button)
+        self.cancel_search_button.hide()
+
     def save_csv(self):
-        if self.df is not None and self.curent_csv_file is not None:
+        # A loaded project is saved in the project format, anything else as CSV
+        if self.df is not None and self.current_project_file is not None:
+            try:
+                save_project(self.df, self.current_project_file)
+            except Exception as e:
+                QMessageBox.warning(self, "Save Error", f"Failed to save project: {str(e)}")
+        elif self.df is not None and self.curent_csv_file is not None:
             try:
                 self.df.to_csv(self.curent_csv_file, index=False)
                 # QMessageBox.information(self, "Save Successful", f"Data saved to {self.current_file}")
@@ -289,35 +686,241 @@ class MainWindow(QMainWindow):
         file_name, _ = QFileDialog.getOpenFileName(self, "Open CSV File", "", "CSV Files (*.csv)")
 
         if file_name:
-            self.df = pd.read_csv(file_name, keep_default_na=False)
+            self.df = self._label_new_table(pd.read_csv(file_name, keep_default_na=False))
+            # Parse all spectra once; malformed rows are kept as empty spectra and reported together
+            if 'MS_Peaks' in self.df.columns:
+                store, bad_rows = parse_ms_peaks_column(self.df['MS_Peaks'])
+                self.df['MS_Peaks'] = store.to_series(self.df.index)
+                if bad_rows:
+                    rows = ', '.join(str(row + 1) for row in bad_rows[:20]) + (', ...' if len(bad_rows) > 20 else '')
+                    QMessageBox.warning(self, "Import Warning",
+                                        f"{len(bad_rows)} row(s) have an invalid MS_Peaks value and were loaded with an empty spectrum:\n{rows}")
+            self.history.clear()
             self.update_table()
             # Update the window title with the file name
             self.curent_csv_file = file_name
+            self.current_project_file = None
             self.set_window_title(file_name)
             self.import_save_action.setEnabled(True)
             self.export_csv_action.setEnabled(True)
+            self.save_project_action.setEnabled(True)
 
     def import_cef(self):
+        if self.cef_import_thread is not None:
+            QMessageBox.warning(self, "Import Error", "A CEF import is already running.")
+            return
         dialog = CEFImportDialog(self)
         if dialog.exec_():
-            directory, rt_tolerance, group_similarity_threshold, exclude_elements = dialog.get_values()
-            if directory:
-                try:
-                    self.df = combine_cef_results(directory, rt_tolerance=rt_tolerance, 
-                                                group_similarity_threshold=group_similarity_threshold,
-                                                exclude_elements=exclude_elements)
-                    self.update_table()
-                    # self.import_save_action.setEnabled(True)
-                    self.export_csv_action.setEnabled(True)
-                except:
-                    QMessageBox.warning(self, "Import Error", "Error when import CEF files.")
-
+            directory, options = dialog.get_values()
+            if directory and os.path.isdir(directory):
+                self.start_cef_import(directory, options)
             else:
                 QMessageBox.warning(self, "Import Error", "Please select a valid directory.")
 
+    def start_cef_import(self, directory, options):
+        # The table shows the parsed compounds as they arrive; self.df is None until the import is done, and
+        # the actions that edit, search or replace the table are disabled meanwhile. The previous table
+        # (and its undo history) comes back on cancel or failure.
+        self.cef_import_previous = self.df
+        self.cef_import_pending = []
+        self.cef_import_pending_hits = []
+        self.df = None
+        self._set_table_actions_enabled(False)
+        self.table.setModel(CEFPreviewModel(CEF_PREVIEW_COLUMNS))
+        self.status_label.setText("Importing: 0 compounds parsed")
+        self.cef_preview_timer.start()
+        self.cef_import_thread = CEFImportThread(directory, options, self)
+        self.cef_import_thread.file_loaded.connect(self._cef_file_loaded)
+        self.cef_import_thread.stage_started.connect(self._cef_stage_started)
+        self.cef_import_thread.import_done.connect(lambda df, errors: self._cef_import_done(df, errors, options))
+        self.cef_import_thread.import_failed.connect(self._cef_import_failed)
+        self.cef_import_thread.import_cancelled.connect(self._cef_import_cancelled)
+        self.cef_import_thread.finished.connect(self._cef_import_finished)
+        self.cancel_import_button.setEnabled(True)
+        self.cancel_import_button.show()
+        self.statusBar.showMessage("Importing CEF files...")
+        self.cef_import_thread.start()
+
+    def cancel_cef_import(self):
+        if self.cef_import_thread is not None:
+            self.cef_import_thread.requestInterruption()
+            self.cancel_import_button.setEnabled(False)
+            self.statusBar.showMessage("Cancelling CEF import...")
+
+    def _cef_file_loaded(self, compounds, done, total, file_path):
+        self.statusBar.showMessage(f"Importing CEF files: {done}/{total} parsed ({os.path.basename(file_path)})")
+        if not compounds or self.cef_import_thread is None or self.cef_import_thread.isInterruptionRequested():
+            return
+        self.cef_import_pending.extend(compounds)
+
+    def _update_cef_preview(self):
+        model = self.table.model()
+        if not self.cef_import_pending or not isinstance(model, CEFPreviewModel):
+            return
+        rows = pd.DataFrame(self.cef_import_pending).reindex(columns=CEF_PREVIEW_COLUMNS)
+        self.cef_import_pending = []
+        self.status_label.setText(f"Importing: {model.append_rows(rows)} compounds parsed")
+
+    def _cef_stage_started(self, stage):
+        self.statusBar.showMessage(f"Importing CEF files: {stage}...")
+
+    def _cef_import_done(self, df, errors, options):
+        # The imported table replaces the previous one: its undo history and pending hits are dropped
+        self.df = self._label_new_table(df)
+        self.cef_import_options = options
+        self.history.clear()
+        self.cef_import_pending_hits = []
+        self.update_table()
+        # self.import_save_action.setEnabled(True)
+        self.export_csv_action.setEnabled(True)
+        self.save_project_action.setEnabled(True)
+        self.statusBar.showMessage(f"CEF import finished: {len(df)} compounds", 10000)
+        if errors:
+            self._show_cef_errors("Some CEF files could not be read and were skipped:", errors)
+
+    def _cef_import_failed(self, message, errors):
+        self._restore_cef_previous()
+        self.statusBar.showMessage("CEF import failed", 10000)
+        if errors:
+            self._show_cef_errors(f"Error when importing CEF files: {message}\n\nFiles that could not be read:", errors)
+        else:
+            QMessageBox.warning(self, "Import Error", f"Error when importing CEF files: {message}")
+
+    def _cef_import_cancelled(self):
+        self._restore_cef_previous()
+        self.statusBar.showMessage("CEF import cancelled", 10000)
+
+    def _restore_cef_previous(self):
+        self.df = self.cef_import_previous
+        if self.df is not None:
+            self.update_table()
+            for rows, hits in self.cef_import_pending_hits:
+                self._write_hit_columns(rows, hits)
+        else:
+            self.table.setModel(None)
+            self.status_label.setText("DataFrame is empty")
+        self.cef_import_pending_hits = []
+
+    def _show_cef_errors(self, text, errors):
+        lines = [f"{os.path.basename(file_path)}: {reason}" for file_path, reason in errors[:20]]
+        if len(errors) > 20:
+            lines.append(f"... and {len(errors) - 20} more")
+        QMessageBox.warning(self, "Import Warning", text + "\n" + "\n".join(lines))
+
+    def _cef_import_finished(self):
+        self.cef_import_thread.deleteLater()
+        self.cef_import_thread = None
+        self.cef_import_previous = None
+        self.cef_import_pending = []
+        self.cef_import_pending_hits = []
+        self.cef_preview_timer.stop()
+        self.cancel_import_button.hide()
+        self._set_table_actions_enabled(True)
+
+    def _set_table_actions_enabled(self, enabled):
+        for action in self.table_actions:
+            action.setEnabled(enabled)
+
+    def closeEvent(self, event):
+        # Stop a running CEF import or library search before the window (and the thread object) goes away
+        for thread in (self.cef_import_thread, self.library_search_thread):
+            if thread is not None:
+                thread.requestInterruption()
+                thread.wait()
+        super().closeEvent(event)
+
+    def import_mslibrary(self):
+        file_name, _ = QFileDialog.getOpenFileName(self, "Open MSLibrary XML", "", "MSLibrary XML Files (*.mslibrary.xml);;XML Files (*.xml)")
+        if not file_name:
+            return
+        try:
+            self.df = self._label_new_table(read_mslibrary_xml(file_name))
+        except Exception as e:
+            QMessageBox.warning(self, "Import Error", f"Error when importing MSLibrary XML: {str(e)}")
+            return
+        self.history.clear()
+        self.update_table()
+        self.curent_csv_file = None
+        self.current_project_file = None
+        self.set_window_title(file_name)
+        self.import_save_action.setEnabled(False)
+        self.export_csv_action.setEnabled(True)
+        self.save_project_action.setEnabled(True)
+
+    def open_project(self):
+        file_name, _ = QFileDialog.getOpenFileName(self, "Open Project", "", f"LibraCEF Projects (*{PROJECT_EXTENSION})")
+        if not file_name:
+            return
+        try:
+            # Read into memory: a memory-mapped project could not be overwritten by Save on Windows
+            self.df = self._label_new_table(load_project(file_name, mmap=False))
+        except Exception as e:
+            QMessageBox.warning(self, "Open Error", f"Error when opening project: {str(e)}")
+            return
+        self.history.clear()
+        self.update_table()
+        self.curent_csv_file = None
+        self.current_project_file = file_name
+        self.set_window_title(file_name)
+        self.import_save_action.setEnabled(True)
+        self.export_csv_action.setEnabled(True)
+        self.save_project_action.setEnabled(True)
+
+    def save_project_as(self):
+        if self.df is None:
+            QMessageBox.warning(self, "Save Error", "No data to save.")
+            return
+
+        file_name, _ = QFileDialog.getSaveFileName(self, "Save Project", "", f"LibraCEF Projects (*{PROJECT_EXTENSION})")
+        if file_name:
+            if not file_name.endswith(PROJECT_EXTENSION):
+                file_name += PROJECT_EXTENSION
+            try:
+                save_project(self.df, file_name)
+            except Exception as e:
+                QMessageBox.warning(self, "Save Error", f"Failed to save project: {str(e)}")
+                return
+            self.curent_csv_file = None
+            self.current_project_file = file_name
+            self.set_window_title(file_name)
+            self.import_save_action.setEnabled(True)
+
+    def append_cef(self):
+        if not self._check_df_exists():
+            return
+        file_names, _ = QFileDialog.getOpenFileNames(self, "Append CEF Files", "", "CEF Files (*.cef)")
+        if not file_names:
+            return
+
+        # Use the settings of the last CEF import, or the dialog defaults
+        options = self.cef_import_options or CEFImportDialog(self).get_values()[1]
+        edited_rows = np.flatnonzero(self.df.index.isin(list(self.edited_row_labels)))
+        try:
+            df, summary = append_cef_results(self.df, file_names, edited_rows=edited_rows, **options)
+        except Exception as e:
+            QMessageBox.warning(self, "Import Error", f"Error when appending CEF files: {str(e)}")
+            return
+
+        if summary['added'] or summary['updated']:
+            # The existing rows keep their labels (and their order), the appended ones get new labels
+            added = np.zeros(len(df), dtype=bool)
+            added[summary['positions']] = True
+            labels = np.empty(len(df), dtype=np.int64)
+            labels[~added] = self.df.index
+            labels[added] = self._new_row_labels(summary['added'])
+            df.index = labels
+            command = insert_command(self.df, df, summary['positions'], f"Append CEF files ({summary['added']} added, {summary['updated']} updated)")
+            self.df = df
+            self.history.push(command)
+            self.show_command_changes(command)
+        QMessageBox.information(self, "Append CEF files",
+                                f"Added {summary['added']} compound(s), updated {summary['updated']} with a larger peak, "
+                                f"skipped {summary['duplicates']} duplicate(s).")
+
     def update_table(self):
         if self.df is not None:
-            model = PandasModel(self.df)
+            model = PandasModel(self.df, self.history)
+            model.cell_edited.connect(self._mark_row_edited)
             self.table.setModel(model)
             # show the number of rows and columns in the status bar
             rows, cols = self.df.shape
@@ -327,16 +930,25 @@ class MainWindow(QMainWindow):
         context = QMenu(self)
         # show_spectrum_action = context.addAction("Show Spectrum")
         search_nist_action = context.addAction("Search NIST")
+        search_nist_selected_action = context.addAction("Search NIST (Selected Rows)")
+        search_library_action = context.addAction("Search Library (Selected Rows)")
         insert_row_action = context.addAction("Insert Row")
         delete_rows_action = context.addAction("Delete Selected Rows")
+        move_rows_action = context.addAction("Move Selected Rows...")
         modify_ms_spectrum_action = context.addAction("Modify MS spectrum")       
         action = context.exec_(self.table.mapToGlobal(pos))
         
         index = self.table.indexAt(pos)
         if action == delete_rows_action:
             self.delete_selected_rows()
+        elif action == move_rows_action:
+            self.move_selected_rows()
         elif action == search_nist_action:            
             self.search_nist(index.row())
+        elif action == search_nist_selected_action:
+            self.search_nist_selected()
+        elif action == search_library_action:
+            self.search_library_selected()
         elif action == insert_row_action:
             self.insert_row(index.row())
         elif action == modify_ms_spectrum_action:
@@ -370,21 +982,18 @@ class MainWindow(QMainWindow):
         if self.df is None:
             return
         label_offset = 10
-        ms_peaks = self.df.iloc[row]['MS_Peaks']
-        
-        # Check if MS_Peaks is a string and convert it to a list if necessary
-        if isinstance(ms_peaks, str):
-            try:
-                ms_peaks = ast.literal_eval(ms_peaks)
-            except:
-                QMessageBox.warning(self, "Plot Error", "Unable to parse MS_Peaks data.")
-                return
+        # MS_Peaks may be a packed Spectrum, a list of tuples or its text form (CSV)
+        try:
+            ms_peaks = as_spectrum(self.df.iloc[row]['MS_Peaks'])
+        except (ValueError, SyntaxError, TypeError):
+            QMessageBox.warning(self, "Plot Error", "Unable to parse MS_Peaks data.")
+            return
         
-        if not isinstance(ms_peaks, list):
+        if len(ms_peaks) == 0:
             QMessageBox.warning(self, "Plot Error", "MS_Peaks data is not in the expected format.")
             return
         
-        mz, intensity = zip(*ms_peaks)
+        mz, intensity = ms_peaks.mz.astype(float), ms_peaks.intensity
         
         self.canvas.axes.clear()
         
@@ -399,27 +1008,48 @@ class MainWindow(QMainWindow):
         self.canvas.axes.set_ylim(0, 1200)
         
         # Add x value (m/z) on top of each bar
-        for mz, intensity in zip(mz, intensity):
+        for mz, intensity in zip(mz.tolist(), intensity.tolist()):
             self.canvas.axes.text(mz + bar_width/2., intensity + label_offset, f'{round(mz)}', ha='center', va='bottom', rotation=90, fontsize=8)      
         self.canvas.draw()
 
+    def apply_command(self, command):
+        # Apply a history_util command to the table and record it for undo
+        self.df = command.redo(self.df)
+        self.history.push(command)
+        self.show_command_changes(command)
+
+    def show_command_changes(self, command, undo=False):
+        # Row edits are passed to the current model; column changes rebuild it
+        model = self.table.model()
+        changes = command.changes(undo)
+        if isinstance(model, PandasModel) and changes is not None:
+            model.apply_changes(self.df, changes)
+            rows, cols = self.df.shape
+            self.status_label.setText(f"DataFrame updated: {rows} rows, {cols} columns")
+        else:
+            self.update_table()
+
+    def selected_rows(self):
+        # Positions of the rows with a selected cell, ascending; read from the selection ranges, not per cell
+        ranges = self.table.selectionModel().selection() if self.table.selectionModel() is not None else []
+        rows = [np.arange(selection_range.top(), selection_range.bottom() + 1) for selection_range in ranges]
+        return np.unique(np.concatenate(rows)).tolist() if rows else []
+
     def insert_row(self, selected_row):
-        # Append Undo stack
-        undo_state = self.df.copy()
-        self.undo_stack.append(undo_state)
-        
-        new_row =  self.df.iloc[selected_row].copy()
+        if self.df is None or selected_row < 0:
+            return
+        new_row = self.df.iloc[[selected_row]].copy()
         new_row['Chemical_Name'] = "New Compound"
-        self.df = pd.concat([self.df.iloc[:selected_row], pd.DataFrame([new_row]), self.df.iloc[selected_row:]]).reset_index(drop=True)
-        self.update_table()
-
+        new_row.index = self._new_row_labels(1)
+        self.edited_row_labels.update(new_row.index)
+        self.apply_command(InsertRows([selected_row], new_row, "Insert row"))
 
     def delete_selected_rows(self):
         if self.df is None:
             return
 
-        selected_rows = sorted(set(index.row() for index in self.table.selectedIndexes()), reverse=True)
-        
+        selected_rows = self.selected_rows()
+
         if not selected_rows:
             QMessageBox.warning(self, "Delete Error", "No rows selected.")
             return
@@ -429,31 +1059,200 @@ class MainWindow(QMainWindow):
                                      QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
 
         if reply == QMessageBox.Yes:
-            undo_state = self.df.copy()
-            self.undo_stack.append(undo_state)
-            for row in selected_rows:
-                self.df = self.df.drop(self.df.index[row])
-            self.df = self.df.reset_index(drop=True)
-            self.update_table()
+            self.apply_command(DeleteRows(selected_rows, self.df.iloc[selected_rows], f"Delete {len(selected_rows)} row(s)"))
+
+    def move_selected_rows(self):
+        # Move the selected rows (keeping their order) in front of the given row number
+        if self.df is None:
+            return
+        selected_rows = self.selected_rows()
+        if not selected_rows:
+            QMessageBox.warning(self, "Move Error", "No rows selected.")
+            return
+        target, ok = QInputDialog.getInt(self, "Move Selected Rows",
+                                         f"Move {len(selected_rows)} row(s) in front of row (1-{len(self.df) + 1}):",
+                                         selected_rows[0] + 1, 1, len(self.df) + 1)
+        if ok:
+            order = move_order(len(self.df), selected_rows, target - 1)
+            self.apply_command(ReorderRows(order, f"Move {len(selected_rows)} row(s)"))
 
     def undo_changes(self):
-        if self.undo_stack:
-            self.df = self.undo_stack.pop()
-            self.update_table()
+        if self.df is None:
+            return
+        self.df, command = self.history.undo(self.df)
+        if command is not None:
+            self.show_command_changes(command, undo=True)
+            self.statusBar.showMessage(f"Undo: {command.text}", 5000)
+
+    def redo_changes(self):
+        if self.df is None:
+            return
+        self.df, command = self.history.redo(self.df)
+        if command is not None:
+            self.show_command_changes(command)
+            self.statusBar.showMessage(f"Redo: {command.text}", 5000)
+
+    def set_undo_memory_limit(self):
+        limit, ok = QInputDialog.getInt(self, "Set Undo Memory Limit", "Memory for the undo history (MB):",
+                                        self.history.memory_budget // (1024 * 1024), 1, 65536)
+        if ok:
+            self.history.set_memory_budget(limit * 1024 * 1024)
 
     def search_nist(self, row):
+        if self.df is None or row < 0:
+            return
+        self.queue_nist_search([row])
+
+    def search_nist_selected(self):
+        # All selected rows go into one import file and a single NIST MS Search run
         if self.df is None:
             return
-        if self.nist_path:
-            current_path = Path(os.path.abspath(os.getcwd()))
-            spec_data_path = current_path / 'spectrum.txt' # add spectrum file to the path
-            df_row = self.df.iloc[row]
-            
-            search_nist_for_spectrum(df_row, spec_data_path=str(spec_data_path), nist_path=str(self.nist_path))
-        else:            
+        selected_rows = self.selected_rows()
+        if not selected_rows:
+            QMessageBox.warning(self, "Search Error", "No rows selected.")
+            return
+        self.queue_nist_search(selected_rows)
+
+    def queue_nist_search(self, rows):
+        if not self.nist_path:
             QMessageBox.warning(self, 'NIST MS Search path not defined', 
                              'Please define the NIST MS Search path in the Settings before searching.')
-            
+            return
+        # Rows are tracked by index label so results land on the right rows after edits
+        self.nist_jobs.append((self.df.index[rows], self.df.iloc[rows].copy()))
+        self._start_next_nist_job()
+
+    def _start_next_nist_job(self):
+        if self.nist_thread is not None:
+            self._show_nist_status()
+            return
+        if not self.nist_jobs:
+            return
+        rows, df = self.nist_jobs.pop(0)
+        spec_data_path = Path(os.path.abspath(os.getcwd())) / 'spectra.txt'
+        self.nist_thread = NistSearchThread(rows, df, str(spec_data_path), str(self.nist_path), self)
+        self.nist_thread.search_done.connect(self.apply_nist_results)
+        self.nist_thread.search_failed.connect(self.nist_search_failed)
+        self.nist_thread.finished.connect(self._nist_job_finished)
+        self.nist_thread.start()
+        self._show_nist_status()
+
+    def _show_nist_status(self):
+        queued = sum(len(rows) for rows, _ in self.nist_jobs)
+        message = f"NIST search running: {len(self.nist_thread.rows)} spectra"
+        if queued:
+            message += f", {queued} queued in {len(self.nist_jobs)} job(s)"
+        self.statusBar.showMessage(message)
+
+    def _nist_job_finished(self):
+        self.nist_thread.deleteLater()
+        self.nist_thread = None
+        self._start_next_nist_job()
+
+    def apply_nist_results(self, rows, results):
+        # Write the top hits into the NIST_Hit_<i>_<field> columns of the searched rows still in the table
+        hits = nist_hits_frame(results, len(rows), self.nist_hit_count)
+        self._write_hit_columns(rows, hits)
+        found = sum(1 for result in results if result['hits'])
+        self.statusBar.showMessage(f"NIST search finished: {found} of {len(hits)} spectra with hits", 10000)
+
+    def _write_hit_columns(self, rows, hits):
+        # Copy search hits (one row per searched index label) into the table, adding missing columns
+        if self.df is None:
+            if self.cef_import_thread is not None:
+                self.cef_import_pending_hits.append((rows, hits))
+            return
+        hits.index = rows
+        rows = rows[rows.isin(self.df.index)]
+        if not len(rows):
+            return
+        positions = self.df.index.get_indexer(rows)
+        added_columns = {column: np.nan if hits[column].dtype.kind == 'f' else None for column in hits.columns if column not in self.df.columns}
+        old_values = capture_values(self.df, positions, [column for column in hits.columns if column in self.df.columns])
+        new_values = {column: hits.loc[rows, column].to_numpy() for column in hits.columns}
+        self.apply_command(SetValues(positions, old_values, new_values, added_columns, "Write search hits"))
+
+    def nist_search_failed(self, rows, message):
+        self.statusBar.showMessage("NIST search failed", 10000)
+        QMessageBox.warning(self, "Search Error", f"Error running NIST MS Search: {message}")
+
+    def load_reference_library(self):
+        library_filter = "Spectral Libraries (*.mslibrary.xml *.xml *.msp *.jdx *.jdx.gz *.csv)"
+        file_name, _ = QFileDialog.getOpenFileName(self, "Load Reference Library", "", library_filter)
+        if not file_name:
+            return
+        try:
+            try:
+                self.reference_library = load_reference_library(file_name, index=True)
+            except OSError:
+                # The peak index lives next to the library; search without it when that folder is read-only
+                self.reference_library = load_reference_library(file_name)
+        except Exception as e:
+            QMessageBox.warning(self, "Library Error", f"Error when loading the reference library: {str(e)}")
+            return
+        self.statusBar.showMessage(f"Reference library loaded: {len(self.reference_library)} spectra from {os.path.basename(file_name)}", 10000)
+
+    def search_library_selected(self):
+        if self.df is None:
+            return
+        selected_rows = self.selected_rows()
+        if not selected_rows:
+            QMessageBox.warning(self, "Search Error", "No rows selected.")
+            return
+        self.search_library(selected_rows)
+
+    def search_library_table(self):
+        if not self._check_df_exists():
+            return
+        self.search_library(list(range(len(self.df))))
+
+    def search_library(self, rows):
+        # Score the rows against the loaded reference library in the background; the top hits are written
+        # into Library_Hit_<i>_* columns of the searched rows still in the table when the search finishes
+        if self.reference_library is None:
+            QMessageBox.warning(self, "Search Error", "Please load a reference library first (Search->Load Reference Library).")
+            return
+        if self.library_search_thread is not None:
+            QMessageBox.warning(self, "Search Error", "A library search is already running.")
+            return
+        if not len(rows):
+            return
+        df = self.df.iloc[rows]
+        ri = df['RI'].copy() if 'RI' in df.columns else None
+        self.library_search_thread = LibrarySearchThread(df.index, df['MS_Peaks'].copy(), ri, self.reference_library,
+                                                         dict(self.library_search_options), self)
+        self.library_search_thread.progress.connect(self._library_search_progress)
+        self.library_search_thread.search_done.connect(self.apply_library_results)
+        self.library_search_thread.search_failed.connect(self.library_search_failed)
+        self.library_search_thread.search_cancelled.connect(lambda: self.statusBar.showMessage("Library search cancelled", 10000))
+        self.library_search_thread.finished.connect(self._library_search_finished)
+        self.cancel_search_button.setEnabled(True)
+        self.cancel_search_button.show()
+        self.statusBar.showMessage(f"Library search running: 0/{len(rows)} spectra")
+        self.library_search_thread.start()
+
+    def cancel_library_search(self):
+        if self.library_search_thread is not None:
+            self.library_search_thread.requestInterruption()
+            self.cancel_search_button.setEnabled(False)
+            self.statusBar.showMessage("Cancelling library search...")
+
+    def _library_search_progress(self, done, total):
+        if not self.library_search_thread.isInterruptionRequested():
+            self.statusBar.showMessage(f"Library search running: {done}/{total} spectra")
+
+    def apply_library_results(self, rows, hits, found):
+        self._write_hit_columns(rows, hits)
+        self.statusBar.showMessage(f"Library search finished: {found} of {len(rows)} spectra with hits", 10000)
+
+    def library_search_failed(self, rows, message):
+        self.statusBar.showMessage("Library search failed", 10000)
+        QMessageBox.warning(self, "Search Error", f"Error when searching the reference library: {message}")
+
+    def _library_search_finished(self):
+        self.library_search_thread.deleteLater()
+        self.library_search_thread = None
+        self.cancel_search_button.hide()
 
     def export_to_csv(self):
         if self.df is None:
@@ -464,6 +1263,7 @@ class MainWindow(QMainWindow):
         if file_name:
             self.df.to_csv(file_name, index=False)
             self.curent_csv_file = file_name
+            self.current_project_file = None
             self.set_window_title(file_name)
             self.import_save_action.setEnabled(True)
             QMessageBox.information(self, "Export Successful", f"Data exported to {file_name}")
@@ -473,12 +1273,9 @@ class MainWindow(QMainWindow):
             QMessageBox.warning(self, "Export Error", "No data to export.")
             return
 
-        file_name, _ = QFileDialog.getSaveFileName(self, "Save JCAMP Library", "", "JCAMP Files (*.jdx)")
+        file_name, _ = QFileDialog.getSaveFileName(self, "Save JCAMP Library", "", "JCAMP Files (*.jdx);;Compressed JCAMP Files (*.jdx.gz)")
         if file_name:
-            jcamp_library = create_jcamp_library(self.df)
-            with open(file_name, 'w') as f:
-                for entry in jcamp_library:
-                    f.write(entry + '\n\n')
+            write_jcamp_library(self.df, file_name)
             QMessageBox.information(self, "Export Successful", f"JCAMP library exported to {file_name}")
     def export_to_mslibrary(self):
         if self.df is None:
@@ -489,9 +1286,30 @@ class MainWindow(QMainWindow):
         if file_name:
             if not file_name.endswith('.mslibrary.xml'):
                 file_name = os.path.splitext(file_name)[0] + '.mslibrary.xml'
-            mslibrary_xml = create_mslibrary_xml(self.df, file_name)
-            with open(file_name, 'w') as f:
-                f.write(mslibrary_xml)
+            # Compound IDs are numbered from the index, so number the rows in table order
+            write_mslibrary_xml(self.df.reset_index(drop=True), file_name)
+
+    def merge_into_library(self):
+        if self.df is None:
+            QMessageBox.warning(self, "Export Error", "No data to export.")
+            return
+
+        library_filter = "Library Files (*.mslibrary.xml *.xml *.csv)"
+        master_path, _ = QFileDialog.getOpenFileName(self, "Select Master Library", "", library_filter)
+        if not master_path:
+            return
+        output_path, _ = QFileDialog.getSaveFileName(self, "Save Merged Library", master_path, library_filter)
+        if not output_path:
+            return
+
+        try:
+            merged, report = merge_library_files(master_path, self.df, output_path)
+        except Exception as e:
+            QMessageBox.warning(self, "Merge Error", f"Error when merging into the library: {str(e)}")
+            return
+        QMessageBox.information(self, "Merge Successful",
+                                f"Merged library written to {output_path}\n\n{len(merged)} compounds: {merge_summary(report)}.\n"
+                                f"The change report is saved next to the merged library.")
 
     def set_bar_width(self):
         width, ok = QInputDialog.getDouble(self, "Set Bar Width", 
@@ -519,13 +1337,19 @@ class MainWindow(QMainWindow):
             else:
                 QMessageBox.warning(self, "NIST MS Search Path Error", "Cannot find nistms$.exe")
 
+    def clear_cache(self):
+        removed = clear_cef_cache(default_cache_dir())
+        QMessageBox.information(self, "Clear Cache", f"Removed {removed} cached CEF file(s).")
+
     def add_column(self):
         if not self._check_df_exists():
             return
         column_name, ok = QInputDialog.getText(self, "Add Column", "Enter new column name:")
         if ok and column_name:
-            self.df[column_name] = None
-            self.update_table()
+            if column_name in self.df.columns:
+                QMessageBox.warning(self, "Add Column", f"Column {column_name} already exists.")
+                return
+            self.apply_command(AddColumn(column_name))
 
     def remove_column(self):
         if not self._check_df_exists():
@@ -533,8 +1357,7 @@ class MainWindow(QMainWindow):
         column_names = list(self.df.columns)
         column_name, ok = QInputDialog.getItem(self, "Remove Column", "Select a column to remove:", column_names, 0, False)
         if ok and column_name:
-            self.df = self.df.drop(columns=[column_name])
-            self.update_table()
+            self.apply_command(RemoveColumn(self.df, column_name))
 
     def rearrange_columns(self):
         if self.df is not None:
@@ -578,8 +1401,8 @@ class MainWindow(QMainWindow):
                 new_column_order = []
                 for row in range(column_list.count()):
                     new_column_order.append(column_list.item(row).text())
-                self.df = self.df[new_column_order]
-                self.update_table()
+                if new_column_order != list(self.df.columns):
+                    self.apply_command(ReorderColumns(self.df.columns, new_column_order))
                 rearrange_dialog.close()
 
             horizontal_layout1 = QHBoxLayout()
@@ -608,31 +1431,34 @@ class MainWindow(QMainWindow):
             if dialog.exec_():
                 column_name, order = dialog.get_values()
                 
-                self.df= self.df.sort_values(by=column_name, ascending=(order == 'Ascending'))
-                self.update_table()
+                # Row positions in sorted order, the same order sort_values gives.
+                # Spectra have no order of their own and are sorted by their number of peaks.
+                values = self.df[column_name].reset_index(drop=True)
+                key = (lambda series: series.map(lambda peaks: len(as_spectrum(peaks)))) if column_name == 'MS_Peaks' else None
+                try:
+                    order = values.sort_values(ascending=(order == 'Ascending'), key=key).index.to_numpy()
+                except (TypeError, ValueError) as e:
+                    QMessageBox.warning(self, "Sort Error", f"Unable to sort by {column_name}: {str(e)}")
+                    return
+                self.apply_command(ReorderRows(order, f"Sort by {column_name}"))
                 # # Example: show the number of rows and columns in the status bar
                 # rows, cols = self.df.shape
                 # self.status_label.setText(f"DataFrame updated: {rows} rows, {cols} columns")
 
 
     def modify_ms_spectrum(self, selected_row):
-        
+        if self.df is None:
+            return
         if selected_row < 0:
             QMessageBox.warning(self, "No Selection", "Please select a row to modify.")
             return
 
-        ms_peaks = self.df.at[selected_row, 'MS_Peaks']
-
-        # Check if MS_Peaks is a string and convert it to a list if necessary 
-        if isinstance(ms_peaks, str):
-            try:
-                ms_peaks = ast.literal_eval(ms_peaks)
-            except:
-                QMessageBox.warning(self, "Plot Error", "Unable to parse MS_Peaks data.")
-                return     
-               
-        if not isinstance(ms_peaks, list):
-            ms_peaks = []
+        # Check if MS_Peaks is a string or packed spectrum and convert it to a list
+        try:
+            ms_peaks = as_spectrum(self.df['MS_Peaks'].iat[selected_row]).peak_texts()
+        except (ValueError, SyntaxError, TypeError):
+            QMessageBox.warning(self, "Plot Error", "Unable to parse MS_Peaks data.")
+            return     
 
         dialog = QDialog(self)
         dialog.setWindowTitle("Modify MS Spectrum")
@@ -644,8 +1470,8 @@ class MainWindow(QMainWindow):
         table.setRowCount(len(ms_peaks))
 
         for i, peak in enumerate(ms_peaks):
-            table.setItem(i, 0, QTableWidgetItem(str(peak[0])))
-            table.setItem(i, 1, QTableWidgetItem(str(peak[1])))
+            table.setItem(i, 0, QTableWidgetItem(peak[0]))
+            table.setItem(i, 1, QTableWidgetItem(peak[1]))
 
         add_button = QPushButton("Add Row", dialog)
         remove_button = QPushButton("Remove Row", dialog)
@@ -667,7 +1493,11 @@ class MainWindow(QMainWindow):
                     mz = float(mz_item.text())
                     intensity = float(intensity_item.text())
                     new_ms_peaks.append((mz, intensity))
-            self.df.at[selected_row, 'MS_Peaks'] = new_ms_peaks
+            new_values = np.empty(1, dtype=object)
+            new_values[0] = Spectrum.from_peaks(new_ms_peaks)
+            old_values = capture_values(self.df, [selected_row], ['MS_Peaks'])
+            self._mark_row_edited(selected_row)
+            self.apply_command(SetValues([selected_row], old_values, {'MS_Peaks': new_values}, text="Modify MS spectrum"))
             self.plot_spectrum(selected_row)
             dialog.accept()
 
@@ -708,6 +1538,18 @@ class MainWindow(QMainWindow):
                     path32_value = line.split("=", 1)[1].strip()
                     
         return path32_value
+    def _new_row_labels(self, count):
+        labels = pd.RangeIndex(self.next_row_label, self.next_row_label + count)
+        self.next_row_label += count
+        return labels
+
+    def _mark_row_edited(self, row):
+        self.edited_row_labels.add(self.df.index[row])
+
+    def _label_new_table(self, df):
+        df.index = self._new_row_labels(len(df))
+        return df
+
     def _check_df_exists(self):
         if self.df is None:
             QMessageBox.warning(self, "Error", "Please import or create a data frame first.")
@@ -715,6 +1557,8 @@ class MainWindow(QMainWindow):
         return True
 
 def main():
+    # Required for the CEF import process pool in the frozen (PyInstaller) build
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     main_window = MainWindow()
     main_window.show()
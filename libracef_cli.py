@@ -0,0 +1,100 @@
+import sys
+import os
+import argparse
+import multiprocessing
+import time
+from cef_util import combine_cef_results
+from cache_util import default_cache_dir
+from export_util import write_mslibrary_xml, write_jcamp_library
+from library_util import merge_library_files, merge_summary
+from project_util import save_project, PROJECT_EXTENSION
+
+# Headless batch pipeline: CEF directory -> combine/filter/group -> MSLibrary XML, JCAMP and/or CSV.
+# Deliberately imports neither PyQt5 nor matplotlib so it can run on servers and in scheduled jobs.
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='libracef_cli', description='Build MS libraries from MassHunter Unknowns CEF files without the GUI.')
+    parser.add_argument('directory', help='Directory containing the .cef files')
+
+    group = parser.add_argument_group('import settings')
+    group.add_argument('--rt-tolerance', type=float, default=0.1, help='RT difference (min) to merge the same identification (default: 0.1)')
+    group.add_argument('--similarity-threshold', type=float, default=0.9, help='Group similarity threshold (default: 0.9)')
+    group.add_argument('--exclude', default='Si', help="Comma separated elements to exclude, e.g. 'Si,Cl' (default: Si; '' for none)")
+    group.add_argument('--max-rt-gap', type=float, default=None, help='Split groups when adjacent peaks are further apart in RT')
+    group.add_argument('--grouping', choices=['adjacent', 'cluster'], default='adjacent', help='Grouping mode (default: adjacent)')
+    group.add_argument('--rt-window', type=float, default=0.5, help='RT window for cluster grouping (default: 0.5)')
+    group.add_argument('--ri-window', type=float, default=None, help='RI window for cluster grouping')
+    group.add_argument('--workers', type=int, default=1, help='Number of processes used to parse the CEF files (default: 1)')
+    group.add_argument('--cache-dir', default=None, help=f'CEF parse cache directory (default: {default_cache_dir()})')
+    group.add_argument('--no-cache', action='store_true', help='Do not use the CEF parse cache')
+
+    group = parser.add_argument_group('outputs (any combination)')
+    group.add_argument('--mslibrary', metavar='PATH', help='Write an Agilent MSLibrary XML file')
+    group.add_argument('--jcamp', metavar='PATH', help='Write a JCAMP library')
+    group.add_argument('--csv', metavar='PATH', help='Write the combined table as CSV')
+    group.add_argument('--project', metavar='PATH', help=f'Write a LibraCEF project file ({PROJECT_EXTENSION})')
+
+    group = parser.add_argument_group('library merge')
+    group.add_argument('--merge-into', metavar='LIBRARY', help='Existing library (MSLibrary XML or CSV) to merge the results into')
+    group.add_argument('--merge-output', metavar='PATH', help='Merged library to write (.xml or .csv, default: overwrite LIBRARY)')
+    group.add_argument('--merge-report', metavar='PATH', help='CSV change report (default: next to the merged library)')
+    group.add_argument('--merge-similarity', type=float, default=0.7, help='Minimum spectral similarity for a library match (default: 0.7)')
+    group.add_argument('--merge-ri-tolerance', type=float, default=None, help='RI window for a library match')
+    group.add_argument('--merge-update-unknown-area', action='store_true',
+                       help='Also replace matched library entries without a known MaxArea (e.g. from MSLibrary XML)')
+
+    parser.add_argument('-q', '--quiet', action='store_true', help='Only print errors')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    log = (lambda message: None) if args.quiet else (lambda message: print(message, flush=True))
+
+    if not os.path.isdir(args.directory):
+        print(f"Error: {args.directory} is not a directory", file=sys.stderr)
+        return 2
+
+    exclude_elements = [element.strip() for element in args.exclude.split(',') if element.strip()]
+    cache_dir = None if args.no_cache else (args.cache_dir or default_cache_dir())
+
+    start = time.time()
+    df = combine_cef_results(args.directory, rt_tolerance=args.rt_tolerance,
+                             group_similarity_threshold=args.similarity_threshold,
+                             exclude_elements=exclude_elements, workers=args.workers, cache_dir=cache_dir,
+                             max_rt_gap=args.max_rt_gap, grouping=args.grouping,
+                             rt_window=args.rt_window, ri_window=args.ri_window)
+    log(f"Combined {len(df)} compounds in {df['group'].nunique() if len(df) else 0} groups ({time.time() - start:.1f} s)")
+
+    if args.csv:
+        df.to_csv(args.csv, index=False)
+        log(f"CSV written to {args.csv}")
+    if args.project:
+        file_name = args.project
+        if not file_name.endswith(PROJECT_EXTENSION):
+            file_name += PROJECT_EXTENSION
+        save_project(df, file_name)
+        log(f"Project written to {file_name}")
+    if args.jcamp:
+        write_jcamp_library(df, args.jcamp)
+        log(f"JCAMP library written to {args.jcamp}")
+    if args.mslibrary:
+        file_name = args.mslibrary
+        if not file_name.endswith('.mslibrary.xml'):
+            file_name = os.path.splitext(file_name)[0] + '.mslibrary.xml'
+        write_mslibrary_xml(df, file_name)
+        log(f"MSLibrary XML written to {file_name}")
+    if args.merge_into:
+        output_path = args.merge_output or args.merge_into
+        merged, report = merge_library_files(args.merge_into, df, output_path, report_path=args.merge_report,
+                                             rt_tolerance=args.rt_tolerance, ri_tolerance=args.merge_ri_tolerance,
+                                             similarity_threshold=args.merge_similarity, update_unknown_area=args.merge_update_unknown_area)
+        log(f"Merged library written to {output_path}: {len(merged)} compounds ({merge_summary(report)})")
+    return 0
+
+
+if __name__ == '__main__':
+    # Required for the CEF import process pool in frozen builds
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,262 @@
+import os
+import base64
+import xml.etree.ElementTree as ET
+import numpy as np
+import pandas as pd
+from spectrum_util import SpectrumStore, previous_next_similarity, pair_similarity, pack_ms_peaks
+from cef_util import COLUMN_ORDER, PEAK_SUFFIX, assign_groups
+from export_util import write_mslibrary_xml
+
+# Reading existing libraries back into the combine_cef_results table layout, and merging new
+# results into them.
+
+
+def read_mslibrary_xml(file_path, group_similarity_threshold=0.9):
+    # Stream-parse an Agilent MSLibrary XML (LibraryDataSet) file. Spectra are decoded straight from
+    # base64 into one buffer per array, so no per-peak Python objects are created.
+    # Compounds and spectra are matched by CompoundID; elements without one are matched by their ordinal
+    # (the n-th Compound with the n-th Spectrum)
+    compounds = {}
+    spectra = {}
+    compound_count = spectrum_count = 0
+    namespace = None
+    parents = []
+    for event, element in ET.iterparse(file_path, events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            if namespace is None:
+                # Normally Quantitation.LibraryDatabase, but accept files written without it
+                tag = element.tag
+                namespace = tag[:tag.index('}') + 1] if tag.startswith('{') else ''
+                compound_tag, spectrum_tag, prefix = namespace + 'Compound', namespace + 'Spectrum', len(namespace)
+            continue
+
+        parents.pop()
+        tag = element.tag
+        if tag == compound_tag:
+            fields = {child.tag[prefix:]: child.text for child in element}
+            compounds[fields.get('CompoundID') or compound_count] = fields
+            compound_count += 1
+        elif tag == spectrum_tag:
+            fields = {child.tag[prefix:]: child.text for child in element}
+            # Keep the first spectrum of every compound
+            spectra.setdefault(fields.get('CompoundID') or spectrum_count, (fields.get('MzValues') or '', fields.get('AbundanceValues') or ''))
+            spectrum_count += 1
+        else:
+            continue
+        # Free the processed element and detach it from its parent, so no empty elements pile up
+        element.clear()
+        if parents:
+            parents[-1].remove(element)
+
+    mz_buffers = []
+    abundance_buffers = []
+    lengths = []
+    for compound_id in compounds:
+        mz_text, abundance_text = spectra.get(compound_id, ('', ''))
+        mz_bytes = base64.b64decode(mz_text)
+        abundance_bytes = base64.b64decode(abundance_text)
+        if len(mz_bytes) != len(abundance_bytes):
+            raise ValueError(f"Compound {compound_id}: MzValues and AbundanceValues have different lengths")
+        mz_buffers.append(mz_bytes)
+        abundance_buffers.append(abundance_bytes)
+        lengths.append(len(mz_bytes) // 8)
+
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    store = SpectrumStore.from_arrays(offsets, np.frombuffer(b''.join(mz_buffers), dtype='<f8'),
+                                      np.frombuffer(b''.join(abundance_buffers), dtype='<f8'))
+
+    records = list(compounds.values())
+    df = pd.DataFrame({
+        'Chemical_Name': [fields.get('CompoundName') or '' for fields in records],
+        'Formula': [fields.get('Formula') or '' for fields in records],
+        'RT': pd.to_numeric(pd.Series([fields.get('RetentionTimeRTL') for fields in records], dtype=object), errors='coerce'),
+        'RI': pd.to_numeric(pd.Series([fields.get('RetentionIndex') for fields in records], dtype=object), errors='coerce'),
+        'RI Ref': [fields.get('UserDefined') or '' for fields in records],
+        'CAS_Number': [fields.get('CASNumber') or '' for fields in records],
+        'File': [fields.get('Description') or '' for fields in records],
+        # MSLibrary XML has no peak areas
+        'MaxArea': np.nan,
+    })
+    df['MS_Peaks'] = store.to_series(df.index)
+    df['Similarity_to_Previous'], df['Similarity_to_Next'] = previous_next_similarity(store)
+    df['group'] = assign_groups(df['Similarity_to_Previous'].to_numpy(), group_similarity_threshold)
+    return df[COLUMN_ORDER]
+
+
+def read_library(file_path):
+    # Load a library saved as MSLibrary XML or as a CSV table
+    if str(file_path).lower().endswith('.xml'):
+        return read_mslibrary_xml(file_path)
+    df = pd.read_csv(file_path, keep_default_na=False)
+    df['MS_Peaks'] = pack_ms_peaks(df['MS_Peaks'])
+    return df
+
+
+def can_write_library(file_path):
+    return str(file_path).lower().endswith(('.xml', '.csv'))
+
+
+def write_library(df, file_path):
+    # Save a library as MSLibrary XML or as a CSV table, by extension. The file is replaced in one step,
+    # so an interrupted save leaves the old library in place.
+    if not can_write_library(file_path):
+        raise ValueError(f"{file_path}: libraries can only be saved as .xml or .csv")
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    if str(file_path).lower().endswith('.xml'):
+        write_mslibrary_xml(df, tmp_path)
+    else:
+        df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, file_path)
+
+
+def _name_key(name):
+    return PEAK_SUFFIX.sub('', str(name)).strip().lower()
+
+
+def _cas_key(cas):
+    cas = str(cas).strip()
+    return cas if cas and cas not in ('0', 'nan', 'None', '0-00-0') else None
+
+
+class LibraryIndex:
+    # Lookup structure over a master library: hash maps from normalised name and CAS number to rows,
+    # plus RT/RI arrays and the stored spectra, so matching a query only touches its candidate rows.
+    def __init__(self, df):
+        self.rt = pd.to_numeric(df['RT'], errors='coerce').to_numpy(dtype=np.float64)
+        self.ri = pd.to_numeric(df['RI'], errors='coerce').to_numpy(dtype=np.float64)
+        self.spectra = list(df['MS_Peaks'])
+        self.by_name = {}
+        self.by_cas = {}
+        for row, (name, cas) in enumerate(zip(df['Chemical_Name'], df['CAS_Number'])):
+            self.by_name.setdefault(_name_key(name), []).append(row)
+            cas = _cas_key(cas)
+            if cas is not None:
+                self.by_cas.setdefault(cas, []).append(row)
+
+    def __len__(self):
+        return len(self.rt)
+
+    def candidates(self, name, cas, rt, ri, rt_tolerance, ri_tolerance=None):
+        # Rows with the same name or CAS number inside the RT (and RI, when both are known) window
+        rows = set(self.by_name.get(_name_key(name), ()))
+        cas = _cas_key(cas)
+        if cas is not None:
+            rows.update(self.by_cas.get(cas, ()))
+        matches = []
+        for row in rows:
+            if not abs(self.rt[row] - rt) <= rt_tolerance:
+                continue
+            if ri_tolerance is not None and self.ri[row] > 0 and ri > 0 and not abs(self.ri[row] - ri) <= ri_tolerance:
+                continue
+            matches.append(row)
+        return matches
+
+
+def merge_library(master_df, new_df, rt_tolerance=0.1, ri_tolerance=None, similarity_threshold=0.7, group_similarity_threshold=0.9,
+                  update_unknown_area=False):
+    # Fold new combine_cef_results output into a master library.
+    # A new compound matches a master entry with the same name or CAS number inside the RT/RI window
+    # whose spectrum is at least similarity_threshold similar; the most similar one wins.
+    # Matched entries are 'updated' (spectrum, RT, RI, File and MaxArea replaced) when the new peak has a
+    # known MaxArea larger than the master's; otherwise 'kept'. Master entries without a known area (NaN
+    # or 0, e.g. everything read from MSLibrary XML) are kept unless update_unknown_area is set.
+    # Everything else is 'added'. Curated master fields (name, CAS, RI Ref, extra columns) are never changed.
+    # Returns the merged frame and a change report with one row per new compound; its Reason column
+    # tells a master area that was larger from one that was unknown.
+    master = master_df.reset_index(drop=True).copy()
+    index = LibraryIndex(master)
+    new_df = new_df.reset_index(drop=True)
+
+    new_rt = pd.to_numeric(new_df['RT'], errors='coerce').to_numpy(dtype=np.float64)
+    new_ri = pd.to_numeric(new_df['RI'], errors='coerce').to_numpy(dtype=np.float64)
+    new_area = pd.to_numeric(new_df['MaxArea'], errors='coerce').to_numpy(dtype=np.float64)
+    master_area = pd.to_numeric(master['MaxArea'], errors='coerce').to_numpy(dtype=np.float64, copy=True) if 'MaxArea' in master.columns else np.full(len(master), np.nan)
+    new_spectra = list(new_df['MS_Peaks'])
+
+    # Score all (new compound, candidate) pairs in one batch
+    pair_query, pair_row = [], []
+    for query, (name, cas) in enumerate(zip(new_df['Chemical_Name'], new_df['CAS_Number'])):
+        for row in index.candidates(name, cas, new_rt[query], new_ri[query], rt_tolerance, ri_tolerance):
+            pair_query.append(query)
+            pair_row.append(row)
+    similarity = pair_similarity([new_spectra[q] for q in pair_query], [index.spectra[r] for r in pair_row])
+
+    best = {}
+    for query, row, score in zip(pair_query, pair_row, similarity.tolist()):
+        if score >= similarity_threshold and (query not in best or score > best[query][1]):
+            best[query] = (row, score)
+
+    report = []
+    added = []
+    name_counts = {}
+    for name in master['Chemical_Name']:
+        name_counts[_name_key(name)] = name_counts.get(_name_key(name), 0) + 1
+
+    for query in range(len(new_df)):
+        name = new_df.at[query, 'Chemical_Name']
+        if query in best:
+            row, score = best[query]
+            if not master_area[row] > 0:
+                reason = 'unknown master area'
+                update = update_unknown_area and new_area[query] > 0
+            elif not new_area[query] > 0:
+                reason, update = 'unknown new area', False
+            else:
+                update = new_area[query] > master_area[row]
+                reason = 'larger new area' if update else 'larger master area'
+            if update:
+                for column in ('MS_Peaks', 'RT', 'RI', 'File', 'MaxArea'):
+                    if column in master.columns:
+                        master.at[row, column] = new_df.at[query, column]
+                master_area[row] = new_area[query]
+            report.append(('updated' if update else 'kept', reason, name, master.at[row, 'Chemical_Name'], row, score, new_rt[query]))
+        else:
+            # Continue the peak numbering of names the library already has
+            base_name = PEAK_SUFFIX.sub('', str(name))
+            count = name_counts.get(_name_key(name), 0) + 1
+            name_counts[_name_key(name)] = count
+            entry = new_df.iloc[query].copy()
+            entry['Chemical_Name'] = base_name if count == 1 else f"{base_name} peak {count}"
+            added.append(entry)
+            row = len(master) + len(added) - 1
+            report.append(('added', 'no match', name, entry['Chemical_Name'], row, np.nan, new_rt[query]))
+
+    merged = master
+    if added:
+        added_df = pd.DataFrame(added).reset_index(drop=True)
+        next_group = int(pd.to_numeric(master['group'], errors='coerce').max()) + 1 if len(master) else 1
+        added_df['group'] = np.arange(next_group, next_group + len(added_df))
+        merged = pd.concat([master, added_df[[column for column in added_df.columns if column in master.columns]]], ignore_index=True)
+        for column in merged.columns:
+            if merged[column].dtype == object:
+                merged[column] = merged[column].fillna('')
+
+    merged['MS_Peaks'] = pack_ms_peaks(merged['MS_Peaks'])
+    merged['Similarity_to_Previous'], merged['Similarity_to_Next'] = previous_next_similarity(merged['MS_Peaks'])
+
+    report = pd.DataFrame(report, columns=['Action', 'Reason', 'New_Name', 'Library_Name', 'Library_Row', 'Similarity', 'RT'])
+    return merged, report
+
+
+def merge_summary(report):
+    # One-line count of the report actions, e.g. "3 added, 2 updated, 5 kept (4 with an unknown master area)"
+    counts = report['Action'].value_counts()
+    unknown = int(((report['Action'] == 'kept') & (report['Reason'] == 'unknown master area')).sum())
+    summary = f"{counts.get('added', 0)} added, {counts.get('updated', 0)} updated, {counts.get('kept', 0)} kept"
+    if unknown:
+        summary += f" ({unknown} with an unknown master area)"
+    return summary
+
+
+def merge_library_files(master_path, new_df, output_path, report_path=None, **kwargs):
+    # Merge new results into the library at master_path and write the merged library (MSLibrary XML
+    # or CSV, by extension) plus a CSV change report
+    merged, report = merge_library(read_library(master_path), new_df, **kwargs)
+    if str(output_path).lower().endswith('.xml'):
+        write_mslibrary_xml(merged, output_path)
+    else:
+        merged.to_csv(output_path, index=False)
+    report.to_csv(report_path or f"{os.path.splitext(str(output_path))[0]}.report.csv", index=False)
+    return merged, report
@@ -1,25 +1,47 @@
-import ast
+import os
+import re
+import sys
+import time
 import subprocess
 import pathlib
+import numpy as np
+import pandas as pd
+from spectrum_util import as_spectrum
+
+NIST_EXECUTABLE = 'nistms$.exe'
+RESULT_FILE = 'SRCRESLT.TXT'
+READY_FILE = 'SRCREADY.TXT'
+HIT_FIELDS = ['Name', 'CAS', 'MF', 'RMF']
+
+_UNKNOWN_LINE = re.compile(r'^Unknown:\s*(.*?)(?:\s+Compound in Library Factor.*)?$')
+_HIT_LINE = re.compile(r'^Hit\s+(\d+)\s*:\s*<<(.*?)>>(.*)$')
+_HIT_VALUE = re.compile(r'(\w+):\s*([^;]*)')
+
 # NIST search
 def format_ms_peaks_for_nist(peaks):
-    if type(peaks) == str:
-        peaks = ast.literal_eval(peaks)
-    return ''.join([f"{int(mz)}\t{int(intensity)}\n" for mz, intensity in peaks])
-    
+    spectrum = as_spectrum(peaks)
+    return ''.join([f"{mz}\t{intensity}\n" for mz, intensity in zip(spectrum.mz.astype(np.int64).tolist(), spectrum.intensity.astype(np.int64).tolist())])
+
+def _spectrum_entry(df_row, name):
+    spectrum = as_spectrum(df_row['MS_Peaks'])
+    return f"name:{name}\nnum:{len(spectrum)}\n" + format_ms_peaks_for_nist(spectrum)
+
 def create_spectrum_file(df_row, filename):
-    lines = []
-    spec_peaks = format_ms_peaks_for_nist(df_row['MS_Peaks'])
-    lines.append(f"name:RT - {df_row['RT']}\n")
-    lines.append(f"num:{len(df_row['MS_Peaks'])}\n")
-    lines.append(spec_peaks)
-    
     with open(filename, 'w') as f:
-        f.writelines(lines)
+        f.write(_spectrum_entry(df_row, f"RT - {df_row['RT']}"))
+    return filename
+
+def create_batch_spectrum_file(df, filename):
+    # One import file with every row of df; entries are separated by a blank line and named
+    # "<row number>: RT - <rt>" so the search results can be matched back to the table
+    with open(filename, 'w') as f:
+        for position, (_, df_row) in enumerate(df.iterrows()):
+            f.write(_spectrum_entry(df_row, f"{position + 1}: RT - {df_row['RT']}"))
+            f.write("\n")
     return filename
 
 def get_autoimp_path(nist_path):
-    with open(nist_path+"\\AUTOIMP.MSD") as f:
+    with open(os.path.join(nist_path, "AUTOIMP.MSD")) as f:
         path = f.readline()
     return path.strip()
 
@@ -27,18 +49,99 @@ def update_filespec(filespec_path, data_path):
     with open(filespec_path, 'w') as f:
         f.write(data_path + '\n10 724')
 
+def nist_command(nist_path, executable=None):
+    # Command line of the search program. The executable defaults to LIBRACEF_NIST_EXECUTABLE, then to
+    # nistms$.exe in nist_path; a .py stand-in is run with the current interpreter.
+    executable = executable or os.environ.get('LIBRACEF_NIST_EXECUTABLE') or os.path.join(nist_path, NIST_EXECUTABLE)
+    if str(executable).endswith('.py'):
+        return [sys.executable, str(executable), "/INSTRUMENT"]
+    return [str(executable), "/INSTRUMENT"]
+
+def run_nist_search(spec_data_file, nist_path, executable=None):
+    # Point AUTOIMP at the import file and start one search; raises CalledProcessError on failure
+    filespec_path = get_autoimp_path(nist_path)
+    update_filespec(filespec_path, str(spec_data_file))
+    return subprocess.run(nist_command(nist_path, executable), check=True, capture_output=True, text=True)
+
 
-def search_nist_for_spectrum(df_row, spec_data_path, nist_path):
+def search_nist_for_spectrum(df_row, spec_data_path, nist_path, executable=None):
 
     spec_data_file = create_spectrum_file(df_row, spec_data_path)
-    filespec_path = get_autoimp_path(nist_path)
-    update_filespec(filespec_path, spec_data_file)
-    cmd = [
-        nist_path+"\\nistms$.exe",
-        "/INSTRUMENT"
-    ]
     try:
         # Execute the NIST MS Search command
-        subprocess.run(cmd, check=True, capture_output=True, text=True)
+        run_nist_search(spec_data_file, nist_path, executable)
     except subprocess.CalledProcessError as e:
-        print(f"Error running NIST MS Search: {e}")
\ No newline at end of file
+        print(f"Error running NIST MS Search: {e}")
+
+def search_nist_batch(df, spec_data_path, nist_path, executable=None):
+    # Search every row of df with a single launch of the search program
+    spec_data_file = create_batch_spectrum_file(df, spec_data_path)
+    return run_nist_search(spec_data_file, nist_path, executable)
+
+def run_nist_search_job(df, spec_data_path, nist_path, executable=None, timeout=600, poll_interval=0.2):
+    # Search every row of df and return the parsed result file. Stale result files are removed first;
+    # the search is complete once the program has written SRCREADY.TXT.
+    ready_path = os.path.join(nist_path, READY_FILE)
+    result_path = os.path.join(nist_path, RESULT_FILE)
+    for path in (ready_path, result_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    search_nist_batch(df, spec_data_path, nist_path, executable)
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(ready_path):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"NIST MS Search did not finish within {timeout} s")
+        time.sleep(poll_interval)
+    return parse_nist_results(result_path)
+
+def parse_nist_results(file_path):
+    # Parse SRCRESLT.TXT into [{'unknown': name, 'hits': [{'Name', 'Formula', 'CAS', 'MF', 'RMF', 'Prob'}, ...]}]
+    results = []
+    with open(file_path, encoding='latin-1') as f:
+        for line in f:
+            line = line.strip()
+            unknown = _UNKNOWN_LINE.match(line)
+            if unknown:
+                results.append({'unknown': unknown.group(1).strip(), 'hits': []})
+                continue
+            hit = _HIT_LINE.match(line)
+            if hit and results:
+                values = dict(_HIT_VALUE.findall(hit.group(3)))
+                formula = re.match(r';\s*<<(.*?)>>', hit.group(3))
+                results[-1]['hits'].append({
+                    'Name': hit.group(2),
+                    'Formula': formula.group(1) if formula else None,
+                    'CAS': values.get('CAS', '').strip() or None,
+                    'MF': _number(values.get('MF')),
+                    'RMF': _number(values.get('RMF')),
+                    'Prob': _number(values.get('Prob')),
+                })
+    return results
+
+def _number(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return np.nan
+
+def nist_hit_columns(top_n=3):
+    return [f"NIST_Hit_{i}_{field}" for i in range(1, top_n + 1) for field in HIT_FIELDS]
+
+def nist_hits_frame(results, row_count, top_n=3):
+    # One row per searched spectrum with the top_n hits in the NIST_Hit_<i>_<field> columns.
+    # Results are matched to rows by the "<n>:" name prefix written by create_batch_spectrum_file.
+    columns = {column: [None] * row_count for column in nist_hit_columns(top_n)}
+    for position, result in enumerate(results):
+        prefix = result['unknown'].split(':', 1)[0]
+        row = int(prefix) - 1 if prefix.isdigit() else position
+        if not 0 <= row < row_count:
+            continue
+        for i, hit in enumerate(result['hits'][:top_n], start=1):
+            for field in HIT_FIELDS:
+                columns[f"NIST_Hit_{i}_{field}"][row] = hit[field]
+    frame = pd.DataFrame(columns)
+    for column in frame.columns:
+        if column.endswith(('_MF', '_RMF')):
+            frame[column] = frame[column].astype(float)
+    return frame
@@ -0,0 +1,253 @@
+import os
+import json
+import hashlib
+import numpy as np
+from spectrum_util import as_spectrum_store, top_peaks, top_peak_positions, peak_weights
+
+# Persistent inverted peak index over a reference library.
+# Every compound is posted under its most significant m/z values (highest m/z^3 * intensity^0.6).
+# The index is a directory of raw little-endian arrays that are memory-mapped when opened:
+#   main_offsets.i8, main_ids.i4  postings sorted by m/z; compounds of m/z k are main_ids[offsets[k]:offsets[k + 1]]
+#   delta_mz.<n>.i4, delta_ids.<n>.i4  the n postings of compounds added since the last compaction,
+#                                      sorted by m/z; every append writes a new pair of files
+#   norms.f8                      (compounds x 2) L2 norms of the raw and of the weighted spectra
+# meta.json holds the counts and is written last, so an interrupted append leaves the index as it was:
+# norms past the count are ignored and cut off by the next append, unused delta files are removed.
+
+INDEX_VERSION = 2
+DEFAULT_INDEX_PEAKS = 6
+DEFAULT_QUERY_PEAKS = 4
+DEFAULT_MAX_CANDIDATES = 300
+COMPACT_RATIO = 0.25  # compact once the delta holds this fraction of the main postings
+SCORE_BINS = 256  # histogram bins per query when cutting candidates to max_candidates
+
+
+def spectra_fingerprint(spectra, count=None):
+    # Content hash of the first `count` spectra; tells whether an index still belongs to a library
+    store = as_spectrum_store(spectra)
+    count = len(store) if count is None else count
+    end = int(store.offsets[count])
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.ascontiguousarray(store.offsets[:count + 1]).tobytes())
+    digest.update(np.ascontiguousarray(store.mz[:end]).astype('<f8').tobytes())
+    digest.update(np.ascontiguousarray(store.intensity[:end]).astype('<f4').tobytes())
+    return digest.hexdigest()
+
+
+def _postings(store, peak_count, first_id=0):
+    # (m/z, compound id) postings of every spectrum's top weighted peaks, one per distinct m/z
+    rows, mz = top_peaks(store, peak_count, weights=peak_weights(store.mz, store.intensity))
+    keys = np.unique(mz.astype(np.int64) * (len(store) + 1) + rows)
+    return (keys // (len(store) + 1)).astype(np.int32), (keys % (len(store) + 1) + first_id).astype(np.int32)
+
+
+def _sorted_postings(mz, ids):
+    # CSR layout by m/z
+    order = np.lexsort((ids, mz))
+    width = int(mz.max()) + 1 if len(mz) else 1
+    offsets = np.zeros(width + 1, dtype=np.int64)
+    np.cumsum(np.bincount(mz, minlength=width), out=offsets[1:])
+    return offsets, ids[order]
+
+
+def _write_array(path, name, array, dtype):
+    tmp_path = os.path.join(path, f"{name}.{os.getpid()}.tmp")
+    np.ascontiguousarray(array, dtype=dtype).tofile(tmp_path)
+    os.replace(tmp_path, os.path.join(path, name))
+
+
+def _append_array(path, name, array, dtype, valid_items):
+    # Cut off anything past the last committed item, then append
+    file_path = os.path.join(path, name)
+    with open(file_path, 'r+b') as f:
+        f.truncate(valid_items * np.dtype(dtype).itemsize)
+        f.seek(0, os.SEEK_END)
+        f.write(np.ascontiguousarray(array, dtype=dtype).tobytes())
+
+
+def _delta_names(count):
+    return f"delta_mz.{count}.i4", f"delta_ids.{count}.i4"
+
+
+def _remove_stale_deltas(path, count):
+    keep = set(_delta_names(count))
+    for name in os.listdir(path):
+        if name.startswith(('delta_mz.', 'delta_ids.')) and name not in keep:
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError:
+                pass
+
+
+def _map_array(path, name, dtype, count):
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(os.path.join(path, name), dtype=dtype, mode='r', shape=(count,))
+
+
+def _write_meta(path, meta):
+    tmp_path = os.path.join(path, f"meta.json.{os.getpid()}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(path, 'meta.json'))
+
+
+class PeakIndex:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != INDEX_VERSION:
+            raise ValueError(f"{path}: unsupported peak index version {self.meta.get('version')}")
+        self._map()
+
+    def _map(self):
+        meta = self.meta
+        self.main_offsets = _map_array(self.path, 'main_offsets.i8', '<i8', meta['width'] + 1)
+        self.main_ids = _map_array(self.path, 'main_ids.i4', '<i4', meta['main_count'])
+        delta_mz_name, delta_ids_name = _delta_names(meta['delta_count'])
+        self.delta_mz = _map_array(self.path, delta_mz_name, '<i4', meta['delta_count'])
+        self.delta_ids = _map_array(self.path, delta_ids_name, '<i4', meta['delta_count'])
+        self.norms = _map_array(self.path, 'norms.f8', '<f8', meta['count'] * 2).reshape(-1, 2)
+
+    def _unmap(self):
+        # Memory-mapped files cannot be replaced on Windows while mapped
+        self.main_offsets = self.main_ids = self.delta_mz = self.delta_ids = self.norms = None
+
+    def __len__(self):
+        return self.meta['count']
+
+    @classmethod
+    def build(cls, path, spectra, norms, peak_count=DEFAULT_INDEX_PEAKS):
+        store = as_spectrum_store(spectra)
+        os.makedirs(path, exist_ok=True)
+        mz, ids = _postings(store, peak_count)
+        offsets, ids = _sorted_postings(mz, ids)
+        _write_array(path, 'main_offsets.i8', offsets, '<i8')
+        _write_array(path, 'main_ids.i4', ids, '<i4')
+        _write_array(path, 'norms.f8', np.asarray(norms, dtype=np.float64).reshape(-1, 2), '<f8')
+        _write_meta(path, {'version': INDEX_VERSION, 'peak_count': peak_count, 'count': len(store),
+                           'width': len(offsets) - 1, 'main_count': len(ids), 'delta_count': 0,
+                           'fingerprint': spectra_fingerprint(store)})
+        _remove_stale_deltas(path, 0)
+        return cls(path)
+
+    @classmethod
+    def open_for(cls, path, spectra, compute_norms, peak_count=DEFAULT_INDEX_PEAKS):
+        # Open the index of a library, bringing it up to date: a library that only gained compounds at
+        # the end is appended in place, anything else is rebuilt. compute_norms(store) gives the norms.
+        store = as_spectrum_store(spectra)
+        index = None
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            try:
+                index = cls(path)
+            except (ValueError, KeyError, OSError):
+                index = None
+        if index is not None and index.meta['peak_count'] == peak_count and len(index) <= len(store) \
+                and index.meta['fingerprint'] == spectra_fingerprint(store, len(index)):
+            if len(index) < len(store):
+                tail = store.offsets[len(index)]
+                tail_store = type(store)(store.offsets[len(index):] - tail, store.mz[tail:], store.intensity[tail:])
+                index.append(tail_store, compute_norms(tail_store), spectra_fingerprint(store))
+            return index
+        if index is not None:
+            index._unmap()
+        return cls.build(path, store, compute_norms(store), peak_count)
+
+    def append(self, spectra, norms, fingerprint):
+        # Add compounds in place (ids continue after the current ones); fingerprint is that of the
+        # whole library after the append
+        store = as_spectrum_store(spectra)
+        if len(store) == 0:
+            return
+        meta = dict(self.meta)
+        mz, ids = _postings(store, meta['peak_count'], first_id=meta['count'])
+        # The delta stays sorted by m/z, so candidates() can binary search it as it is
+        mz = np.concatenate([np.asarray(self.delta_mz), mz])
+        ids = np.concatenate([np.asarray(self.delta_ids), ids])
+        order = np.lexsort((ids, mz))
+        self._unmap()
+        delta_mz_name, delta_ids_name = _delta_names(len(ids))
+        _write_array(self.path, delta_mz_name, mz[order], '<i4')
+        _write_array(self.path, delta_ids_name, ids[order], '<i4')
+        _append_array(self.path, 'norms.f8', np.asarray(norms, dtype=np.float64).reshape(-1, 2), '<f8', meta['count'] * 2)
+        meta.update(count=meta['count'] + len(store), delta_count=len(ids), fingerprint=fingerprint)
+        _write_meta(self.path, meta)
+        _remove_stale_deltas(self.path, len(ids))
+        self.meta = meta
+        self._map()
+        if meta['delta_count'] > COMPACT_RATIO * max(meta['main_count'], 1000):
+            self.compact()
+
+    def compact(self):
+        # Merge the delta postings into the sorted main postings
+        main_mz = np.repeat(np.arange(self.meta['width'], dtype=np.int32), np.diff(self.main_offsets))
+        mz = np.concatenate([main_mz, np.asarray(self.delta_mz)]).astype(np.int32)
+        ids = np.concatenate([np.asarray(self.main_ids), np.asarray(self.delta_ids)]).astype(np.int32)
+        offsets, ids = _sorted_postings(mz, ids)
+        meta = dict(self.meta, width=len(offsets) - 1, main_count=len(ids), delta_count=0)
+        self._unmap()
+        _write_array(self.path, 'main_offsets.i8', offsets, '<i8')
+        _write_array(self.path, 'main_ids.i4', ids, '<i4')
+        _write_meta(self.path, meta)
+        _remove_stale_deltas(self.path, 0)
+        self.meta = meta
+        self._map()
+
+    def candidates(self, spectra, query_peaks=DEFAULT_QUERY_PEAKS, max_candidates=DEFAULT_MAX_CANDIDATES):
+        # (query position, compound id) pairs: compounds posted under any of a query's top weighted
+        # peaks, ranked by the summed weight of the shared peaks and cut to max_candidates per query
+        store = as_spectrum_store(spectra)
+        weights = peak_weights(store.mz, store.intensity)
+        selected = top_peak_positions(store, query_peaks, weights)
+        rows = store.row_ids[selected]
+        mz = np.rint(store.mz[selected]).astype(np.int64)
+        # Share of each selected peak in its query's total selected weight
+        totals = np.bincount(rows, weights=weights[selected], minlength=len(store))
+        peak_weight = weights[selected] / np.where(totals[rows] > 0, totals[rows], 1)
+
+        # Posting slices of every selected peak, from the main postings and the delta (both sorted by m/z)
+        inside = (mz >= 0) & (mz < self.meta['width'])
+        main_mz = np.where(inside, mz, 0)
+        main_low = np.where(inside, self.main_offsets[main_mz], 0)
+        main_high = np.where(inside, self.main_offsets[main_mz + 1], 0)
+        query_ids, query_rows, query_weights = [], [], []
+        for source, low, high in ((self.main_ids, main_low, main_high),
+                                  (self.delta_ids, np.searchsorted(self.delta_mz, mz), np.searchsorted(self.delta_mz, mz + 1))):
+            lengths = high - low
+            total = int(lengths.sum())
+            if total == 0:
+                continue
+            # Concatenated slices source[low:high] of all peaks in one gather
+            positions = np.repeat(low - (np.cumsum(lengths) - lengths), lengths) + np.arange(total)
+            query_ids.append(np.asarray(source[positions], dtype=np.int64))
+            query_rows.append(np.repeat(rows, lengths))
+            query_weights.append(np.repeat(peak_weight, lengths))
+        if not query_ids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        # Sum the shared peak weights per (query, compound) over the postings only. Every posting slice is
+        # sorted by compound id, and a stable sort merges such runs quickly.
+        keys = np.concatenate(query_rows) * len(self) + np.concatenate(query_ids)
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        score = np.add.reduceat(np.concatenate(query_weights)[order], starts)
+        query_positions, library_rows = keys[starts] // len(self), keys[starts] % len(self)
+
+        counts = np.bincount(query_positions, minlength=len(store))
+        if counts.max() <= max_candidates:
+            return query_positions, library_rows
+        # Keep the best max_candidates per query. Scores are in [0, 1]: a per-query histogram gives the bin
+        # the cut falls in, and only the pairs in that bin are sorted.
+        bins = np.minimum((score * SCORE_BINS).astype(np.int64), SCORE_BINS - 1)
+        histogram = np.bincount(query_positions * SCORE_BINS + bins, minlength=len(store) * SCORE_BINS).reshape(-1, SCORE_BINS)
+        at_least = np.cumsum(histogram[:, ::-1], axis=1)[:, ::-1]
+        cut_bin = (at_least >= max_candidates).sum(axis=1) - 1
+        above = np.where(cut_bin + 1 < SCORE_BINS, at_least[np.arange(len(store)), np.minimum(cut_bin + 1, SCORE_BINS - 1)], 0)
+        keep = bins > cut_bin[query_positions]
+        boundary = np.flatnonzero(bins == cut_bin[query_positions])
+        boundary = boundary[np.lexsort((-score[boundary], query_positions[boundary]))]
+        rank = np.arange(len(boundary)) - np.searchsorted(query_positions[boundary], query_positions[boundary])
+        keep[boundary[rank < (max_candidates - above)[query_positions[boundary]]]] = True
+        return query_positions[keep], library_rows[keep]
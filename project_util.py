@@ -0,0 +1,99 @@
+import os
+import json
+import struct
+import numpy as np
+import pandas as pd
+from spectrum_util import SpectrumStore, as_spectrum_store
+
+# Native project file (.lcproj).
+# Layout: 8-byte magic, uint32 format version, uint64 header length, JSON header, then raw array
+# blocks aligned to 64 bytes. Numeric columns and the packed spectra (offsets, m/z, intensity) are
+# stored as raw arrays so they can be memory-mapped; text columns are kept in the JSON header.
+
+PROJECT_MAGIC = b'LIBRACEF'
+PROJECT_VERSION = 1
+PROJECT_EXTENSION = '.lcproj'
+_ALIGNMENT = 64
+_PREAMBLE = struct.Struct('<8sIQ')
+
+
+def _column_blocks(df):
+    # Split the frame into the JSON column descriptions and the raw arrays to write
+    columns = []
+    arrays = []
+    for name in df.columns:
+        series = df[name]
+        if name == 'MS_Peaks':
+            store = as_spectrum_store(series)
+            columns.append({'name': name, 'kind': 'spectrum', 'arrays': ['offsets', 'mz', 'intensity']})
+            arrays.extend([(name, 'offsets', store.offsets), (name, 'mz', store.mz), (name, 'intensity', store.intensity)])
+        elif series.dtype.kind in 'biuf':
+            columns.append({'name': name, 'kind': 'array'})
+            arrays.append((name, 'values', np.ascontiguousarray(series.to_numpy())))
+        else:
+            values = [None if value is None or (isinstance(value, float) and np.isnan(value)) else
+                      value if isinstance(value, (str, int, float, bool)) else str(value)
+                      for value in series.tolist()]
+            columns.append({'name': name, 'kind': 'values', 'values': values})
+    return columns, arrays
+
+
+def save_project(df, file_path):
+    # Write the frame to a project file; the file is replaced atomically
+    columns, arrays = _column_blocks(df)
+
+    # Lay the arrays out after the header; offsets are relative to the start of the data section
+    blocks = {}
+    position = 0
+    for name, role, array in arrays:
+        position = -(-position // _ALIGNMENT) * _ALIGNMENT
+        blocks.setdefault(name, {})[role] = {'dtype': array.dtype.str, 'length': len(array), 'offset': position}
+        position += array.nbytes
+    for column in columns:
+        if column['name'] in blocks:
+            column['blocks'] = blocks[column['name']]
+
+    header = json.dumps({'rows': len(df), 'columns': columns}).encode('utf-8')
+    data_start = -(-(_PREAMBLE.size + len(header)) // _ALIGNMENT) * _ALIGNMENT
+
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(_PREAMBLE.pack(PROJECT_MAGIC, PROJECT_VERSION, len(header)))
+        f.write(header)
+        for name, role, array in arrays:
+            f.seek(data_start + blocks[name][role]['offset'])
+            f.write(array.tobytes())
+        f.truncate(data_start + position)
+    os.replace(tmp_path, file_path)
+
+
+def load_project(file_path, mmap=True):
+    # Load a project file. With mmap=True the spectra stay memory-mapped (read-only) instead of being read.
+    with open(file_path, 'rb') as f:
+        magic, version, header_length = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+        if magic != PROJECT_MAGIC:
+            raise ValueError(f"{file_path} is not a LibraCEF project file")
+        if version > PROJECT_VERSION:
+            raise ValueError(f"{file_path} was written by a newer LibraCEF (format {version})")
+        header = json.loads(f.read(header_length).decode('utf-8'))
+    data_start = -(-(_PREAMBLE.size + header_length) // _ALIGNMENT) * _ALIGNMENT
+
+    def read_block(block, copy):
+        dtype = np.dtype(block['dtype'])
+        if block['length'] == 0:
+            return np.empty(0, dtype=dtype)
+        if mmap and not copy:
+            return np.memmap(file_path, dtype=dtype, mode='r', offset=data_start + block['offset'], shape=(block['length'],))
+        return np.fromfile(file_path, dtype=dtype, count=block['length'], offset=data_start + block['offset'])
+
+    data = {}
+    for column in header['columns']:
+        if column['kind'] == 'spectrum':
+            blocks = column['blocks']
+            store = SpectrumStore(read_block(blocks['offsets'], True), read_block(blocks['mz'], False), read_block(blocks['intensity'], False))
+            data[column['name']] = store.to_series()
+        elif column['kind'] == 'array':
+            data[column['name']] = read_block(column['blocks']['values'], True)
+        else:
+            data[column['name']] = pd.Series(column['values'], dtype=object)
+    return pd.DataFrame(data, columns=[column['name'] for column in header['columns']])
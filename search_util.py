@@ -0,0 +1,362 @@
+import re
+import gzip
+import numpy as np
+import pandas as pd
+from spectrum_util import SpectrumStore, as_spectrum_store, normalize_rows, row_norms, weighted_csr, with_width
+from peak_index_util import PeakIndex, spectra_fingerprint, DEFAULT_MAX_CANDIDATES
+from library_util import read_library, write_library, can_write_library
+
+# In-process spectral library search.
+# A ReferenceLibrary keeps a reference library as packed spectra plus its name/CAS/formula/RI columns.
+# Queries are scored with sparse matrix products against the whole library: cosine on the raw
+# intensities, the NIST-style weighted dot product (match factor, m/z^3 * intensity^0.6 weights) and
+# the composite score that adds the intensity ratio of neighbouring common peaks (Stein & Scott).
+# All scores use the 0-999 scale of NIST MS Search.
+
+METRICS = ('cosine', 'dot', 'composite')
+HIT_FIELDS = ['Name', 'CAS', 'Score']
+
+_NUMBER = r'[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?'
+_PEAK_PAIR = re.compile(rf'({_NUMBER})[\s,:]+({_NUMBER})')
+_QUOTED = re.compile(r'"[^"]*"')
+
+_MSP_FIELDS = {'name': 'Chemical_Name', 'cas#': 'CAS_Number', 'casno': 'CAS_Number', 'cas': 'CAS_Number',
+               'formula': 'Formula', 'ri': 'RI', 'retentionindex': 'RI', 'retention_index': 'RI',
+               'rt': 'RT', 'retentiontime': 'RT', 'retention_time': 'RT'}
+_JCAMP_FIELDS = {'TITLE': 'Chemical_Name', 'CAS REGISTRY NO': 'CAS_Number', 'MOLECULAR FORMULA': 'Formula',
+                 '$RETENTION INDEX': 'RI', 'RETENTION INDEX': 'RI', 'RETENTION TIME': 'RT'}
+
+
+def _open_text(file_path):
+    if str(file_path).lower().endswith('.gz'):
+        return gzip.open(file_path, 'rt', encoding='utf-8', errors='replace')
+    return open(file_path, encoding='utf-8', errors='replace')
+
+
+def _library_frame(records, lengths, values):
+    # Table in the combine_cef_results layout from parsed records and their flat "m/z intensity" texts
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    values = np.array(values, dtype=np.float64)
+    df = pd.DataFrame(records, columns=['Chemical_Name', 'Formula', 'RT', 'RI', 'CAS_Number'])
+    for column in ('RT', 'RI'):
+        df[column] = pd.to_numeric(df[column], errors='coerce')
+    df['MS_Peaks'] = SpectrumStore.from_arrays(offsets, values[0::2], values[1::2]).to_series(df.index)
+    return df
+
+
+def read_msp(file_path):
+    # NIST MSP text library: "Key: value" lines, "Num Peaks: n", then n m/z-intensity pairs per record
+    records, lengths, values = [], [], []
+    record, remaining = None, 0
+    with _open_text(file_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                record, remaining = None, 0
+                continue
+            if record is None:
+                record = {}
+                records.append(record)
+                lengths.append(0)
+            if remaining > 0:
+                pairs = _PEAK_PAIR.findall(_QUOTED.sub(' ', line))
+                for mz, intensity in pairs[:remaining]:
+                    values.extend((mz, intensity))
+                lengths[-1] += min(len(pairs), remaining)
+                remaining -= len(pairs)
+                continue
+            key, _, value = line.partition(':')
+            key = key.strip().lower()
+            if key == 'num peaks':
+                remaining = int(value.strip() or 0)
+            elif key in _MSP_FIELDS and _MSP_FIELDS[key] not in record:
+                record[_MSP_FIELDS[key]] = value.strip()
+    return _library_frame(records, lengths, values)
+
+
+def read_jcamp(file_path):
+    # JCAMP-DX mass spectra (as written by export_util.write_jcamp_library): ##KEY=value headers and
+    # an XY peak table up to ##END=
+    records, lengths, values = [], [], []
+    record, in_peaks = None, False
+    with _open_text(file_path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('##'):
+                key, _, value = line[2:].partition('=')
+                key = key.strip().upper()
+                in_peaks = False
+                if key == 'TITLE':
+                    record = {}
+                    records.append(record)
+                    lengths.append(0)
+                if record is None:
+                    continue
+                if key in ('PEAK TABLE', 'XYPOINTS'):
+                    in_peaks = True
+                elif key == 'END':
+                    record = None
+                elif key in _JCAMP_FIELDS and _JCAMP_FIELDS[key] not in record:
+                    record[_JCAMP_FIELDS[key]] = value.strip()
+            elif in_peaks and line:
+                pairs = _PEAK_PAIR.findall(line)
+                for mz, intensity in pairs:
+                    values.extend((mz, intensity))
+                lengths[-1] += len(pairs)
+    return _library_frame(records, lengths, values)
+
+
+def load_reference_library(file_path, index=False):
+    # index=True keeps a persistent peak index next to the library file (<file>.peakindex)
+    name = str(file_path).lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    if name.endswith('.msp'):
+        df = read_msp(file_path)
+    elif name.endswith(('.jdx', '.dx', '.jcamp')):
+        df = read_jcamp(file_path)
+    else:
+        df = read_library(file_path)
+    return ReferenceLibrary(df, index_path=f"{file_path}.peakindex" if index else None, library_path=file_path)
+
+
+def spectrum_norms(spectra):
+    # (spectra x 2) L2 norms of the raw and of the NIST-weighted spectra
+    store = as_spectrum_store(spectra)
+    return np.column_stack([row_norms(store.to_csr()), row_norms(weighted_csr(store))])
+
+
+def _ratio_scores(pair_rows, query_values, library_values, pair_count):
+    # Peak ratio term of the composite score. Inputs are the common peaks of all pairs in m/z order
+    # within each pair. For every two neighbouring common peaks, min(r, 1/r) with
+    # r = (L_i * Q_i-1) / (L_i-1 * Q_i), averaged over the neighbour pairs so an identical spectrum
+    # scores 1. Returns (ratio score, number of common peaks) per pair.
+    common = np.bincount(pair_rows, minlength=pair_count)
+    neighbours = pair_rows[1:] == pair_rows[:-1]
+    ratio = (library_values[1:] * query_values[:-1]) / (library_values[:-1] * query_values[1:])
+    ratio = np.minimum(ratio, 1.0 / ratio)
+    total = np.bincount(pair_rows[1:][neighbours], weights=ratio[neighbours], minlength=pair_count)
+    return np.divide(total, common - 1, out=np.zeros(pair_count), where=common > 1), common
+
+
+def _ri_penalty(query_ri, library_ri, ri_window, ri_penalty):
+    # Score penalty for RI differences beyond ri_window (arrays broadcast), or None without RI filtering
+    if ri_window is None or not np.isfinite(query_ri).any():
+        return None
+    excess = np.abs(query_ri - library_ri) - ri_window
+    return np.where(np.isfinite(excess) & (excess > 0), excess * ri_penalty, 0.0)
+
+
+class ReferenceLibrary:
+    def __init__(self, df, index_path=None, library_path=None):
+        # library_path is the file the library was read from; add() saves to it when there is a peak index
+        self.df = df.reset_index(drop=True)
+        self.library_path = library_path
+        self.store = as_spectrum_store(self.df['MS_Peaks'])
+        self.names = self._text_column('Chemical_Name')
+        self.cas = self._text_column('CAS_Number')
+        self.formulas = self._text_column('Formula')
+        if 'RI' in self.df:
+            self.ri = pd.to_numeric(self.df['RI'], errors='coerce').to_numpy(dtype=np.float64)
+        else:
+            self.ri = np.full(len(self.df), np.nan)
+
+        # With a peak index the norms come precomputed from disk
+        self.index = None
+        norms = None
+        if index_path is not None:
+            self.index = PeakIndex.open_for(index_path, self.store, spectrum_norms)
+            norms = self.index.norms
+        self._build_matrices(norms)
+
+    def _text_column(self, column):
+        if column not in self.df:
+            return np.full(len(self.df), '', dtype=object)
+        return self.df[column].astype(str).to_numpy(dtype=object)
+
+    def _build_matrices(self, norms=None):
+        # Unit-length rows, so a matrix product gives cosines directly; float32 halves the memory traffic
+        cosine_matrix = self.store.to_csr()
+        self.width = cosine_matrix.shape[1]
+        weighted_matrix = weighted_csr(self.store, self.width)
+        self.cosine_matrix = normalize_rows(cosine_matrix, None if norms is None else norms[:, 0]).astype(np.float32)
+        self.weighted_matrix = normalize_rows(weighted_matrix, None if norms is None else norms[:, 1]).astype(np.float32)
+        # Pair scoring walks the peaks of each row in m/z order
+        self.cosine_matrix.sort_indices()
+        self.weighted_matrix.sort_indices()
+
+    def __len__(self):
+        return len(self.store)
+
+    def add(self, df):
+        # Append compounds to the library. With a peak index the library file is saved first and the index
+        # is then updated in place, so the two still match when the library is opened again. An index
+        # whose library cannot be saved (no file, or MSP/JCAMP) is dropped instead and searches go back
+        # to scoring the whole library.
+        new_store = as_spectrum_store(df['MS_Peaks'])
+        merged = pd.concat([self.df, df], ignore_index=True)
+        if self.index is not None:
+            if self.library_path is not None and can_write_library(self.library_path):
+                write_library(merged, self.library_path)
+            else:
+                self.index = None
+        self.df = merged
+        self.store = SpectrumStore.from_arrays(np.concatenate([self.store.offsets, self.store.offsets[-1] + new_store.offsets[1:]]),
+                                               np.concatenate([self.store.mz, new_store.mz]),
+                                               np.concatenate([self.store.intensity, new_store.intensity]))
+        self.names, self.cas, self.formulas = self._text_column('Chemical_Name'), self._text_column('CAS_Number'), self._text_column('Formula')
+        self.ri = pd.to_numeric(self.df['RI'], errors='coerce').to_numpy(dtype=np.float64) if 'RI' in self.df else np.full(len(self.df), np.nan)
+        norms = None
+        if self.index is not None:
+            self.index.append(new_store, spectrum_norms(new_store), spectra_fingerprint(self.store))
+            norms = self.index.norms
+        self._build_matrices(norms)
+
+    def search(self, spectra, ri=None, top_k=5, metric='composite', ri_window=None, ri_penalty=1.0,
+               min_score=0, chunk_size=None, use_index=True, max_candidates=DEFAULT_MAX_CANDIDATES):
+        # Search every query spectrum and return the top_k hits per query as one long table
+        # (Query = position of the query). With ri and ri_window, hits whose RI differs by more than
+        # ri_window lose ri_penalty points per RI unit beyond the window. With a peak index only the
+        # index candidates of each query are scored (for composite, the best of them by dot score), otherwise a
+        # shortlist from the whole library.
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric {metric!r}, expected one of {METRICS}")
+        store = as_spectrum_store(spectra)
+        count = len(store)
+        query_ri = np.full(count, np.nan) if ri is None else pd.to_numeric(pd.Series(list(ri), dtype=object), errors='coerce').to_numpy(dtype=np.float64)
+        # Normalise before trimming to the library width: peaks the library never has still count
+        query_cosine = with_width(normalize_rows(store.to_csr()), self.width)
+        query_weighted = with_width(normalize_rows(weighted_csr(store)), self.width)
+        query_peaks = np.diff(query_weighted.indptr)
+
+        top_k = min(top_k, len(self))
+        if count == 0 or top_k == 0:
+            return _hits_table([], self)
+        use_index = use_index and self.index is not None
+        if chunk_size is None:
+            chunk_size = 256 if use_index else int(max(1, min(256, 2 * 10 ** 7 // max(len(self), 1))))
+        shortlist = min(len(self), max(top_k * 5, 20))
+
+        tables = []
+        for start in range(0, count, chunk_size):
+            end = min(start + chunk_size, count)
+            cosine_block = query_cosine[start:end].toarray().astype(np.float32)
+            weighted_block = query_weighted[start:end].toarray().astype(np.float32)
+
+            if use_index:
+                chunk = SpectrumStore(store.offsets[start:end + 1] - store.offsets[start],
+                                      store.mz[store.offsets[start]:store.offsets[end]],
+                                      store.intensity[store.offsets[start]:store.offsets[end]])
+                query_positions, library_rows = self.index.candidates(chunk, max_candidates=max_candidates)
+                if metric == 'composite':
+                    # The cheap dot score picks the shortlist the composite score is computed for
+                    dot = self._pair_scores('dot', cosine_block, weighted_block, query_positions, library_rows, None)
+                    penalty = _ri_penalty(query_ri[start:end][query_positions], self.ri[library_rows], ri_window, ri_penalty)
+                    if penalty is not None:
+                        dot = dot - penalty
+                    query_positions, library_rows, _ = _best_pairs(query_positions, library_rows, dot, shortlist)
+            else:
+                query_positions, library_rows = self._shortlist(metric, cosine_block, weighted_block, query_ri[start:end],
+                                                                ri_window, ri_penalty, shortlist if metric == 'composite' else top_k)
+
+            score = self._pair_scores(metric, cosine_block, weighted_block, query_positions, library_rows,
+                                      query_peaks[start:end][query_positions])
+            penalty = _ri_penalty(query_ri[start:end][query_positions], self.ri[library_rows], ri_window, ri_penalty)
+            if penalty is not None:
+                score = score - penalty
+
+            # Best top_k per query; cosine and match factor are only computed for those
+            query_positions, library_rows, score = _best_pairs(query_positions, library_rows, score, top_k)
+            keep = score > min_score
+            query_positions, library_rows, score = query_positions[keep], library_rows[keep], score[keep]
+            cosine = _pair_dot(self.cosine_matrix, cosine_block, query_positions, library_rows)
+            dot = np.square(_pair_dot(self.weighted_matrix, weighted_block, query_positions, library_rows))
+            tables.append(pd.DataFrame({'Query': query_positions + start, 'Library_Row': library_rows, 'Score': score,
+                                        'Cosine': cosine * 999, 'Match_Factor': dot * 999}))
+
+        hits = pd.concat(tables, ignore_index=True)
+        hits['RI_Delta'] = self.ri[hits['Library_Row'].to_numpy()] - query_ri[hits['Query'].to_numpy()]
+        return _hits_table(hits, self)
+
+    def _shortlist(self, metric, cosine_block, weighted_block, query_ri, ri_window, ri_penalty, keep):
+        # Best `keep` library rows per query from a (queries x library) score matrix over the whole library
+        if metric == 'cosine':
+            scores = np.ascontiguousarray((self.cosine_matrix @ cosine_block.T).T)
+        else:
+            scores = np.ascontiguousarray((self.weighted_matrix @ weighted_block.T).T)
+        penalty = _ri_penalty(query_ri[:, None], self.ri[None, :], ri_window, ri_penalty)
+        if penalty is not None:
+            scores = (np.square(scores) if metric != 'cosine' else scores) * 999 - penalty
+        if keep < len(self):
+            rows = np.argpartition(scores, len(self) - keep, axis=1)[:, len(self) - keep:]
+        else:
+            rows = np.tile(np.arange(len(self)), (len(cosine_block), 1))
+        return np.repeat(np.arange(len(cosine_block)), rows.shape[1]), rows.ravel()
+
+    def _pair_scores(self, metric, cosine_block, weighted_block, query_positions, library_rows, query_peaks):
+        # Score (0-999) of every (query, library row) pair, computed over the stored peaks of the library rows
+        if metric == 'cosine':
+            return _pair_dot(self.cosine_matrix, cosine_block, query_positions, library_rows) * 999
+        pair_rows, query_values, library_values = _pair_peaks(self.weighted_matrix, weighted_block, query_positions, library_rows)
+        dot = np.square(np.bincount(pair_rows, weights=query_values * library_values, minlength=len(library_rows)))
+        if metric == 'dot':
+            return dot * 999
+        common = (query_values > 0) & (library_values > 0)
+        ratio, common_count = _ratio_scores(pair_rows[common], query_values[common], library_values[common], len(library_rows))
+        score = np.divide(query_peaks * dot + common_count * ratio, query_peaks + common_count,
+                          out=np.zeros(len(library_rows)), where=(query_peaks + common_count) > 0)
+        return score * 999
+
+
+def _best_pairs(query_positions, library_rows, score, keep):
+    # The `keep` best scoring pairs of every query, ordered by query and then by descending score
+    order = np.lexsort((-score, query_positions))
+    query_positions, library_rows, score = query_positions[order], library_rows[order], score[order]
+    best = np.arange(len(order)) - np.searchsorted(query_positions, query_positions) < keep
+    return query_positions[best], library_rows[best], score[best]
+
+
+def _pair_peaks(matrix, block, query_positions, library_rows):
+    # Stored peaks of the library rows of every pair with the query values at the same m/z:
+    # (pair of each peak, query values, library values)
+    rows = matrix[library_rows]
+    pair_rows = np.repeat(np.arange(len(library_rows)), np.diff(rows.indptr))
+    query_values = block.ravel()[query_positions[pair_rows] * block.shape[1] + rows.indices]
+    return pair_rows, query_values.astype(np.float64), rows.data.astype(np.float64)
+
+
+def _pair_dot(matrix, block, query_positions, library_rows):
+    pair_rows, query_values, library_values = _pair_peaks(matrix, block, query_positions, library_rows)
+    return np.bincount(pair_rows, weights=query_values * library_values, minlength=len(library_rows))
+
+
+def _hits_table(hits, library):
+    columns = ['Query', 'Rank', 'Library_Row', 'Name', 'CAS', 'Formula', 'RI', 'RI_Delta', 'Score', 'Cosine', 'Match_Factor']
+    if len(hits) == 0:
+        return pd.DataFrame(columns=columns)
+    rows = hits['Library_Row'].to_numpy()
+    hits['Rank'] = hits.groupby('Query').cumcount() + 1
+    hits['Name'] = library.names[rows]
+    hits['CAS'] = library.cas[rows]
+    hits['Formula'] = library.formulas[rows]
+    hits['RI'] = library.ri[rows]
+    return hits[columns]
+
+
+def library_hit_columns(top_n=3):
+    return [f"Library_Hit_{i}_{field}" for i in range(1, top_n + 1) for field in HIT_FIELDS]
+
+
+def library_hits_frame(hits, row_count, top_n=3):
+    # One row per query with the top_n hits in the Library_Hit_<i>_<field> columns
+    columns = {column: [None] * row_count for column in library_hit_columns(top_n)}
+    for query, rank, name, cas, score in zip(hits['Query'], hits['Rank'], hits['Name'], hits['CAS'], hits['Score']):
+        if rank <= top_n:
+            for field, value in zip(HIT_FIELDS, (name, cas, float(score))):
+                columns[f"Library_Hit_{rank}_{field}"][query] = value
+    frame = pd.DataFrame(columns)
+    for column in frame.columns:
+        if column.endswith('_Score'):
+            frame[column] = frame[column].astype(float)
+    return frame
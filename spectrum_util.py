@@ -0,0 +1,356 @@
+import re
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Packed spectrum storage.
+# A SpectrumStore keeps the peaks of many spectra in three contiguous arrays (offsets, m/z and
+# intensity). Each row of the MS_Peaks column is a Spectrum: a zero-copy view into those arrays
+# that still behaves like the old list of (mz, intensity) tuples.
+
+MZ_DTYPE = np.uint16
+FLOAT_MZ_DTYPE = np.float32
+INTENSITY_DTYPE = np.float32
+
+# NIST-style peak weighting for library search: m/z^3 * intensity^0.6
+MZ_WEIGHT = 3.0
+INTENSITY_WEIGHT = 0.6
+
+# MS_Peaks text as written to CSV: "[(41, 999.0), (43, 120.5)]" (pairs may also be in brackets).
+# Every digit and every whitespace run can only be matched one way, so a malformed (e.g. truncated)
+# cell fails in linear time instead of backtracking through all the ways to split its numbers.
+_NUMBER = r'[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?'
+_PAIR = rf'[(\[]\s*{_NUMBER}\s*,\s*{_NUMBER}\s*[)\]]'
+_PEAKS_TEXT = re.compile(rf'\s*\[\s*(?:{_PAIR}\s*(?:,\s*{_PAIR}\s*)*(?:,\s*)?)?\]\s*')
+_SEPARATORS = str.maketrans('[](),', '     ')
+
+
+def _mz_dtype(mz):
+    # Nominal m/z values are stored as uint16, anything else as float32
+    if mz.size == 0 or mz.dtype == MZ_DTYPE:
+        return MZ_DTYPE
+    if np.all(mz >= 0) and np.all(mz <= np.iinfo(MZ_DTYPE).max) and np.all(np.mod(mz, 1) == 0):
+        return MZ_DTYPE
+    return FLOAT_MZ_DTYPE
+
+
+class Spectrum:
+    __slots__ = ('mz', 'intensity')
+
+    def __init__(self, mz, intensity):
+        self.mz = mz
+        self.intensity = intensity
+
+    @classmethod
+    def from_peaks(cls, peaks):
+        if len(peaks) == 0:
+            return cls(np.empty(0, dtype=MZ_DTYPE), np.empty(0, dtype=INTENSITY_DTYPE))
+        values = np.asarray(peaks, dtype=np.float64).reshape(-1, 2)
+        mz = values[:, 0]
+        return cls(mz.astype(_mz_dtype(mz)), values[:, 1].astype(INTENSITY_DTYPE))
+
+    def __len__(self):
+        return len(self.mz)
+
+    def __iter__(self):
+        return zip(self.mz.tolist(), self.intensity.tolist())
+
+    def __getitem__(self, i):
+        return (self.mz[i].item(), self.intensity[i].item())
+
+    def __repr__(self):
+        # Same text as str(list of tuples) so CSV files keep their format
+        return '[' + ', '.join(f"({m}, {i})" for m, i in self.peak_texts()) + ']'
+
+    def peak_texts(self):
+        # (m/z, intensity) pairs formatted with the shortest text for their stored precision
+        if self.mz.dtype == MZ_DTYPE:
+            mz_text = self.mz.astype(np.int64).astype(str).tolist()
+        else:
+            mz_text = _float_text(self.mz)
+        return list(zip(mz_text, _float_text(self.intensity)))
+
+    def __reduce__(self):
+        # Pickle only the viewed peaks, not the whole shared buffer
+        return (Spectrum, (self.mz.copy(), self.intensity.copy()))
+
+    def to_list(self):
+        return list(self)
+
+    @property
+    def base_peak(self):
+        if len(self) == 0:
+            return None
+        return self.mz[int(np.argmax(self.intensity))].item()
+
+    def summary(self):
+        # Short cell text for tables: peak count and base peak
+        base_peak = self.base_peak
+        if base_peak is None:
+            return "0 peaks"
+        return f"{len(self)} peaks, base {base_peak:g}"
+
+
+def _float_text(values):
+    # Shortest text that round-trips float32, always with a decimal point like repr(float)
+    texts = values.astype(str).tolist()
+    return [text if ('.' in text or 'e' in text or 'n' in text) else text + '.0' for text in texts]
+
+
+def parse_ms_peaks_text(texts):
+    # Bulk tokenizer for MS_Peaks text. Every row is validated with one regex, then the numbers of all
+    # valid rows are converted in a single pass. Blank rows are empty spectra; malformed rows are
+    # stored as empty spectra and their positions returned.
+    bad_rows = []
+    valid = []
+    lengths = np.zeros(len(texts), dtype=np.int64)
+    for i, text in enumerate(texts):
+        if not text.strip():
+            continue
+        if _PEAKS_TEXT.fullmatch(text) is None:
+            bad_rows.append(i)
+            continue
+        # n pairs have 2n - 1 commas, or 2n with a trailing comma
+        lengths[i] = (text.count(',') + 1) // 2
+        valid.append(text)
+
+    values = np.array(' '.join(valid).translate(_SEPARATORS).split(), dtype=np.float64)
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return SpectrumStore.from_arrays(offsets, values[0::2], values[1::2]), bad_rows
+
+
+def parse_ms_peaks_column(values):
+    # Parse a whole MS_Peaks column once. Returns (SpectrumStore, positions of malformed rows).
+    # Text rows go through the bulk tokenizer; Spectrum objects, lists and missing values are converted as is.
+    values = list(values)
+    texts = [value if isinstance(value, str) else '' for value in values]
+    store, bad_rows = parse_ms_peaks_text(texts)
+    if all(isinstance(value, str) for value in values):
+        return store, bad_rows
+    spectra = [store[i] if isinstance(value, str) else as_spectrum(value) for i, value in enumerate(values)]
+    return SpectrumStore.from_peaks(spectra), bad_rows
+
+
+def as_spectrum(peaks):
+    # Convert anything stored in MS_Peaks (Spectrum, list of tuples or its printed text) to a Spectrum
+    if isinstance(peaks, Spectrum):
+        return peaks
+    if isinstance(peaks, str):
+        store, bad_rows = parse_ms_peaks_text([peaks])
+        if bad_rows:
+            raise ValueError(f"Invalid MS_Peaks value: {peaks[:80]!r}")
+        return store[0]
+    if peaks is None or (isinstance(peaks, float) and np.isnan(peaks)):
+        peaks = []
+    return Spectrum.from_peaks(peaks)
+
+
+class SpectrumStore:
+    def __init__(self, offsets, mz, intensity):
+        self.offsets = offsets
+        self.mz = mz
+        self.intensity = intensity
+
+    @classmethod
+    def from_peaks(cls, spectra):
+        # Pack an iterable of spectra (Spectrum, lists of tuples or MS_Peaks text) into shared arrays
+        spectra = [as_spectrum(peaks) for peaks in spectra]
+        lengths = np.fromiter((len(spectrum) for spectrum in spectra), dtype=np.int64, count=len(spectra))
+        offsets = np.zeros(len(spectra) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        if spectra:
+            mz = np.concatenate([spectrum.mz for spectrum in spectra])
+            intensity = np.concatenate([spectrum.intensity for spectrum in spectra]).astype(INTENSITY_DTYPE, copy=False)
+        else:
+            mz = np.empty(0, dtype=MZ_DTYPE)
+            intensity = np.empty(0, dtype=INTENSITY_DTYPE)
+        return cls(offsets, mz.astype(_mz_dtype(mz), copy=False), intensity)
+
+    @classmethod
+    def from_arrays(cls, offsets, mz, intensity):
+        # Wrap flat arrays, converting them to the store dtypes (copies only when the dtype changes)
+        mz = np.asarray(mz)
+        return cls(np.asarray(offsets, dtype=np.int64), mz.astype(_mz_dtype(mz), copy=False),
+                   np.asarray(intensity).astype(INTENSITY_DTYPE, copy=False))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return Spectrum(self.mz[start:end], self.intensity[start:end])
+
+    def __iter__(self):
+        offsets = self.offsets.tolist()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield Spectrum(self.mz[start:end], self.intensity[start:end])
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def row_ids(self):
+        # Row number of every peak
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def to_csr(self, dtype=np.float64):
+        # Sparse (spectra x nominal m/z) intensity matrix
+        columns = np.rint(self.mz).astype(np.int64)
+        width = int(columns.max()) + 1 if columns.size else 1
+        # Peaks that round to the same m/z keep the last one, like the dense vectors of
+        # cef_util.calculate_similarity (np.unique on the reversed keys finds the last of each)
+        keys = self.row_ids * width + columns
+        keys, last = np.unique(keys[::-1], return_index=True)
+        kept = len(columns) - 1 - last
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys // width, minlength=len(self)), out=offsets[1:])
+        return sparse.csr_matrix((self.intensity[kept].astype(dtype), columns[kept], offsets), shape=(len(self), width))
+
+    def to_series(self, index=None):
+        # Object series of zero-copy views, ready to be used as the MS_Peaks column
+        series = pd.Series(list(self), dtype=object)
+        if index is not None:
+            series.index = index
+        return series
+
+
+def pack_ms_peaks(series):
+    # Repack an MS_Peaks column into one shared store and return the column of views.
+    # Raises ValueError when rows cannot be parsed.
+    store, bad_rows = parse_ms_peaks_column(series)
+    if bad_rows:
+        raise ValueError(f"Invalid MS_Peaks in {len(bad_rows)} row(s): {', '.join(str(row + 1) for row in bad_rows[:10])}")
+    return store.to_series(series.index)
+
+
+def as_spectrum_store(spectra):
+    if isinstance(spectra, SpectrumStore):
+        return spectra
+    return SpectrumStore.from_peaks(spectra)
+
+
+def row_norms(matrix):
+    return np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+
+
+def normalize_rows(matrix, norms=None):
+    # Scale every row of a sparse matrix to unit length; all-zero rows stay zero.
+    # Precomputed norms can be passed in.
+    if norms is None:
+        norms = row_norms(matrix)
+    norms = np.asarray(norms, dtype=np.float64)
+    scale = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+    return sparse.diags(scale).dot(matrix).tocsr()
+
+
+def peak_weights(mz, intensity):
+    return np.power(np.clip(np.asarray(intensity, dtype=np.float64), 0, None), INTENSITY_WEIGHT) * np.power(np.rint(mz).astype(np.float64), MZ_WEIGHT)
+
+
+def with_width(matrix, width):
+    # Drop or add m/z columns so two spectrum matrices line up
+    if matrix.shape[1] > width:
+        return matrix[:, :width].tocsr()
+    matrix = matrix.copy()
+    matrix.resize((matrix.shape[0], width))
+    return matrix
+
+
+def weighted_csr(spectra, width=None):
+    # (spectra x nominal m/z) matrix of NIST-weighted intensities
+    matrix = as_spectrum_store(spectra).to_csr()
+    if width is not None:
+        matrix = with_width(matrix, width)
+    matrix.data = peak_weights(matrix.indices, matrix.data)
+    return matrix
+
+
+def normalized_csr(spectra):
+    # Row-normalised sparse matrix; empty spectra stay all-zero rows
+    return normalize_rows(as_spectrum_store(spectra).to_csr())
+
+
+def adjacent_similarity(spectra):
+    # Cosine similarity of every spectrum with the next one: N spectra give N-1 scores.
+    # Pairs involving an empty spectrum score 0.
+    matrix = normalized_csr(spectra)
+    if matrix.shape[0] < 2:
+        return np.zeros(0)
+    return np.asarray(matrix[:-1].multiply(matrix[1:]).sum(axis=1)).ravel()
+
+
+def pair_similarity(spectra_a, spectra_b):
+    # Cosine similarity of spectra_a[i] with spectra_b[i] for every i
+    spectra_a, spectra_b = list(spectra_a), list(spectra_b)
+    if not spectra_a:
+        return np.zeros(0)
+    matrix = normalized_csr(spectra_a + spectra_b)
+    count = len(spectra_a)
+    return np.asarray(matrix[:count].multiply(matrix[count:]).sum(axis=1)).ravel()
+
+
+def previous_next_similarity(spectra):
+    # Similarity_to_Previous and Similarity_to_Next columns; Next is Previous shifted by one row
+    store = as_spectrum_store(spectra)
+    if len(store) < 2:
+        return np.zeros(len(store)), np.zeros(len(store))
+    similarity = adjacent_similarity(store)
+    return np.concatenate(([0.0], similarity)), np.concatenate((similarity, [0.0]))
+
+
+def top_peak_positions(spectra, count=3, weights=None):
+    # Peak positions (into the store arrays) of the `count` most intense peaks of every spectrum, or of
+    # the peaks with the highest per-peak weights when given; grouped by row
+    store = as_spectrum_store(spectra)
+    rows = store.row_ids
+    if weights is None:
+        weights = store.intensity
+    order = np.lexsort((-np.asarray(weights, dtype=np.float64), rows))
+    rank = np.arange(len(order)) - store.offsets[rows[order]]
+    return order[rank < count]
+
+
+def top_peaks(spectra, count=3, weights=None):
+    # (row, m/z) of the `count` most intense (or highest weighted) peaks of every spectrum
+    store = as_spectrum_store(spectra)
+    selected = top_peak_positions(store, count, weights)
+    return store.row_ids[selected], np.rint(store.mz[selected]).astype(np.int64)
+
+
+def candidate_pairs(spectra, rt, rt_window, top_peak_count=3):
+    # Pairs (i < j) of spectra that share one of their top peaks and are within rt_window of each other.
+    # Each top peak is an inverted list sorted by RT, so only neighbours inside the window are visited.
+    rows, mz = top_peaks(spectra, top_peak_count)
+    rt = np.asarray(rt, dtype=np.float64)
+    if len(rows) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # One sorted key for all lists: m/z buckets spaced further apart than any RT difference
+    posting_rt = rt[rows] - np.nanmin(rt)
+    spacing = np.nanmax(posting_rt) + rt_window + 1
+    keys = mz * spacing + posting_rt
+    order = np.argsort(keys, kind='stable')
+    keys, rows = keys[order], rows[order]
+
+    starts = np.arange(len(keys)) + 1
+    ends = np.searchsorted(keys, keys + rt_window, side='right')
+    counts = np.maximum(ends - starts, 0)
+    first = np.repeat(np.arange(len(keys)), counts)
+    second = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+
+    a, b = rows[first], rows[second]
+    a, b = np.minimum(a, b), np.maximum(a, b)
+    keep = a != b
+    pair_ids = np.unique(a[keep] * len(rt) + b[keep])
+    return pair_ids // len(rt), pair_ids % len(rt)
+
+
+def indexed_pair_similarity(matrix, first, second, chunk_size=100000):
+    # Cosine similarity of the given row pairs of a row-normalised matrix, in chunks to bound memory
+    scores = np.zeros(len(first))
+    for start in range(0, len(first), chunk_size):
+        end = start + chunk_size
+        scores[start:end] = np.asarray(matrix[first[start:end]].multiply(matrix[second[start:end]]).sum(axis=1)).ravel()
+    return scores
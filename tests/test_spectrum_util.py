@@ -0,0 +1,31 @@
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from spectrum_util import parse_ms_peaks_column
+
+
+def make_text(peaks):
+    rng = np.random.default_rng(0)
+    intensity = np.round(rng.uniform(1, 999, size=peaks), 4)
+    return repr([(mz, value) for mz, value in zip(range(35, 35 + peaks), intensity.tolist())])
+
+
+def test_truncated_cell_is_rejected_quickly():
+    # A cell cut off mid-pair (as Excel truncates long cells) must fail validation without backtracking
+    text = make_text(200)
+    truncated = text[:-1] + ', (2'
+    start = time.perf_counter()
+    store, bad_rows = parse_ms_peaks_column([text, truncated])
+    assert time.perf_counter() - start < 0.1
+    assert bad_rows == [1]
+    assert len(store[0]) == 200 and len(store[1]) == 0
+
+
+def test_parse_accepts_spacing_and_number_forms():
+    store, bad_rows = parse_ms_peaks_column(['[ (41 , 999.0) , [43,1e2], (44, .5), ]', '[]', ''])
+    assert bad_rows == []
+    assert store[0].to_list() == [(41, 999.0), (43, 100.0), (44, 0.5)]
+    assert len(store[1]) == 0 and len(store[2]) == 0